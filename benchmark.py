@@ -0,0 +1,201 @@
+#!/usr/bin/env python
+
+# Benchmarks the merger on synthetic data and flags regressions against a baseline version.
+# To run from terminal:
+# python benchmark.py
+# Options:
+#   --scales N ...        numbers of participants to benchmark (default: 1000 10000 100000)
+#   --repeat N            number of runs at each scale; the median of the runs is recorded (default: 3)
+#   --merger FILE         the merger program to benchmark (default: merger.py next to this file)
+#   --merger-args=ARGS    extra arguments of the merger, as one string (default: --no-cache)
+#   --work-dir DIR        directory of the synthetic data and runs (default: a temporary directory)
+#   --results FILE        results file (default: benchmark_results.json)
+#   --label LABEL         name of this version (default: the git commit, or a hash of the merger)
+#   --baseline LABEL      version to compare against (default: the latest other version)
+#   --threshold P         share slower than the baseline flagged as a regression (default: 0.2)
+#   --min-seconds S       changes of fewer seconds are never flagged (default: 0.05)
+# The options of generate_synthetic_data.py (besides --participants) set the shape of the synthetic data.
+
+import os
+import sys
+import argparse
+import hashlib
+import json
+import shlex
+import shutil
+import subprocess
+import tempfile
+import time
+
+import generate_synthetic_data
+
+# the stages of the run which are recorded, and the stages of the run report they add up
+benchmark_stages = [['config load', ['config load']], ['form load', ['form load']], ['key index', ['key index']], ['date markers', ['date markers']], ['find discrepancies', []], ['assembly', ['assembly']], ['export', ['export', 'discrepancies export']]]
+
+## FUNCTIONS ##
+
+# gets the name of the version being benchmarked: its git commit, or a hash of the merger
+def get_version_label(merger_file):
+    merger_dir = os.path.dirname(os.path.abspath(merger_file))
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd = merger_dir, stderr = subprocess.DEVNULL).decode('utf-8').strip()
+        changes = subprocess.check_output(['git', 'status', '--porcelain', '--', os.path.basename(merger_file)], cwd = merger_dir, stderr = subprocess.DEVNULL).decode('utf-8').strip()
+        return commit + ('+' if changes != '' else '')
+    except Exception:
+        with open(merger_file, 'rb') as merger_program:
+            return hashlib.sha1(merger_program.read()).hexdigest()[:10]
+
+# gets the times of the stages of a run from its run report
+def get_stage_times(run_report):
+    stage_times = {}
+    all_stages = run_report['stages'] + [stage_record for table_report in run_report['tables'].values() for stage_record in table_report['stages']]
+    for stage_name, report_stages in benchmark_stages:
+        stage_times[stage_name] = sum(stage_record['seconds'] for stage_record in all_stages if stage_record['stage'] in report_stages)
+    stage_times['find discrepancies'] = sum(column_record['seconds'] for table_report in run_report['tables'].values() for column_record in table_report['columns'].values())
+    return stage_times
+
+# runs the merger once in its own directory. Returns the wall time, stage times and peak memory.
+def run_merger(merger_file, merger_args, data_dir, run_dir):
+    if os.path.isdir(run_dir):
+        shutil.rmtree(run_dir)
+    os.makedirs(run_dir)
+    command = [sys.executable, os.path.abspath(merger_file), os.path.join(data_dir, 'list_of_files.txt'), os.path.join(data_dir, 'input_config.csv'), os.path.join(data_dir, 'output_config.csv'), '--run-report', 'run_report.json'] + merger_args
+    start_time = time.perf_counter()
+    with open(os.path.join(run_dir, 'merger_output.txt'), 'w') as merger_output:
+        return_code = subprocess.call(command, cwd = run_dir, stdout = merger_output, stderr = subprocess.STDOUT)
+    wall_time = time.perf_counter() - start_time
+    if return_code != 0 or not os.path.exists(os.path.join(run_dir, 'run_report.json')):
+        raise Exception('The merger failed, see ' + os.path.join(run_dir, 'merger_output.txt'))
+    with open(os.path.join(run_dir, 'run_report.json')) as report_file:
+        run_report = json.load(report_file)
+    run_times = get_stage_times(run_report)
+    run_times['total'] = wall_time
+    run_times['peak rss mb'] = run_report.get('process_peak_rss_mb', 0)
+    run_times['error count'] = run_report['error_count']
+    return run_times
+
+# gets the median of a list of numbers
+def get_median(values):
+    sorted_values = sorted(values)
+    middle = len(sorted_values) // 2
+    if len(sorted_values) % 2 == 1:
+        return sorted_values[middle]
+    return (sorted_values[middle - 1] + sorted_values[middle]) / 2.0
+
+# benchmarks the merger at one scale. Returns the median of each time.
+def benchmark_scale(merger_file, merger_args, settings, repeat, work_dir):
+    scale_dir = os.path.join(work_dir, 'participants_' + str(settings['participants']))
+    data_dir = os.path.join(scale_dir, 'data')
+    print('\n# Generating ' + str(settings['participants']) + ' participants')
+    generate_synthetic_data.generate_synthetic_data(data_dir, settings)
+    runs = []
+    for run_index in range(repeat):
+        runs.append(run_merger(merger_file, merger_args, data_dir, os.path.join(scale_dir, 'run_' + str(run_index))))
+        print('Run ' + str(run_index + 1) + ' of ' + str(repeat) + ': ' + str(round(runs[-1]['total'], 2)) + 's')
+    scale_result = {}
+    for time_name in runs[0]:
+        scale_result[time_name] = round(get_median([run[time_name] for run in runs]), 4)
+    return scale_result
+
+# loads the results file, which holds the results of every version benchmarked
+def load_results(results_file):
+    if not os.path.exists(results_file):
+        return []
+    with open(results_file) as results_in:
+        return json.load(results_in)
+
+# writes the results file
+def write_results(results_file, results):
+    with open(results_file + '.tmp', 'w') as results_out:
+        json.dump(results, results_out, indent = 1)
+    os.replace(results_file + '.tmp', results_file)
+
+# finds the results of the baseline version
+def find_baseline(results, current):
+    for previous in reversed(results):
+        if previous['settings'] != current['settings'] or previous['merger_args'] != current['merger_args']:
+            continue
+        if (current['baseline'] is not None) and (previous['label'] == current['baseline']):
+            return previous
+        if (current['baseline'] is None) and (previous['label'] != current['label']):
+            return previous
+    return None
+
+# compares the results to the baseline at each shared scale. Returns the regressions.
+def find_regressions(current, baseline, threshold, min_seconds):
+    regressions = []
+    for scale, scale_result in current['scales'].items():
+        if scale not in baseline['scales']:
+            continue
+        for time_name, seconds in scale_result.items():
+            if time_name in ['peak rss mb', 'error count']:
+                continue
+            baseline_seconds = baseline['scales'][scale].get(time_name)
+            if baseline_seconds is None:
+                continue
+            if (seconds - baseline_seconds > min_seconds) and (seconds > baseline_seconds * (1 + threshold)):
+                regressions.append('participants ' + scale + ', ' + time_name + ': ' + str(baseline_seconds) + 's -> ' + str(seconds) + 's')
+    return regressions
+
+# prints a table of the results at each scale
+def print_results(current, baseline):
+    time_names = ['total'] + [stage_name for stage_name, report_stages in benchmark_stages] + ['peak rss mb']
+    print('\n' + 'participants'.ljust(14) + ''.join(time_name.rjust(20) for time_name in time_names))
+    for scale, scale_result in current['scales'].items():
+        line = scale.ljust(14)
+        for time_name in time_names:
+            cell = str(scale_result[time_name])
+            if (baseline is not None) and (scale in baseline['scales']) and (baseline['scales'][scale].get(time_name)):
+                cell = cell + ' (' + str(round(100.0 * (scale_result[time_name] / baseline['scales'][scale][time_name] - 1), 1)) + '%)'
+            line = line + cell.rjust(20)
+        print(line)
+
+
+## START OF PROGRAM ##
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Benchmarks the merger program on synthetic data and flags regressions against a previous version.')
+    parser.add_argument('--scales', type = int, nargs = '+', default = [1000, 10000, 100000], help = 'numbers of participants to benchmark')
+    parser.add_argument('--repeat', type = int, default = 3, help = 'number of runs at each scale; the median of the runs is recorded')
+    parser.add_argument('--merger', default = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'merger.py'), help = 'the merger program to benchmark')
+    parser.add_argument('--merger-args', default = '--no-cache', help = 'extra arguments of the merger, as one string')
+    parser.add_argument('--work-dir', help = 'directory the synthetic data and the outputs of the runs are written to (default: a temporary directory)')
+    parser.add_argument('--results', default = 'benchmark_results.json', help = 'results file which the results of this version are added to')
+    parser.add_argument('--label', help = 'name of the version being benchmarked (default: the git commit, or a hash of the merger program)')
+    parser.add_argument('--baseline', help = 'version to compare against (default: the latest other version in the results file)')
+    parser.add_argument('--threshold', type = float, default = 0.2, help = 'a time is flagged as a regression if it is slower than the baseline by more than this share')
+    parser.add_argument('--min-seconds', type = float, default = 0.05, help = 'changes of fewer seconds than this are never flagged')
+    generate_synthetic_data.add_generator_arguments(parser)
+    args = parser.parse_args()
+
+    settings = generate_synthetic_data.get_generator_settings(args)
+    merger_args = shlex.split(args.merger_args)
+    work_dir = args.work_dir if args.work_dir else tempfile.mkdtemp(prefix = 'merger_benchmark_')
+    current = {'label': args.label if args.label else get_version_label(args.merger), 'baseline': args.baseline, 'date': time.strftime('%Y-%m-%d %H:%M:%S'), 'settings': dict(settings, participants = None), 'merger_args': merger_args, 'scales': {}}
+    try:
+        for participants in args.scales:
+            current['scales'][str(participants)] = benchmark_scale(args.merger, merger_args, dict(settings, participants = participants), args.repeat, work_dir)
+    except Exception as e:
+        print('Error: ' + str(e))
+        sys.exit(2)
+    finally:
+        if not args.work_dir:
+            shutil.rmtree(work_dir, True)
+
+    results = load_results(args.results)
+    baseline = find_baseline(results, current)
+    results.append(current)
+    write_results(args.results, results)
+    print_results(current, baseline)
+    print('\nResults of \'' + current['label'] + '\' added to \'' + args.results + '\'.')
+
+    # regressions fail the benchmark, so it can be used as a check
+    if baseline is None:
+        print('No baseline to compare against.')
+    else:
+        regressions = find_regressions(current, baseline, args.threshold, args.min_seconds)
+        print('Compared against \'' + baseline['label'] + '\' (' + baseline['date'] + '): ' + str(len(regressions)) + ' regression(s).')
+        for regression in regressions:
+            print('REGRESSION: ' + regression)
+        if len(regressions) != 0:
+            sys.exit(1)
@@ -0,0 +1,195 @@
+#!/usr/bin/env python
+
+# Generates synthetic input forms for the merger program, with the list of files and the configs.
+# To run from terminal:
+# python generate_synthetic_data.py 'output directory'
+# Options:
+#   --participants N      number of participants (default: 1000)
+#   --visits N            number of visits of each participant (default: 3)
+#   --forms N             number of input forms (default: 4)
+#   --tables N            number of output tables (default: 2)
+#   --columns N           output columns of each table, besides the keys and dates (default: 10)
+#   --coverage P          chance that a form has a row for a given visit (default: 0.8)
+#   --overlap P           chance that a column is also taken from each other form (default: 0.5)
+#   --conflict-rate P     chance that a form's value differs from the true value (default: 0.05)
+#   --missing-rate P      chance that a form's value is missing (default: 0.05)
+#   --duplicate-rate P    chance that a row of a form is repeated, giving a duplicate key (default: 0)
+#   --precedence-levels N number of form precedences; form i has precedence i % N + 1 (default: 2)
+#   --date-layout LAYOUT  'none', 'date' or 'mixed' (a date, then day/month/year) (default: mixed)
+#   --seed N              seed of the random number generator (default: 0)
+
+import pandas as pd
+import numpy as np
+import os
+import argparse
+
+# the values written for missing values, as they are found in the real forms
+missing_value_sentinels = ['', '-4']
+
+# the output key columns, and the name of each key column in the forms with even and odd positions
+key_fields = {'reggieid': ['ptid', 'reggieid'], 'visitno': ['visitno', 'visno']}
+
+## FUNCTIONS ##
+
+# gets the name of the field of a key column in a form
+def get_key_field(output_key_column, form_index):
+    return key_fields[output_key_column][form_index % 2]
+
+# gets the name of the field which holds an output column in a form
+def get_value_field(output_cn, form_index):
+    return output_cn + '_f' + str(form_index)
+
+# the comparison rule of each output column: every third column is compared as integers
+def get_column_rule(column_index):
+    if column_index % 3 == 2:
+        return 'compare_value_int'
+    return ''
+
+# plans the output columns of every output table and the forms each is taken from
+def plan_table_columns(settings, rng):
+    table_columns = {}
+    for table_index in range(settings['tables']):
+        output_tn = 'table_' + str(table_index)
+        table_columns[output_tn] = []
+        for column_index in range(settings['columns']):
+            main_form = (table_index + column_index) % settings['forms']
+            column_forms = [form_index for form_index in range(settings['forms']) if (form_index == main_form) or (rng.random() < settings['overlap'])]
+            table_columns[output_tn].append({'output_cn': 't' + str(table_index) + '_var' + str(column_index), 'forms': column_forms, 'rule': get_column_rule(column_index)})
+    return table_columns
+
+# writes a form's values for a column, with a share of conflicts and missing values
+def get_form_values(true_values, rule, settings, rng):
+    row_count = len(true_values)
+    values = true_values.copy()
+    is_conflict = rng.random(row_count) < settings['conflict_rate']
+    values[is_conflict] = (values[is_conflict] + rng.integers(1, 10, is_conflict.sum())) % 10
+    values = values.astype(str)
+    if rule == 'compare_value_int':
+        has_decimal = rng.random(row_count) < 0.5
+        values[has_decimal] = np.char.add(values[has_decimal], '.0')
+    is_missing = rng.random(row_count) < settings['missing_rate']
+    values = values.astype(object)
+    values[is_missing] = rng.choice(missing_value_sentinels, is_missing.sum())
+    return values
+
+# writes a form's visit dates, with a share shifted or missing
+def get_form_dates(true_dates, settings, rng):
+    row_count = len(true_dates)
+    is_conflict = rng.random(row_count) < settings['conflict_rate']
+    dates = pd.Series(true_dates + pd.to_timedelta(np.where(is_conflict, rng.integers(-180, 181, row_count), 0), unit = 'D'))
+    is_missing = rng.random(row_count) < settings['missing_rate']
+    days = dates.dt.day.astype(str).to_numpy(dtype = object)
+    months = dates.dt.month.astype(str).to_numpy(dtype = object)
+    years = dates.dt.year.astype(str).to_numpy(dtype = object)
+    date_strings = months + '/' + days + '/' + years
+    for date_parts in [date_strings, days, months, years]:
+        date_parts[is_missing] = ''
+    return date_strings, days, months, years
+
+# generates the input forms and the rows of the config files which merge them
+def generate_synthetic_data(output_dir, settings):
+    rng = np.random.default_rng(settings['seed'])
+    form_dir = os.path.join(output_dir, 'forms')
+    if not os.path.isdir(form_dir):
+        os.makedirs(form_dir)
+    table_columns = plan_table_columns(settings, rng)
+    form_names = ['form_' + str(form_index) for form_index in range(settings['forms'])]
+
+    # every visit of every participant, with its true visit date and true values
+    participant_ids = np.array(['P' + str(participant).zfill(len(str(settings['participants']))) for participant in range(settings['participants'])], dtype = object)
+    visit_ids = pd.DataFrame({'reggieid': np.repeat(participant_ids, settings['visits']), 'visitno': np.tile(np.arange(1, settings['visits'] + 1).astype(str).astype(object), settings['participants'])})
+    visit_count = len(visit_ids)
+    true_dates = pd.DatetimeIndex(pd.Timestamp('2000-01-01') + pd.to_timedelta(rng.integers(0, 365 * 20, visit_count), unit = 'D'))
+    true_values = {}
+    for output_tn in table_columns:
+        for column in table_columns[output_tn]:
+            true_values[column['output_cn']] = rng.integers(0, 10, visit_count)
+
+    # the config rows
+    input_config_rows = []
+    output_config_rows = []
+    for table_index, output_tn in enumerate(table_columns):
+        display_order = 1
+        for output_key_column in key_fields:
+            output_config_rows.append([output_tn, output_key_column, output_key_column, display_order])
+            display_order += 1
+            for form_index, form_name in enumerate(form_names):
+                input_config_rows.append([output_tn, output_key_column, form_index % settings['precedence_levels'] + 1, form_name, get_key_field(output_key_column, form_index), '', ''])
+        if settings['date_layout'] != 'none':
+            for date_column in ['visdate', 'visday', 'vismonth', 'visyear'] if settings['date_layout'] == 'mixed' else ['visdate']:
+                output_config_rows.append([output_tn, date_column, '', display_order])
+                display_order += 1
+            for form_index, form_name in enumerate(form_names):
+                precedence = form_index % settings['precedence_levels'] + 1
+                if (settings['date_layout'] == 'date') or (form_index == 0):
+                    input_config_rows.append([output_tn, 'visdate', precedence, form_name, 'vdate', 'date', 'date_90_day'])
+                else:
+                    input_config_rows.append([output_tn, 'visday', precedence, form_name, 'vd', 'day', ''])
+                    input_config_rows.append([output_tn, 'vismonth', precedence, form_name, 'vm', 'month', ''])
+                    input_config_rows.append([output_tn, 'visyear', precedence, form_name, 'vy', 'year', ''])
+        for column in table_columns[output_tn]:
+            output_config_rows.append([output_tn, column['output_cn'], '', display_order])
+            display_order += 1
+            for form_index in column['forms']:
+                input_config_rows.append([output_tn, column['output_cn'], form_index % settings['precedence_levels'] + 1, form_names[form_index], get_value_field(column['output_cn'], form_index), '', column['rule']])
+    pd.DataFrame(input_config_rows, columns = ['output_tn', 'output_cn', 'form_precedence', 'input_form_name', 'input_field_name', 'date_markers', 'comparison_type']).to_csv(os.path.join(output_dir, 'input_config.csv'), index = False)
+    pd.DataFrame(output_config_rows, columns = ['output_tn', 'output_cn', 'key_column', 'output_display_order']).to_csv(os.path.join(output_dir, 'output_config.csv'), index = False)
+
+    # the forms: each has a row for a share of the visits, with its own names for the key columns
+    list_of_files = []
+    for form_index, form_name in enumerate(form_names):
+        has_visit = rng.random(visit_count) < settings['coverage']
+        form_df = pd.DataFrame({get_key_field('reggieid', form_index): visit_ids['reggieid'].to_numpy()[has_visit], get_key_field('visitno', form_index): visit_ids['visitno'].to_numpy()[has_visit]})
+        if settings['date_layout'] != 'none':
+            date_strings, days, months, years = get_form_dates(true_dates[has_visit], settings, rng)
+            if (settings['date_layout'] == 'date') or (form_index == 0):
+                form_df['vdate'] = date_strings
+            else:
+                form_df['vd'] = days
+                form_df['vm'] = months
+                form_df['vy'] = years
+        for output_tn in table_columns:
+            for column in table_columns[output_tn]:
+                if form_index in column['forms']:
+                    form_df[get_value_field(column['output_cn'], form_index)] = get_form_values(true_values[column['output_cn']][has_visit], column['rule'], settings, rng)
+        # repeated rows give duplicate keys
+        is_duplicate = rng.random(len(form_df)) < settings['duplicate_rate']
+        if is_duplicate.any():
+            form_df = pd.concat([form_df, form_df[is_duplicate]]).sort_index(kind = 'mergesort').reset_index(drop = True)
+        form_path = os.path.abspath(os.path.join(form_dir, form_name + '.csv'))
+        form_df.to_csv(form_path, index = False)
+        list_of_files.append('synthetic|' + form_name + '|' + form_path)
+        print('Wrote \'' + form_name + '\' (' + str(len(form_df)) + ' rows, ' + str(len(form_df.columns)) + ' columns)')
+    with open(os.path.join(output_dir, 'list_of_files.txt'), 'w') as list_file:
+        list_file.write('\n'.join(list_of_files) + '\n')
+
+# the settings of the generator, from the parsed command line arguments
+def get_generator_settings(args):
+    return {'participants': args.participants, 'visits': args.visits, 'forms': args.forms, 'tables': args.tables, 'columns': args.columns, 'coverage': args.coverage, 'overlap': args.overlap, 'conflict_rate': args.conflict_rate, 'missing_rate': args.missing_rate, 'duplicate_rate': args.duplicate_rate, 'precedence_levels': args.precedence_levels, 'date_layout': args.date_layout, 'seed': args.seed}
+
+# adds the arguments of the generator to a parser, so the benchmark suite takes the same arguments
+def add_generator_arguments(parser):
+    parser.add_argument('--participants', type = int, default = 1000, help = 'number of participants')
+    parser.add_argument('--visits', type = int, default = 3, help = 'number of visits of each participant')
+    parser.add_argument('--forms', type = int, default = 4, help = 'number of input forms')
+    parser.add_argument('--tables', type = int, default = 2, help = 'number of output tables')
+    parser.add_argument('--columns', type = int, default = 10, help = 'number of output columns in each output table, besides the key and date columns')
+    parser.add_argument('--coverage', type = float, default = 0.8, help = 'chance that a form has a row for a given visit')
+    parser.add_argument('--overlap', type = float, default = 0.5, help = 'chance that an output column is also taken from each form other than its main form')
+    parser.add_argument('--conflict-rate', type = float, default = 0.05, help = 'chance that a form\'s value differs from the true value')
+    parser.add_argument('--missing-rate', type = float, default = 0.05, help = 'chance that a form\'s value is missing')
+    parser.add_argument('--duplicate-rate', type = float, default = 0.0, help = 'chance that a row of a form is repeated, giving a duplicate key')
+    parser.add_argument('--precedence-levels', type = int, default = 2, help = 'number of form precedences; form i has precedence i %% N + 1')
+    parser.add_argument('--date-layout', choices = ['none', 'date', 'mixed'], default = 'mixed', help = 'date columns of the forms: none, a date column in every form, or a date column in the first form and day, month, and year columns in the others')
+    parser.add_argument('--seed', type = int, default = 0, help = 'seed of the random number generator')
+
+
+## START OF PROGRAM ##
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Generates synthetic input forms, along with the list of input files and the config files which merge them.')
+    parser.add_argument('output_dir', help = 'directory the forms, list of input files, and config files are written to')
+    add_generator_arguments(parser)
+    args = parser.parse_args()
+    generate_synthetic_data(args.output_dir, get_generator_settings(args))
+    print('\nComplete.\nRun the merger with:\n        python merger.py ' + os.path.join(args.output_dir, 'list_of_files.txt') + ' ' + os.path.join(args.output_dir, 'input_config.csv') + ' ' + os.path.join(args.output_dir, 'output_config.csv'))
@@ -1,22 +1,105 @@
 #!/usr/bin/env python
 
 # To run from terminal:
-# python merger_rebuild.py 'list of input files file name' 'input config file name' 'output config file name'
+# python merger.py 'list of input files file name' 'input config file name' 'output config file name'
+# Options:
+#   --cache-dir DIR       directory of the cache of parsed input forms (default: .merger_cache)
+#   --no-cache            don't use the cache of parsed forms and merge plans
+#   --rebuild-cache       replace the cache entries of the forms and merge plan
+#   --cache-size-mb MB    size cap of the cached forms and merge plans (default: 4096)
+#   --incremental         only recompute the output columns whose inputs changed since the last run
+#   --manifest FILE       run manifest (default: merger_manifest.json)
+#   --read-threads N      number of input forms read at the same time on a pool of threads (default: 4)
+#   --jobs N              process N output tables (or shards) at the same time (default: 1)
+#   --write-plan FILE     write the merge plan as JSON instead of running the merge
+#   --rule-plugins FILE ...     python files which register additional comparison rules
+#   --discrepancy-batch-rows N  discrepancies kept in memory before spilling (default: 100000)
+#   --discrepancies-parquet     also write discrepancies.parquet (requires pyarrow)
+#   --streaming           merge the forms out of core, a batch of keys at a time
+#   --memory-budget-mb MB memory budget of the streaming mode (default: 1024)
+#   --backend ENGINE      resolve the output tables with pandas (default) or in SQLite (sqlite)
+#   --database FILE       database of the sqlite backend (default: merger.sqlite in the cache)
+#   --shards N            hash-partition the forms on the first key column into N shards
+#   --write-shards DIR    write the shards to DIR instead of running the merge
+#   --combine-shards DIR  combine the outputs of the shards in DIR once each has been run
+#   --run-report FILE     write a JSON report of the time of each stage, with the process peak memory so far
+#   --trace-memory        record the peak memory traced while each stage runs in the run report (slower)
+#   --profile FILE        profile the run with cProfile and dump the statistics to FILE
+#   --dictionary-max-values N  encode columns of at most N values (default: 1000, 0 to disable)
+#   --output-formats F ...  write the output tables as csv (default), csv.gz, parquet, and/or feather
+#   --write-threads N     number of output tables written at the same time (default: 2)
+#   --dry-run [FILE]      estimate the cost of each output table and suggest --jobs or --shards
+#   --dry-run-sample-rows N  rows of the largest form in the dry run's sample (default: 10000)
+#   --cell-store DIR      keep the resolved cells in DIR and only resolve the changed ones
+#   --discrepancy-delta   also write the changed discrepancies to discrepancies_delta.csv
+#   --duplicate-keys P    policy for duplicate key tuples: first (default), fail, precedence, or report
+#   --watch               keep running, and run again whenever a file it reads changes
+#   --watch-interval S    seconds between the checks for changed files in watch mode (default: 2)
+# From python:
+#   from merger import Merger
+#   merger = Merger('list of files', 'input config', 'output config', incremental = True)
+#   estimate = merger.estimate()
+#   output_tables, discrepancies = merger.run()
+#   merger.export()
 
 import pandas as pd
 import numpy as np
 import os
 import sys
-from datetime import date, timedelta
+import argparse
+import hashlib
+import json
+import re
+import importlib.util
+import shutil
+import atexit
+import tempfile
+import multiprocessing
+import concurrent.futures
+import threading
+import copy
+import types
+import time
+import sqlite3
+import cProfile
+import tracemalloc
+import gzip
+
+# pyarrow is optional; without it the input forms are not cached
+try:
+    import pyarrow as pa
+    import pyarrow.feather as feather
+    import pyarrow.parquet as parquet
+except ImportError:
+    feather = None
+
+# resource is only available on Unix; without it the run report has no peak resident memory
+try:
+    import resource
+except ImportError:
+    resource = None
 
 pd.options.mode.chained_assignment = None
 
+# values which are treated as missing when comparing forms
+null_values = ['nan', '', '-4']
+
+# number of rows of an output table which are written to its files at a time
+output_chunk_rows = 100000
+
 ## FUNCTIONS ##
 
-# logs an error message and prints an alert
+# logs an error message and prints an alert; the messages of a table are kept until it's finished
 def log_error(message, python_message, critical):
     global error_log
     global error_count
+    global table_error_messages
+    if table_error_messages is not None:
+        table_error_messages.append(('\n' + message + '\n' + python_message, True))
+        if(critical):
+            sys.exit()
+        print('ERROR: Check error_log.txt')
+        return
     error_count += 1
     error_log.write('\n' + message + '\n' + python_message)
     if(critical):
@@ -26,16 +109,101 @@ def log_error(message, python_message, critical):
     else:
         print('ERROR: Check error_log.txt')
 
+# writes a progress message to the error log; it isn't counted as an error
+def log_progress(message):
+    global error_log
+    global table_error_messages
+    if table_error_messages is not None:
+        table_error_messages.append(('\n' + message + '\n', False))
+        return
+    error_log.write('\n' + message + '\n')
+
+# starts timing a stage of the run. Returns the running stage, which is ended with end_stage.
+def start_stage(stage_name):
+    global stage_stack
+    if trace_memory:
+        update_stage_peaks()
+    stage = {'stage': stage_name, 'start_time': time.perf_counter(), 'peak_memory': 0}
+    stage_stack.append(stage)
+    return stage
+
+# adds the traced memory peak since the last reset to every running stage, then resets it
+def update_stage_peaks():
+    global stage_stack
+    traced_peak = tracemalloc.get_traced_memory()[1]
+    for stage in stage_stack:
+        stage['peak_memory'] = max(stage['peak_memory'], traced_peak)
+    tracemalloc.reset_peak()
+
+# the peak resident memory of the process so far in MB (ru_maxrss is in bytes on macOS)
+def get_max_rss_mb():
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        max_rss = max_rss / 1024.0
+    return round(max_rss / 1024.0, 2)
+
+# ends a running stage and returns its record, adding it to stage_records if given
+def end_stage(stage, stage_records):
+    global stage_stack
+    if trace_memory:
+        update_stage_peaks()
+    for position in range(len(stage_stack) - 1, -1, -1):
+        if stage_stack[position] is stage:
+            del stage_stack[position:]
+            break
+    stage_record = {'stage': stage['stage'], 'seconds': round(time.perf_counter() - stage['start_time'], 4)}
+    if trace_memory:
+        stage_record['peak_traced_mb'] = round(stage['peak_memory'] / 1048576.0, 2)
+    if resource is not None:
+        stage_record['process_peak_rss_mb'] = get_max_rss_mb()
+    if stage_records is not None:
+        stage_records.append(stage_record)
+    return stage_record
+
+# adds a stage or column record into the same record of another part of a table
+def merge_report_record(merged_record, record):
+    for name, value in record.items():
+        if name in ['seconds', 'rows', 'discrepancies']:
+            merged_record[name] = round(merged_record.get(name, 0) + value, 4)
+        elif name.endswith('_mb') or (name == 'forms'):
+            merged_record[name] = max(merged_record.get(name, 0), value)
+        elif name not in merged_record:
+            merged_record[name] = value
+
+# merges the reports of the parts of an output table into the report of the whole table
+def merge_table_reports(table_reports):
+    merged_report = {'stages': [], 'columns': {}}
+    stage_positions = {}
+    for table_report in table_reports:
+        for stage_record in table_report['stages']:
+            if stage_record['stage'] not in stage_positions:
+                stage_positions[stage_record['stage']] = len(merged_report['stages'])
+                merged_report['stages'].append({})
+            merge_report_record(merged_report['stages'][stage_positions[stage_record['stage']]], stage_record)
+        for output_cn, column_record in table_report['columns'].items():
+            merge_report_record(merged_report['columns'].setdefault(output_cn, {}), column_record)
+        if 'rows' in table_report:
+            merged_report['rows'] = merged_report.get('rows', 0) + table_report['rows']
+    return merged_report
+
+# writes the run report as JSON
+def write_run_report(report_file, run_report):
+    try:
+        with open(report_file, 'w') as report_out:
+            json.dump(run_report, report_out, indent = 1)
+    except Exception as e:
+        log_error('Error: Could not write the run report \'' + report_file + '\'', str(e), False)
+
 # sorts the input config file by the output table names and the output column names
 def sort_input_config_file(in_config):
     try:
         in_config = in_config[['output_tn', 'output_cn', 'form_precedence', 'input_form_name', 'input_field_name', 'date_markers', 'comparison_type']]
     except Exception as e:
-        log_error('Error: The input config file does not contain the required columns', e.message, True)
+        log_error('Error: The input config file does not contain the required columns', str(e), True)
     try:
         in_config['form_precedence'] = in_config['form_precedence'].astype('int')
     except Exception as e:
-        log_error('Error: Not all forms have been assigned a form_precedence value', e.message, True)
+        log_error('Error: Not all forms have been assigned a form_precedence value', str(e), True)
     in_config = in_config.sort_values(by=['output_tn', 'output_cn'])
     return in_config
 
@@ -44,54 +212,244 @@ def sort_output_config_file(out_config):
     try:
         out_config = out_config[['output_tn', 'output_cn', 'key_column', 'output_display_order']]
     except Exception as e:
-        log_error('Error: The output config file does not contain the required columns', e.message, True)
+        log_error('Error: The output config file does not contain the required columns', str(e), True)
     try:
         out_config['output_display_order'] = out_config['output_display_order'].astype('int')
     except Exception as e:
-        log_error('Error: Not all columns have been assigned an output_display_order value', e.message, True)
+        log_error('Error: Not all columns have been assigned an output_display_order value', str(e), True)
     out_config = out_config.sort_values(by=['output_tn', 'output_display_order'])
     return out_config
 
 # pass in config file and get out DataFrame
 def load_config_file(cfile):
     try:
-        cdf = pd.read_csv(cfile, dtype='string')
+        cdf = pd.read_csv(cfile, dtype=str)
         return cdf
     except Exception as e:
-        log_error('Error: Problem reading the config file \'' + cfile + '\'', e.message, True)
-
-# reads the .txt file listing the directories of the required input files and loads them into a dictionary
-def load_input_files(list_of_files):
-    global all_input_forms
-    try:
-        all_input_forms = {}
-        text_file = open(list_of_files)
-        converted_string = text_file.read()
-        file_list = converted_string.split('\n')
-        for form in file_list:
-            split_line = form.split('|')
-            if(len(split_line) == 3):
-                all_input_forms[split_line[1]] = pd.read_csv(split_line[2],dtype='string')
-        return all_input_forms
+        log_error('Error: Problem reading the config file \'' + cfile + '\'', str(e), True)
+
+# gets the input field names that the input config references in each input form
+def get_required_input_fields(in_config):
+    required_fields_dict = {}
+    for form_name, form_rows in in_config.groupby('input_form_name', sort = False):
+        required_fields_dict[form_name] = set(form_rows['input_field_name'].dropna().tolist())
+    return required_fields_dict
+
+# writes data to a JSON file
+def write_json_file(json_path, data, sort_keys = False):
+    with open(json_path, 'w') as json_file:
+        json.dump(data, json_file, indent = 1, sort_keys = sort_keys)
+
+# writes a file with write_file to a temporary path and then moves it into place
+def write_file_atomically(file_path, write_file):
+    temp_path = file_path + '.tmp'
+    write_file(temp_path)
+    os.replace(temp_path, file_path)
+
+# fingerprints a form file by path, size, mtime and content hash, hashed again only if they change
+def get_file_fingerprint(file_path):
+    global cache_dir
+    file_path = os.path.abspath(file_path)
+    file_stat = os.stat(file_path)
+    hash_path = os.path.join(cache_dir, 'hash_' + hashlib.sha1(file_path.encode('utf-8')).hexdigest() + '.json')
+    try:
+        with open(hash_path) as hash_file:
+            file_hash = json.load(hash_file)
+        if (file_hash['size'] == file_stat.st_size) and (file_hash['mtime_ns'] == file_stat.st_mtime_ns):
+            return [file_path, file_stat.st_size, file_stat.st_mtime_ns, file_hash['sha1']]
+    except (OSError, ValueError, KeyError):
+        pass
+    content_hash = hashlib.sha1()
+    with open(file_path, 'rb') as form_file:
+        for chunk in iter(lambda: form_file.read(1 << 20), b''):
+            content_hash.update(chunk)
+    with cache_lock:
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        write_file_atomically(hash_path, lambda temp_path: write_json_file(temp_path, {'size': file_stat.st_size, 'mtime_ns': file_stat.st_mtime_ns, 'sha1': content_hash.hexdigest()}))
+    return [file_path, file_stat.st_size, file_stat.st_mtime_ns, content_hash.hexdigest()]
+
+# gets the path of the cache entry of a form, keyed by its file's fingerprint and the columns read
+def get_cache_entry_path(file_path, required_fields):
+    global cache_dir
+    cache_key = json.dumps(get_file_fingerprint(file_path) + [sorted(required_fields)])
+    return os.path.join(cache_dir, hashlib.sha1(cache_key.encode('utf-8')).hexdigest() + '.feather')
+
+# loads a parsed form from the cache. Touching the entry marks it as recently used.
+def read_cached_form(entry_path):
+    form_table = feather.read_table(entry_path)
+    os.utime(entry_path, None)
+    return form_table.to_pandas(types_mapper = {pa.string(): pd.StringDtype(), pa.large_string(): pd.StringDtype()}.get)
+
+# stores a parsed form in the cache
+def write_cached_form(entry_path, form_df):
+    global cache_dir
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    write_file_atomically(entry_path, lambda temp_path: feather.write_feather(form_df, temp_path))
+
+# removes the least recently used cached forms and merge plans until the cache is within its size cap
+def evict_cache_entries():
+    global cache_dir
+    global cache_size_limit
+    entries = []
+    for entry_name in os.listdir(cache_dir):
+        if entry_name.endswith('.feather') or (entry_name.startswith('plan_') and entry_name.endswith('.json')):
+            entry_stat = os.stat(os.path.join(cache_dir, entry_name))
+            entries.append((entry_stat.st_mtime, entry_stat.st_size, entry_name))
+    entries.sort()
+    cache_size = sum(entry[1] for entry in entries)
+    for entry_mtime, entry_size, entry_name in entries:
+        if cache_size <= cache_size_limit:
+            break
+        os.remove(os.path.join(cache_dir, entry_name))
+        cache_size -= entry_size
+
+# reads a form from its .csv file, or from the cache. Cache errors are added to form_errors.
+def read_input_form(file_path, required_fields, form_errors):
+    global use_cache
+    global rebuild_cache
+    entry_path = None
+    if use_cache:
+        try:
+            entry_path = get_cache_entry_path(file_path, required_fields)
+            if (not rebuild_cache) and os.path.exists(entry_path):
+                return read_cached_form(entry_path)
+        except Exception as e:
+            form_errors.append(('Error: Could not read the cache entry for \'' + file_path + '\', the form will be parsed from its .csv file', str(e)))
+    form_df = pd.read_csv(file_path, dtype='string', usecols=lambda col: col in required_fields)
+    if entry_path is not None:
+        try:
+            # forms are read on several threads, so only one of them writes to the cache at a time
+            with cache_lock:
+                write_cached_form(entry_path, form_df)
+                evict_cache_entries()
+        except Exception as e:
+            form_errors.append(('Error: Could not write the cache entry for \'' + file_path + '\'', str(e)))
+    return form_df
+
+# reads the .txt file listing the input files into a dictionary of the path of each form
+def read_list_of_files(list_of_files):
+    global merge_plan
+    form_paths = {}
+    text_file = open(list_of_files)
+    converted_string = text_file.read()
+    text_file.close()
+    file_list = converted_string.split('\n')
+    for form in file_list:
+        split_line = form.split('|')
+        if(len(split_line) == 3) and (split_line[1] in merge_plan['required_fields']):
+            form_paths[split_line[1]] = split_line[2]
+    return form_paths
+
+# the fields of a form which are only compared as strings
+def get_dictionary_fields(form_name):
+    global merge_plan
+    excluded_fields = set()
+    for table_plan in merge_plan['tables'].values():
+        excluded_fields.update(table_plan['key_fields'].get(form_name, {}).values())
+        date_markers = table_plan['date_markers']
+        if form_name in date_markers['date_fields']:
+            excluded_fields.add(date_markers['date_fields'][form_name])
+        excluded_fields.update(date_markers['dmy_fields'].get(form_name, []))
+        for column_plan in table_plan['columns']:
+            if column_plan['is_dmy_var'] or (column_plan['output_cn'] == date_markers['date_col_name']):
+                excluded_fields.update(source['field_name'] for source in column_plan['sources'] if source['form_name'] == form_name)
+    return [field_name for field_name in merge_plan['required_fields'][form_name] if field_name not in excluded_fields]
+
+# dictionary-encodes the low-cardinality compared columns of a form. Returns the number encoded.
+def encode_form_columns(form_name, form_df):
+    global dictionary_max_values
+    encoded_count = 0
+    if dictionary_max_values <= 0:
+        return encoded_count
+    for field_name in get_dictionary_fields(form_name):
+        if (field_name in form_df.columns) and (form_df[field_name].dtype != 'category'):
+            encoded_column = form_df[field_name].astype('category')
+            if len(encoded_column.cat.categories) <= dictionary_max_values:
+                form_df[field_name] = encoded_column
+                encoded_count = encoded_count + 1
+    return encoded_count
+
+# reads an input form on a thread. Returns the form, its errors and its row hashes.
+def read_input_form_timed(form_name, file_path, required_fields):
+    global run_report
+    start_time = time.time()
+    form_errors = []
+    form_df = read_input_form(file_path, required_fields, form_errors)
+    encoded_count = encode_form_columns(form_name, form_df)
+    # the rows are hashed while the form is loaded when the cell store is used
+    row_hashes = hash_form_rows(form_df) if hash_loaded_forms else None
+    print('Loaded \'' + form_name + '\' (' + str(len(form_df)) + ' rows) in ' + str(round(time.time() - start_time, 2)) + 's')
+    run_report['forms'][form_name] = {'seconds': round(time.time() - start_time, 4), 'rows': len(form_df), 'columns': len(form_df.columns), 'dictionary_columns': encoded_count}
+    return form_df, form_errors, row_hashes
+
+# the fingerprint of a loaded input form: its file's path, size and mtime, and its columns
+def get_loaded_form_fingerprint(file_path, required_fields):
+    file_stat = os.stat(file_path)
+    return [os.path.abspath(file_path), file_stat.st_size, file_stat.st_mtime_ns, sorted(required_fields)]
+
+# starts reading the required input files on a pool of threads, keeping unchanged forms
+def start_loading_input_files(list_of_files, read_threads):
+    global merge_plan
+    global input_read_pool
+    global loaded_input_files_dict
+    global loaded_form_fingerprints
+    global loaded_form_row_hashes
+    try:
+        form_paths = read_list_of_files(list_of_files)
+        for form_name in list(loaded_input_files_dict):
+            if form_name not in form_paths:
+                del loaded_input_files_dict[form_name]
+                loaded_form_row_hashes.pop(form_name, None)
+        input_read_pool = concurrent.futures.ThreadPoolExecutor(max_workers = max(read_threads, 1))
+        form_futures = {}
+        for form_name, form_path in form_paths.items():
+            required_fields = set(merge_plan['required_fields'][form_name])
+            form_fingerprint = get_loaded_form_fingerprint(form_path, required_fields)
+            if (form_name in loaded_input_files_dict) and (loaded_form_fingerprints.get(form_name) == form_fingerprint):
+                continue
+            loaded_input_files_dict.pop(form_name, None)
+            loaded_form_row_hashes.pop(form_name, None)
+            loaded_form_fingerprints[form_name] = form_fingerprint
+            form_futures[form_name] = input_read_pool.submit(read_input_form_timed, form_name, form_path, required_fields)
+        return form_futures
     except Exception as e:
-        log_error('Error: Could not load input source files from the given paths', e.message, True)
+        log_error('Error: Could not load input source files from the given paths', str(e), True)
+
+# waits for the given input forms to be read and adds them to the loaded forms
+def wait_for_input_forms(form_names):
+    global loaded_input_files_dict
+    global loaded_form_row_hashes
+    global input_form_futures
+    global run_report
+    waited_forms = [form_name for form_name in form_names if form_name in input_form_futures]
+    if len(waited_forms) == 0:
+        return
+    form_load_stage = start_stage('form load')
+    for form_name in form_names:
+        if form_name in input_form_futures:
+            try:
+                loaded_input_files_dict[form_name], form_errors, row_hashes = input_form_futures.pop(form_name).result()
+                if row_hashes is not None:
+                    loaded_form_row_hashes[form_name] = row_hashes
+                for message, python_message in form_errors:
+                    log_error(message, python_message, False)
+            except Exception as e:
+                log_error('Error: Could not load the input form \'' + form_name + '\' from its path', str(e), True)
+    end_stage(form_load_stage, run_report['stages'])['forms'] = waited_forms
 
-# creates an output file and adds it to the dictionary of all output files
-def create_output_file(output_tn, output_files_dict, key_values):
+# creates an output file and adds it to the resolved columns; the table is assembled once they're all done
+def create_output_file(output_tn, resolved_columns_dict):
     print('\n\n# Creating output table: \'' + output_tn + '\'\n')
     try:
-        output_file_names.append(output_tn)
-        output_file = 'output file'
-        converter = {}
-        temp = output_file
-        converter[temp] = output_tn
-        output_files_dict[converter[output_file]] = pd.DataFrame(columns = key_values)
-        return output_files_dict
+        resolved_columns_dict[output_tn] = []
+        return resolved_columns_dict
     except Exception as e:
-        log_error('Error: Could not create the output table \'' + output_tn + '\'', e.message, True)
+        log_error('Error: Could not create the output table \'' + output_tn + '\'', str(e), True)
 
 # gets the key columns for a certain output table
-def get_key_columns(output_config_specific_tn):
+def get_key_columns(output_tn, output_config_specific_tn):
     try:
         key_columns_df = output_config_specific_tn[['key_column']]
         key_columns_df = key_columns_df.dropna(how='any',axis=0)
@@ -100,52 +458,188 @@ def get_key_columns(output_config_specific_tn):
             key_column_list.append(row['key_column'])
         return key_column_list
     except Exception as e:
-        log_error('Error: Could not retrieve the key columns for output table \'' + output_config_specific_tn + '\'', e.message, True)
-
-# goes through each input form required for the specific output table and makes sure they contain the required key values
-def check_input_forms_for_key_values(output_tn, key_values):
-    global input_config
-    try:
-        output_table_df = input_config[input_config.output_tn == output_tn]
-        output_table_input_files_col = output_table_df[['input_form_name']]
-        output_table_input_files_list = output_table_input_files_col['input_form_name'].tolist()
-        output_table_input_files_list = list(dict.fromkeys(output_table_input_files_list))
-        for form_name in output_table_input_files_list:
-            # gets the names of the key values in the input form
-            converted_key_values_list = convert_key_column_names(key_values, form_name, output_tn)
+        log_error('Error: Could not retrieve the key columns for output table \'' + output_tn + '\'', str(e), True)
+
+# returns the value of a cell of a config file, or None if the cell is empty
+def get_config_value(value):
+    if pd.isna(value):
+        return None
+    return value
+
+# gets the input field of each key column in each input form of the output table
+def plan_key_fields(input_config_specific_tn, key_values):
+    key_fields = {}
+    for form_name, form_rows in input_config_specific_tn.groupby('input_form_name', sort = False):
+        try:
+            form_key_fields = {}
+            for output_key_column in key_values:
+                key_rows = form_rows[form_rows.output_cn == output_key_column]
+                if len(key_rows) > 1:
+                    raise Exception ('Key column \'' + output_key_column + '\' listed more than once for ' + form_name)
+                if key_rows.empty:
+                    raise Exception ('Missing key column \'' + output_key_column + '\' in form \'' + form_name)
+                form_key_fields[output_key_column] = get_config_value(key_rows.iloc[0]['input_field_name'])
+            key_fields[form_name] = form_key_fields
+        except Exception as e:
+            log_error('Error: Problem retrieving the key column names from the input form \'' + form_name + '\'', str(e), True)
+    return key_fields
+
+# plans the date columns of an output table from its 'date_markers'
+def plan_date_markers(input_config_specific_tn):
+    date_markers = {'has_dmy_vars': False, 'date_col_name': 'visdate', 'day_col_name': 'visday', 'month_col_name': 'vismonth', 'year_col_name': 'visyear', 'date_fields': {}, 'dmy_fields': {}, 'only_date_forms': []}
+    try:
+        # the forms with a column for each date marker, and the name of that column in the form
+        marker_fields = {'date': {}, 'day': {}, 'month': {}, 'year': {}}
+        for i, row in input_config_specific_tn.iterrows():
+            marker = get_config_value(row['date_markers'])
+            if marker in marker_fields:
+                # makes sure that date markers have not been assigned to more than one output column
+                marker_col_name = marker + '_col_name'
+                if (len(marker_fields[marker]) != 0) and (date_markers[marker_col_name] != row['output_cn']):
+                    raise Exception ('The date marker \'' + marker + '\' has been assigned to more than one output column')
+                date_markers[marker_col_name] = row['output_cn']
+                marker_fields[marker][row['input_form_name']] = get_config_value(row['input_field_name'])
+        date_markers['date_fields'] = marker_fields['date']
+        forms_with_day_var = sorted(marker_fields['day'])
+        forms_with_month_var = sorted(marker_fields['month'])
+        forms_with_year_var = sorted(marker_fields['year'])
+        # if the forms which contain day, month, and year variables differ, throw an error, as if a form has one of these variables it should have all of the others
+        if ((forms_with_day_var != forms_with_month_var) | (forms_with_day_var != forms_with_year_var)):
+            raise Exception ('Forms with date information in seperate columns must have a column for day, month, and year. One or more of these columns are missing. Forms with columns for days: ' + str(forms_with_day_var) + ' Forms with columns for months: ' + str(forms_with_month_var) + ' Forms with columns for years: ' + str(forms_with_year_var))
+        # if all forms have day, month, and year variables, date columns are created in both directions
+        if len(forms_with_day_var) != 0:
+            date_markers['has_dmy_vars'] = True
+            for form_name in forms_with_day_var:
+                if form_name not in marker_fields['date']:
+                    date_markers['dmy_fields'][form_name] = [marker_fields['day'][form_name], marker_fields['month'][form_name], marker_fields['year'][form_name]]
+            date_markers['only_date_forms'] = [form_name for form_name in marker_fields['date'] if form_name not in marker_fields['day']]
     except Exception as e:
-        log_error('Error: Problem checking all of the input forms for \'' + output_tn + '\' for key values', e.message, True)
+        log_error('Error: Problem parsing through the \'date markers\' column in the input configuration file', str(e), True)
+    return date_markers
+
+# plans how each column of an output table is resolved: its forms, fields, precedences and rule
+def plan_output_columns(input_config_specific_tn, output_config_specific_tn, key_values, date_markers):
+    date_col_name = date_markers['date_col_name']
+    output_columns = []
+    for i, row in output_config_specific_tn.iterrows():
+        # retrieve all the rows from the input config file which correspond to this output column name
+        input_config_matching_rows = input_config_specific_tn[input_config_specific_tn.output_cn == row['output_cn']]
 
-# gets the key column names in the input form
-def convert_key_column_names(output_key_columns, form_name, output_tn):
-    global input_config
+        # if this DataFrame is empty, this means there is no information about this variable in the input form and a critical error should be thrown
+        if(input_config_matching_rows.empty):
+            log_error('Error: No corresponding input column for the output column \'' + row['output_cn'] + '\' in the input config file', '', True)
+
+        # special case for the date column: compare across forms not just listed with a date output column, but also those with day, month, and year output columns, as a date column is generated for these forms
+        if(get_config_value(input_config_matching_rows.iloc[0]['date_markers']) == 'date'):
+            input_config_matching_rows = input_config_specific_tn[input_config_specific_tn.date_markers.isin(['date', 'day'])].copy()
+            is_generated = (input_config_matching_rows.output_cn != date_col_name).to_numpy(dtype = bool)
+            input_config_matching_rows.loc[is_generated, 'input_field_name'] = date_col_name + '_' + input_config_matching_rows.loc[is_generated, 'input_form_name']
+            input_config_matching_rows.loc[is_generated, 'output_cn'] = date_col_name
+
+        sources = []
+        for j, input_config_matching_row in input_config_matching_rows.iterrows():
+            sources.append({'form_name': input_config_matching_row['input_form_name'], 'field_name': get_config_value(input_config_matching_row['input_field_name']), 'precedence': int(input_config_matching_row['form_precedence'])})
+        rule = get_config_value(input_config_matching_rows.iloc[0]['comparison_type'])
+
+        # the output columns of this column: the column of dates is also split into day, month and year
+        column_names = [row['output_cn']]
+        if ((date_markers['has_dmy_vars']) & (row['output_cn'] == date_col_name)):
+            column_names = column_names + [date_markers['day_col_name'], date_markers['month_col_name'], date_markers['year_col_name']]
+
+        output_columns.append({
+            'output_cn': row['output_cn'],
+            'is_key': row['output_cn'] in key_values,
+            # the day, month, and year columns are filled in when the column of dates is resolved
+            'is_dmy_var': row['output_cn'] in [date_markers['day_col_name'], date_markers['month_col_name'], date_markers['year_col_name']],
+            'sources': sources,
+            'rule': '' if rule is None else str(rule),
+            'column_names': column_names,
+            'config_fingerprint': hash_parts([input_config_matching_rows.to_json(orient = 'values')])})
+    return output_columns
+
+# builds the merge plan, validating everything the output tables need up front
+def build_merge_plan(input_config, output_config):
+    merge_plan = {'required_fields': {}, 'table_names': [], 'tables': {}}
+    for form_name, required_fields in get_required_input_fields(input_config).items():
+        merge_plan['required_fields'][form_name] = sorted(required_fields)
+    input_config_groups = dict(list(input_config.groupby('output_tn', sort = False)))
+    for output_tn, output_config_specific_tn in output_config.groupby('output_tn', sort = False):
+        input_config_specific_tn = input_config_groups.get(output_tn, input_config.iloc[0:0])
+        key_values = get_key_columns(output_tn, output_config_specific_tn)
+        if len(key_values) == 0:
+            log_error('Error: No key columns have been assigned for output table \'' + output_tn + '\'', '', True)
+        date_markers = plan_date_markers(input_config_specific_tn)
+        merge_plan['table_names'].append(output_tn)
+        merge_plan['tables'][output_tn] = {
+            'output_tn': output_tn,
+            'key_values': key_values,
+            # fingerprint of the output table: its key columns and its rows in the output config
+            'fingerprint': hash_parts(key_values + [output_config_specific_tn.to_json(orient = 'values')]),
+            'key_fields': plan_key_fields(input_config_specific_tn, key_values),
+            # only the forms which contribute a column besides the key columns add rows to the output table
+            'row_forms': list(dict.fromkeys(input_config_specific_tn.loc[~input_config_specific_tn.output_cn.isin(key_values), 'input_form_name'].tolist())),
+            'date_markers': date_markers,
+            'display_order': output_config_specific_tn.sort_values(by = ['output_display_order'])['output_cn'].tolist(),
+            'columns': plan_output_columns(input_config_specific_tn, output_config_specific_tn, key_values, date_markers)}
+    return merge_plan
+
+# gets the path of the cached merge plan, keyed by the contents of the config files and of this program
+def get_plan_cache_path(input_config_file, output_config_file):
+    global cache_dir
+    parts = []
+    for plan_source in [input_config_file, output_config_file, os.path.abspath(__file__)]:
+        with open(plan_source, 'rb') as plan_source_file:
+            parts.append(plan_source_file.read())
+    return os.path.join(cache_dir, 'plan_' + hash_parts(parts) + '.json')
+
+# writes a merge plan as JSON
+def write_merge_plan(plan_file, merge_plan):
+    plan_dir = os.path.dirname(plan_file)
+    if (plan_dir != '') and not os.path.isdir(plan_dir):
+        os.makedirs(plan_dir)
+    write_file_atomically(plan_file, lambda temp_path: write_json_file(temp_path, merge_plan))
+
+# loads the merge plan from the cache, or builds it from the config files
+def load_merge_plan(input_config_file, output_config_file):
+    global use_plan_cache
+    global rebuild_cache
+    plan_path = None
+    if use_plan_cache:
+        try:
+            plan_path = get_plan_cache_path(input_config_file, output_config_file)
+            if (not rebuild_cache) and os.path.exists(plan_path):
+                with open(plan_path) as plan_file:
+                    cached_plan = json.load(plan_file)
+                # touching the plan marks it as recently used
+                os.utime(plan_path, None)
+                return cached_plan
+        except Exception as e:
+            log_error('Error: Could not read the cached merge plan, it will be built from the config files', str(e), False)
+    input_config = load_config_file(input_config_file)
+    input_config = sort_input_config_file(input_config)
+    output_config = load_config_file(output_config_file)
+    output_config = sort_output_config_file(output_config)
+    merge_plan = build_merge_plan(input_config, output_config)
+    if plan_path is not None:
+        try:
+            write_merge_plan(plan_path, merge_plan)
+            with cache_lock:
+                evict_cache_entries()
+        except Exception as e:
+            log_error('Error: Could not write the merge plan to the cache', str(e), False)
+    return merge_plan
+
+# renames the key columns of each input form of the output table to the names of the output key columns
+def rename_key_columns(table_plan):
     global input_files_dict
-    converted_key_columns_list = []
-    try:
-        # creates a DataFrame from the input config by getting only the rows that correspond to a certain form and which contain a key value
-        input_config_trimmed = input_config[(input_config.output_tn == output_tn) & (input_config.input_form_name == form_name)]
-        for i, row in input_config_trimmed.iterrows():
-            if row['output_cn'] not in output_key_columns:
-                input_config_trimmed = input_config_trimmed.drop([i])
-        # cycles through this DataFrame to make sure all of key columns are present
-        for output_key_column in output_key_columns:
-            found_key_column = False
-            for i, row in input_config_trimmed.iterrows():
-                if row['output_cn'] == output_key_column:
-                    if found_key_column:
-                        raise Exception ('Key column \'' + output_key_column + '\' listed more than once for ' + form_name)
-                    found_key_column = True
-                    input_files_dict[form_name] = input_files_dict[form_name].rename(columns = {row['input_field_name']:row['output_cn']})
-                    converted_key_columns_list.append(row['output_cn'])
-            # if a date, month, or year is missing, adding the missing_ keyword to the key columns list. These will be handled in the handle_missing_key_values method
-            if found_key_column == False:
-                raise Exception ('Missing key column \'' + output_key_column + '\' in form \'' + form_name)
-    except Exception as e:
-         log_error('Error: Problem retrieving the key column names from the input form \'' + form_name + '\'', e.message, True)
-    return converted_key_columns_list
+    for form_name, form_key_fields in table_plan['key_fields'].items():
+        try:
+            input_files_dict[form_name] = input_files_dict[form_name].rename(columns = {field_name: output_key_column for output_key_column, field_name in form_key_fields.items()})
+        except Exception as e:
+            log_error('Error: Problem retrieving the key column names from the input form \'' + form_name + '\'', str(e), True)
 
-# create date columns for forms which contain day, month, and year columns, using information in the 'date_markers' column in the input config
-def process_date_markers(input_config_specific_tn):
+# create date columns for the forms with day, month, and year columns, and the reverse
+def process_date_markers(date_markers):
     try:
         global has_dmy_vars
         global date_col_name
@@ -153,439 +647,2540 @@ def process_date_markers(input_config_specific_tn):
         global month_col_name
         global year_col_name
         global input_files_dict
-        has_dmy_vars = False
-        # lists which store the names of the forms which contain date, day, month, and year variable columns
-        forms_with_date_var = []
-        forms_with_day_var = []
-        forms_with_month_var = []
-        forms_with_year_var = []
-        # dictionaries which match a form to the form variable name for either the date, day, month, or year
-        form_name_to_date_var_dict = {}
-        form_name_to_day_var_dict = {}
-        form_name_to_month_var_dict = {}
-        form_name_to_year_var_dict = {}
-        # makes sure that date markers have not been assigned to more than one output column
-        old_date_name = ''
-        old_day_name = ''
-        old_month_name = ''
-        old_year_name = ''
-        # cycle through and see which forms already contain a date column, and which ones contain seperate day, month, and year values
-        for i, row in input_config_specific_tn.iterrows():
-            if row['date_markers'] == 'date':
-                if((old_date_name != '') & (old_date_name != row['output_cn'])):
-                    raise Exception ('The date marker \'date\' has been assigned to more than one output column')
-                date_col_name = row['output_cn']
-                old_date_name = row['output_cn']
-                forms_with_date_var.append(row['input_form_name'])
-                form_name_to_date_var_dict.update({row['input_form_name'] : row['input_field_name']})
-            elif row['date_markers'] == 'day':
-                if((old_day_name != '') & (old_day_name != row['output_cn'])):
-                    raise Exception ('The date marker \'day\' has been assigned to more than one output column')
-                day_col_name = row['output_cn']
-                old_day_name = row['output_cn']
-                forms_with_day_var.append(row['input_form_name'])
-                form_name_to_day_var_dict.update({row['input_form_name'] : row['input_field_name']})
-            elif row['date_markers'] == 'month':
-                if((old_month_name != '') & (old_month_name != row['output_cn'])):
-                    raise Exception ('The date marker \'month\' has been assigned to more than one output column')
-                month_col_name = row['output_cn']
-                old_month_name = row['output_cn']
-                forms_with_month_var.append(row['input_form_name'])
-                form_name_to_month_var_dict.update({row['input_form_name'] : row['input_field_name']})
-            elif row['date_markers'] == 'year':
-                if((old_year_name != '') & (old_year_name != row['output_cn'])):
-                    raise Exception ('The date marker \'year\' has been assigned to more than one output column')
-                year_col_name = row['output_cn']
-                old_year_name = row['output_cn']
-                forms_with_year_var.append(row['input_form_name'])
-                form_name_to_year_var_dict.update({row['input_form_name'] : row['input_field_name']})
-        forms_with_date_var.sort()
-        forms_with_day_var.sort()
-        forms_with_month_var.sort()
-        forms_with_year_var.sort()
-        # if no forms have individual day, month, and year variables, set the global boolean to False
-        if ((len(forms_with_day_var) == 0) & (len(forms_with_month_var) == 0) & (len(forms_with_year_var) == 0)):
-            has_dmy_vars = False
-        # if the forms which contain day, month, and year variables differ, throw an error, as if a form has one of these variables it should have all of the others
-        elif ((forms_with_day_var != forms_with_month_var) | (forms_with_day_var != forms_with_year_var)):
-            raise Exception ('Forms with date information in seperate columns must have a column for day, month, and year. One or more of these columns are missing. Forms with columns for days: ' + str(forms_with_day_var) + ' Forms with columns for months: ' + str(forms_with_month_var) + ' Forms with columns for years: ' + str(forms_with_year_var))
-        # if all forms contain one of each day, month, and year variable, create a date variable for them if they don't already have one
-        else:
-            has_dmy_vars = True
-            # get all the forms which have day, month, and year variables but no date variable
-            forms_with_only_dmy_var = list(set(forms_with_day_var).difference(set(forms_with_date_var)))
-            # get all the forms which have date variables but no day, month, and year variables
-            forms_with_only_date_var = list(set(forms_with_date_var).difference(set(forms_with_day_var)))
-            # cycle through all of the forms with just day, month, and year variables and create date variable columns for them
-            for form_name in forms_with_only_dmy_var:
-                input_files_dict[form_name] = convert_dmy_to_date(form_name, input_files_dict[form_name].copy(), form_name_to_day_var_dict[form_name], form_name_to_month_var_dict[form_name], form_name_to_year_var_dict[form_name])
-            # cycle through all of the forms with just a date variable and create day, month, and year variable columns for them
-            for form_name in forms_with_only_date_var:
-                input_files_dict[form_name] = convert_date_to_day(form_name, input_files_dict[form_name].copy(), form_name_to_date_var_dict[form_name])
-                input_files_dict[form_name] = convert_date_to_month(form_name, input_files_dict[form_name].copy(), form_name_to_date_var_dict[form_name])
-                input_files_dict[form_name] = convert_date_to_year(form_name, input_files_dict[form_name].copy(), form_name_to_date_var_dict[form_name])
+        global parsed_dates_dict
+        has_dmy_vars = date_markers['has_dmy_vars']
+        date_col_name = date_markers['date_col_name']
+        day_col_name = date_markers['day_col_name']
+        month_col_name = date_markers['month_col_name']
+        year_col_name = date_markers['year_col_name']
+        # cycle through the forms with just day, month, and year variables and create date columns for them
+        for form_name, (day_var_name, month_var_name, year_var_name) in date_markers['dmy_fields'].items():
+            input_files_dict[form_name] = input_files_dict[form_name].copy(deep = False)
+            convert_dmy_to_date(form_name, input_files_dict[form_name], day_var_name, month_var_name, year_var_name)
+        # cycle through all of the forms with just a date variable and create day, month, and year variable columns for them
+        for form_name in date_markers['only_date_forms']:
+            input_files_dict[form_name] = input_files_dict[form_name].copy(deep = False)
+            convert_date_to_dmy(form_name, input_files_dict[form_name], date_markers['date_fields'][form_name])
+        # the dates of the other forms are parsed as well, so the date rules never parse strings
+        for form_name, date_var_name in date_markers['date_fields'].items():
+            if (form_name, date_var_name) not in parsed_dates_dict:
+                parse_date_column(form_name, input_files_dict[form_name], date_var_name)
     except Exception as e:
-        log_error('Error: Problem parsing through the \'date markers\' column in the input configuration file', e.message, True)
+        log_error('Error: Problem creating the date columns of the input forms from the \'date markers\' column in the input configuration file', str(e), True)
 
-# converts a date column into a column of days
-def convert_date_to_day(form_name, form_df, date_var_name):
-    try:
-        global day_col_name
-        list_of_days = []
-        for i, row in form_df.iterrows():
-            list_of_days.append(row[date_var_name].split('/')[1])
-        kwargs = {day_col_name + '_' + form_name : list_of_days}
-        new_form_df = form_df.assign(**kwargs)
-        return new_form_df
-    except Exception as e:
-        log_error('Error: Problem converting a column of dates into a day variable', e.message, False)
+# splits a column of M/D/Y dates into columns of months, days, and years in one pass
+def split_date_column(date_col):
+    date_parts = date_col.str.split('/', expand = True).reindex(columns = [0, 1, 2])
+    return date_parts[0], date_parts[1], date_parts[2]
+
+# parses columns of months, days, and years into an array of dates; invalid dates are NaT
+def parse_date_parts(month_col, day_col, year_col):
+    months, days, years = [pd.to_numeric(part_col, errors = 'coerce').to_numpy(dtype = float, na_value = np.nan) for part_col in (month_col, day_col, year_col)]
+    is_valid = np.isfinite(months) & np.isfinite(days) & np.isfinite(years)
+    is_valid &= (months == np.floor(months)) & (days == np.floor(days)) & (years == np.floor(years))
+    is_valid &= (months >= 1) & (months <= 12) & (days >= 1) & (days <= 31) & (years >= 1) & (years <= 9999)
+    parsed_dates = np.full(len(months), np.datetime64('NaT'), dtype = 'datetime64[D]')
+    month_starts = (years[is_valid].astype(np.int64) - 1970).astype('datetime64[Y]').astype('datetime64[M]') + (months[is_valid].astype(np.int64) - 1)
+    valid_dates = month_starts.astype('datetime64[D]') + (days[is_valid].astype(np.int64) - 1)
+    # days past the end of the month (e.g. 2/30) roll over into the next month, so they aren't valid
+    valid_dates[valid_dates.astype('datetime64[M]') != month_starts] = np.datetime64('NaT')
+    parsed_dates[is_valid] = valid_dates
+    return parsed_dates
 
-# converts a date column into a column of months
-def convert_date_to_month(form_name, form_df, date_var_name):
+# converts a date column into day, month and year columns, and keeps the parsed dates
+def convert_date_to_dmy(form_name, form_df, date_var_name):
     try:
+        global day_col_name
         global month_col_name
-        list_of_months = []
-        for i, row in form_df.iterrows():
-            list_of_months.append(row[date_var_name].split('/')[0])
-        kwargs = {month_col_name + '_' + form_name : list_of_months}
-        new_form_df = form_df.assign(**kwargs)
-        return new_form_df
+        global year_col_name
+        global parsed_dates_dict
+        month_col, day_col, year_col = split_date_column(form_df[date_var_name])
+        form_df[day_col_name + '_' + form_name] = day_col
+        form_df[month_col_name + '_' + form_name] = month_col
+        form_df[year_col_name + '_' + form_name] = year_col
+        parsed_dates_dict[(form_name, date_var_name)] = parse_date_parts(month_col, day_col, year_col)
     except Exception as e:
-        log_error('Error: Problem converting a column of dates into a month variable', e.message, False)
+        log_error('Error: Problem converting a column of dates into day, month, and year variables', str(e), False)
 
-# converts a date column into a column of years
-def convert_date_to_year(form_name, form_df, date_var_name):
+# keeps the parsed dates of a date column for the comparison rules
+def parse_date_column(form_name, form_df, date_var_name):
     try:
-        global year_col_name
-        list_of_years = []
-        for i, row in form_df.iterrows():
-            list_of_years.append(row[date_var_name].split('/')[2])
-        kwargs = {year_col_name + '_' + form_name : list_of_years}
-        new_form_df = form_df.assign(**kwargs)
-        return new_form_df
+        global parsed_dates_dict
+        month_col, day_col, year_col = split_date_column(form_df[date_var_name])
+        parsed_dates_dict[(form_name, date_var_name)] = parse_date_parts(month_col, day_col, year_col)
     except Exception as e:
-        log_error('Error: Problem converting a column of dates into a year variable', e.message, False)
+        log_error('Error: Problem parsing the column of dates \'' + date_var_name + '\' in the form \'' + form_name + '\'', str(e), False)
 
-# converts day, month, and year columns into a single date column
+# converts day, month and year columns into a date column, and keeps the parsed dates
 def convert_dmy_to_date(form_name, form_df, day_var_name, month_var_name, year_var_name):
     try:
         global date_col_name
-        list_of_dates = []
-        for i, row in form_df.iterrows():
-            list_of_dates.append(str(row[month_var_name]) + '/' + str(row[day_var_name]) + '/' + str(row[year_var_name]))
-        kwargs = {date_col_name + '_' + form_name : list_of_dates}
-        new_form_df = form_df.assign(**kwargs)
-        return new_form_df
+        global parsed_dates_dict
+        date_col = form_df[month_var_name].str.cat([form_df[day_var_name], form_df[year_var_name]], sep = '/')
+        form_df[date_col_name + '_' + form_name] = date_col
+        parsed_dates_dict[(form_name, date_col_name + '_' + form_name)] = parse_date_parts(form_df[month_var_name], form_df[day_var_name], form_df[year_var_name])
     except Exception as e:
-        log_error('Error: Problem converting the day, month, and year columns into a date column', e.message, False)
+        log_error('Error: Problem converting the day, month, and year columns into a date column', str(e), False)
+
+# counts the duplicate key tuples of each form of an output table
+def count_duplicate_keys(table_plan):
+    global input_files_dict
+    key_values = table_plan['key_values']
+    form_key_indexes = {}
+    duplicate_counts = {}
+    for form_name in table_plan['row_forms']:
+        form_key_indexes[form_name] = pd.MultiIndex.from_frame(input_files_dict[form_name][key_values])
+        duplicate_counts[form_name] = int(form_key_indexes[form_name].duplicated(keep = 'first').sum())
+    predicted_join_rows = None
+    if sum(duplicate_counts.values()) != 0:
+        key_counts = pd.concat([form_key_index.value_counts(dropna = False) for form_key_index in form_key_indexes.values()], axis = 1)
+        predicted_join_rows = int(key_counts.fillna(1).prod(axis = 1).sum())
+    return form_key_indexes, duplicate_counts, predicted_join_rows
+
+# combines the rows of each duplicate key of a form into its first row
+def combine_duplicate_rows(form_name, key_values, is_any_duplicate):
+    global input_files_dict
+    form_df = input_files_dict[form_name].copy()
+    form_rows = np.flatnonzero(is_any_duplicate)
+    fields = [field_name for field_name in form_df.columns if field_name not in key_values]
+    duplicate_values = form_df[fields].iloc[form_rows].astype(object)
+    duplicate_values = duplicate_values.mask(duplicate_values.isna() | duplicate_values.isin(null_values))
+    duplicate_groups = pd.concat([form_df[key_values].iloc[form_rows], duplicate_values], axis = 1).assign(form_row = form_rows).groupby(key_values, sort = False, dropna = False)
+    first_rows = duplicate_groups['form_row'].first().to_numpy()
+    combined_values = duplicate_groups[fields].first()
+    combined_values.index = first_rows
+    # a column whose values are all missing keeps the value of the first row
+    first_values = form_df[fields].iloc[first_rows]
+    first_values.index = first_rows
+    combined_values = combined_values.where(combined_values.notna(), first_values)
+    for field_name in fields:
+        form_df.iloc[first_rows, form_df.columns.get_loc(field_name)] = combined_values[field_name].to_numpy()
+    input_files_dict[form_name] = form_df
 
-# creates a DataFrame for a source form containing all of the key values and a unique column to be compared. Returns a list of these DataFrames.
-def create_dataframes_for_each_form(unique_form_rows, key_values, table_name):
+# finds the columns whose values differ between the rows of each duplicate key of a form
+def get_duplicate_key_values(form_name, key_values, is_any_duplicate):
     global input_files_dict
-    form_dataframes = {}
-    try:
-        # cycles through each row in the passed in DataFrame. Each row is a unique input form for which a new DataFrame needs to be created.
-        for i, unique_form_row in unique_form_rows.iterrows():
-            form_df = None
-            key_values_copy = key_values[:]
-            key_values_copy.append(unique_form_row['input_field_name'])
-            form_df = input_files_dict[unique_form_row['input_form_name']][key_values_copy]
-            if(form_df is not None):
-                form_dataframes.update({unique_form_row['input_form_name']:form_df})
+    form_df = input_files_dict[form_name]
+    form_rows = np.flatnonzero(is_any_duplicate)
+    fields = [field_name for field_name in form_df.columns if field_name not in key_values]
+    duplicate_values = form_df[fields].iloc[form_rows].astype(object)
+    is_missing = duplicate_values.isna() | duplicate_values.isin(null_values)
+    duplicate_values = duplicate_values.astype(str).mask(is_missing)
+    duplicate_groups = pd.concat([form_df[key_values].iloc[form_rows], duplicate_values], axis = 1).assign(form_row = form_rows).groupby(key_values, sort = False, dropna = False)
+    first_rows = duplicate_groups['form_row'].first().to_numpy()
+    differing_values = pd.DataFrame(index = first_rows)
+    for field_name in fields:
+        joined_values = duplicate_groups[field_name].agg(lambda field_values: ' | '.join(pd.unique(field_values.dropna()))).to_numpy(dtype = object)
+        differs = duplicate_groups[field_name].nunique().to_numpy() > 1
+        differing_values[field_name] = np.where(differs, joined_values, None)
+    return differing_values
+
+# indexes the key tuples of each form by row position, applying the duplicate key policy
+def build_form_key_indexes(table_plan):
+    global input_files_dict
+    global duplicate_key_policy
+    global duplicate_key_values
+    global duplicate_first_rows
+    global table_duplicate_keys
+    output_tn = table_plan['output_tn']
+    key_values = table_plan['key_values']
+    form_key_indexers = {}
+    duplicate_key_values = {}
+    duplicate_first_rows = {}
+    table_duplicate_keys = {}
+    try:
+        # only the forms which contribute a column besides the key columns add rows to the output table
+        all_form_key_indexes, duplicate_counts, predicted_join_rows = count_duplicate_keys(table_plan)
+        if predicted_join_rows is not None:
+            distinct_key_count = len(pd.concat([form_key_index.to_frame(index = False) for form_key_index in all_form_key_indexes.values()], ignore_index = True).drop_duplicates())
+            table_duplicate_keys = {'duplicate_rows': dict((form_name, duplicate_count) for form_name, duplicate_count in duplicate_counts.items() if duplicate_count != 0), 'distinct_keys': distinct_key_count, 'predicted_join_rows': predicted_join_rows}
+            print('...duplicate keys: an outer join of the forms on the key columns would have ' + str(predicted_join_rows) + ' rows for ' + str(distinct_key_count) + ' distinct key tuples')
+            if duplicate_key_policy == 'fail':
+                log_error('Error: Duplicate key values in the forms of output table \'' + output_tn + '\': ' + ', '.join(form_name + ' (' + str(duplicate_count) + ')' for form_name, duplicate_count in table_duplicate_keys['duplicate_rows'].items()) + '. An outer join of the forms on the key columns would have ' + str(predicted_join_rows) + ' rows for ' + str(distinct_key_count) + ' distinct key tuples', '', True)
+        form_key_indexes = {}
+        for form_name, form_key_index in all_form_key_indexes.items():
+            is_duplicate = form_key_index.duplicated(keep = 'first')
+            if is_duplicate.any():
+                duplicate_keys = ', '.join(str(key) for key in form_key_index[is_duplicate][:5])
+                # the rows which stand for their duplicate key when it is combined or reported
+                if duplicate_key_policy in ['precedence', 'report']:
+                    duplicate_first_rows[form_name] = np.flatnonzero(form_key_index.duplicated(keep = False) & ~is_duplicate)
+                if duplicate_key_policy == 'precedence':
+                    combine_duplicate_rows(form_name, key_values, form_key_index.duplicated(keep = False))
+                    log_error('Error: ' + str(int(is_duplicate.sum())) + ' duplicate key value(s) in form \'' + form_name + '\' for output table \'' + output_tn + '\', the rows of each key are combined, each column taking its first value which isn\'t missing. Duplicates include: ' + duplicate_keys, '', False)
+                elif duplicate_key_policy == 'report':
+                    duplicate_key_values[form_name] = get_duplicate_key_values(form_name, key_values, form_key_index.duplicated(keep = False))
+                    log_error('Error: ' + str(int(is_duplicate.sum())) + ' duplicate key value(s) in form \'' + form_name + '\' for output table \'' + output_tn + '\', only the first row for each key is used, and the keys whose rows differ are listed in discrepancies.csv. Duplicates include: ' + duplicate_keys, '', False)
+                else:
+                    log_error('Error: ' + str(int(is_duplicate.sum())) + ' duplicate key value(s) in form \'' + form_name + '\' for output table \'' + output_tn + '\', only the first row for each key is used. Duplicates include: ' + duplicate_keys, '', False)
+            form_key_indexes[form_name] = (form_key_index[~is_duplicate], np.flatnonzero(~is_duplicate))
+        # the union of the key tuples, sorted the way an outer merge on the key values would sort them
+        table_keys_df = pd.concat([pd.DataFrame(columns = key_values)] + [form_key_index.to_frame(index = False) for form_key_index, row_positions in form_key_indexes.values()], ignore_index = True)
+        table_keys_df = table_keys_df.drop_duplicates().sort_values(by = key_values).reset_index(drop = True)
+        table_key_index = pd.MultiIndex.from_frame(table_keys_df)
+        # the row position of every output row in each form (-1 if the form doesn't contain the key tuple)
+        for form_name, (form_key_index, row_positions) in form_key_indexes.items():
+            indexer = form_key_index.get_indexer(table_key_index)
+            form_key_indexers[form_name] = np.full(len(indexer), -1, dtype = np.int64)
+            form_key_indexers[form_name][indexer >= 0] = row_positions[indexer[indexer >= 0]]
+        return table_keys_df, form_key_indexers
     except Exception as e:
-        log_error('Error: One of the variables: ' +  ', '.join(str(x) for x in converted_key_values_list) + ' is not contained in the form \'' + unique_form_row['input_form_name'] + '\'. Column \'' + unique_form_row['output_cn'] + '\' can not be compared across forms', e.message, False)
-        # if everything went smoothly, a DataFrame will have been created which contains all of the key values and unique column for a specific form. Add this to the list.
-    return form_dataframes
+        log_error('Error: Could not build the key index of the input forms for output table \'' + output_tn + '\'', str(e), True)
+
+# gathers the column to be compared from each source form, for the output rows or gather_rows
+def gather_form_columns(column_plan, gather_rows = None):
+    global input_files_dict
+    global form_key_indexers
+    global duplicate_key_values
+    global gathered_duplicate_values
+    form_columns = {}
+    gathered_duplicate_values = {}
+    # cycles through each source of the column, an input form from which the column is gathered
+    for source in column_plan['sources']:
+        try:
+            form_name = source['form_name']
+            indexer = form_key_indexers[form_name] if gather_rows is None else form_key_indexers[form_name][gather_rows]
+            form_column = input_files_dict[form_name][source['field_name']]
+            # the codes of a dictionary-encoded column are gathered as they are; code -1 is missing
+            if form_column.dtype == 'category':
+                form_codes = form_column.cat.codes.to_numpy()
+                gathered_codes = np.full(len(indexer), -1, dtype = form_codes.dtype)
+                gathered_codes[indexer >= 0] = form_codes[indexer[indexer >= 0]]
+                gathered_values = pd.Categorical.from_codes(gathered_codes, dtype = form_column.dtype)
+            else:
+                form_values = form_column.to_numpy(dtype = object)
+                gathered_values = np.full(len(indexer), np.nan, dtype = object)
+                gathered_values[indexer >= 0] = form_values[indexer[indexer >= 0]]
+            form_columns.update({form_name:gathered_values})
+            if (form_name in duplicate_key_values) and (source['field_name'] in duplicate_key_values[form_name].columns):
+                differing_values = duplicate_key_values[form_name][source['field_name']].dropna()
+                differing_positions = differing_values.index.get_indexer(indexer)
+                gathered_rows = np.flatnonzero(differing_positions >= 0)
+                if len(gathered_rows) != 0:
+                    # the differing values are kept with the rows of the output table they are in
+                    table_rows = gathered_rows if gather_rows is None else gather_rows[gathered_rows]
+                    gathered_duplicate_values[form_name] = (table_rows, differing_values.to_numpy(dtype = object)[differing_positions[gathered_rows]])
+        except Exception as e:
+            log_error('Error: The variable \'' + str(source['field_name']) + '\' is not contained in the form \'' + source['form_name'] + '\'. Column \'' + column_plan['output_cn'] + '\' can not be compared across forms', str(e), False)
+    return form_columns
+
+# gathers the parsed dates of the column from each source form with a column of dates
+def gather_parsed_dates(column_plan, gather_rows = None):
+    global parsed_dates_dict
+    global form_key_indexers
+    parsed_date_columns = {}
+    for source in column_plan['sources']:
+        form_name = source['form_name']
+        parsed_dates = parsed_dates_dict.get((form_name, source['field_name']))
+        if (parsed_dates is not None) and (form_name in form_key_indexers):
+            indexer = form_key_indexers[form_name] if gather_rows is None else form_key_indexers[form_name][gather_rows]
+            gathered_dates = np.full(len(indexer), np.datetime64('NaT'), dtype = 'datetime64[D]')
+            gathered_dates[indexer >= 0] = parsed_dates[indexer[indexer >= 0]]
+            parsed_date_columns.update({form_name:gathered_dates})
+    return parsed_date_columns
 
 # creates a dictionary which matches each form to a precedence value
-def get_form_precedence_dict(unique_form_rows):
+def get_form_precedence_dict(column_plan):
     form_precedence_dict = {}
-    try:
-        for i, unique_form_row in unique_form_rows.iterrows():
-            form_precedence_dict.update({unique_form_row['input_form_name']:unique_form_row['form_precedence']})
-    except Exception as e:
-        log_error('Error: Could not find a form precedence value for all forms', e.message, False)
+    for source in column_plan['sources']:
+        form_precedence_dict.update({source['form_name']:source['precedence']})
     return form_precedence_dict
 
-# creates a dictionary which matches each var to a form name
-def get_var_to_form_dict(unique_form_rows):
-    var_to_form_dict = {}
+# stacks the gathered column of each form into a 2-D array and masks out the null values
+def stack_form_values(form_columns, form_names, rows):
+    if all(isinstance(form_columns[form_name], pd.Categorical) for form_name in form_names):
+        form_categories = [form_columns[form_name].categories for form_name in form_names]
+        shared_categories = form_categories[0].append(form_categories[1:]).unique()
+        # missing values are given the code of the last entry of the dictionary, 'nan'
+        dictionary = np.append(shared_categories.to_numpy(dtype = object), 'nan')
+        values = np.empty((len(rows), len(form_names)), dtype = np.int32)
+        for k, form_name in enumerate(form_names):
+            shared_codes = np.append(shared_categories.get_indexer(form_categories[k]), len(dictionary) - 1).astype(np.int32)
+            values[:, k] = shared_codes[form_columns[form_name].codes[rows]]
+        null_mask = np.isin(dictionary, null_values)[values]
+        return values, null_mask, dictionary
+    raw_values = np.column_stack([np.asarray(form_columns[form_name], dtype = object)[rows] for form_name in form_names])
+    values = raw_values.astype(str)
+    null_mask = pd.isnull(raw_values)
+    values[null_mask] = 'nan'
+    null_mask |= np.isin(values, null_values)
+    return values, null_mask, None
+
+# picks each row's winner by form precedence and flags the rows where the top forms disagree
+def resolve_form_values(values, null_mask, precedences, compiled_rule, parsed_dates = None, dictionary = None):
+    row_positions = np.arange(values.shape[0])
+    # null values can never win, so they are given a precedence lower than any form
+    precedence_matrix = np.where(null_mask, np.iinfo(np.int64).max, precedences[np.newaxis, :])
+    highest_precedence = precedence_matrix.min(axis=1)
+    is_highest = (precedence_matrix == highest_precedence[:, np.newaxis]) & ~null_mask
+    has_value = is_highest.any(axis=1)
+    # the first value with the highest precedence wins, the others with the same precedence are compared to it
+    winning_col = is_highest.argmax(axis=1)
+    highest_precedence_vals = values[row_positions, winning_col]
+    if dictionary is None:
+        winning_vals = np.where(has_value, highest_precedence_vals, 'nan').astype(object)
+    else:
+        winning_vals = dictionary[np.where(has_value, highest_precedence_vals, len(dictionary) - 1)]
+    differs = is_highest & (values != highest_precedence_vals[:, np.newaxis])
+    if compiled_rule['predicate'] is None:
+        discrepancy_mask = differs.any(axis=1)
+    else:
+        # all the differing pairs are passed to the rule's predicate at once
+        pair_rows, pair_cols = np.nonzero(differs)
+        pair_dates = None
+        winning_dates = None
+        if parsed_dates is not None:
+            pair_dates = parsed_dates[pair_rows, pair_cols]
+            winning_dates = parsed_dates[pair_rows, winning_col[pair_rows]]
+        pair_vals = values[pair_rows, pair_cols]
+        pair_winning_vals = highest_precedence_vals[pair_rows]
+        if dictionary is not None:
+            pair_vals = dictionary[pair_vals].astype(str)
+            pair_winning_vals = dictionary[pair_winning_vals].astype(str)
+        pair_discrepancies = compiled_rule['predicate'](pair_vals, pair_winning_vals, pair_dates, winning_dates)
+        discrepancy_mask = np.zeros(values.shape[0], dtype=bool)
+        discrepancy_mask[pair_rows[pair_discrepancies]] = True
+    winning_vals[discrepancy_mask] = 'discrep'
+    return winning_vals, discrepancy_mask
+
+# creates an append-only buffer of discrepancies, spilled to disk in batches
+def create_discrepancy_buffer(columns):
+    return {'columns': list(columns), 'parts': [], 'buffered_rows': 0}
+
+# adds new columns to the end of the buffer's columns, e.g. the forms of an output column
+def add_discrepancy_columns(discrepancy_buffer, columns):
+    for column in columns:
+        if column not in discrepancy_buffer['columns']:
+            discrepancy_buffer['columns'].append(column)
+
+# appends a chunk of discrepancies to the buffer, spilling it to disk once a batch is full
+def append_discrepancies(discrepancy_buffer, discrepancies_chunk):
+    global discrepancy_batch_rows
+    if len(discrepancies_chunk) == 0:
+        return
+    discrepancy_buffer['parts'].append(discrepancies_chunk)
+    discrepancy_buffer['buffered_rows'] += len(discrepancies_chunk)
+    if discrepancy_buffer['buffered_rows'] >= discrepancy_batch_rows:
+        flush_discrepancy_buffer(discrepancy_buffer)
+
+# spills the chunks kept in memory to disk, keeping the order of the discrepancies
+def flush_discrepancy_buffer(discrepancy_buffer):
+    global discrepancy_spill_dir
+    global discrepancy_spill_count
+    flushed_parts = []
+    chunks = []
+    for part in discrepancy_buffer['parts'] + [None]:
+        if isinstance(part, pd.DataFrame):
+            chunks.append(part)
+            continue
+        if len(chunks) != 0:
+            discrepancy_spill_count += 1
+            spill_path = os.path.join(discrepancy_spill_dir, 'discrepancies_' + str(os.getpid()) + '_' + str(discrepancy_spill_count) + '.pkl')
+            pd.concat(chunks, ignore_index = True).to_pickle(spill_path)
+            flushed_parts.append(spill_path)
+            chunks = []
+        if part is not None:
+            flushed_parts.append(part)
+    discrepancy_buffer['parts'] = flushed_parts
+    discrepancy_buffer['buffered_rows'] = 0
+
+# appends all the discrepancies of another buffer, e.g. the one of an output table, to the buffer
+def extend_discrepancy_buffer(discrepancy_buffer, other_buffer):
+    add_discrepancy_columns(discrepancy_buffer, other_buffer['columns'])
+    for part in other_buffer['parts']:
+        if isinstance(part, pd.DataFrame):
+            append_discrepancies(discrepancy_buffer, part)
+        else:
+            discrepancy_buffer['parts'].append(part)
+
+# reads the discrepancies of the buffer one chunk at a time
+def iterate_discrepancy_chunks(discrepancy_buffer):
+    for part in discrepancy_buffer['parts']:
+        if isinstance(part, pd.DataFrame):
+            yield part
+        else:
+            yield pd.read_pickle(part)
+
+# reads all of the discrepancies of the buffer into a single DataFrame
+def read_discrepancy_buffer(discrepancy_buffer):
+    return pd.concat([pd.DataFrame(columns = discrepancy_buffer['columns'])] + list(iterate_discrepancy_chunks(discrepancy_buffer)), ignore_index = True)[discrepancy_buffer['columns']]
+
+# writes the discrepancies of the buffer to a .csv file, and optionally to a .parquet file
+def write_discrepancies(discrepancy_buffer, csv_file, parquet_file):
+    columns = discrepancy_buffer['columns']
+    parquet_writer = None
+    if parquet_file is not None:
+        if feather is None:
+            log_error('Error: pyarrow is needed to write \'' + parquet_file + '\'', '', False)
+        else:
+            parquet_schema = pa.schema([(column, pa.string()) for column in columns])
+            parquet_writer = parquet.ParquetWriter(parquet_file, parquet_schema)
+    with open(csv_file, 'w', newline = '') as discrepancies_file:
+        pd.DataFrame(columns = columns).to_csv(discrepancies_file, index = False)
+        for discrepancies_chunk in iterate_discrepancy_chunks(discrepancy_buffer):
+            discrepancies_chunk = discrepancies_chunk.reindex(columns = columns)
+            discrepancies_chunk.to_csv(discrepancies_file, header = False, index = False)
+            if parquet_writer is not None:
+                parquet_chunk = discrepancies_chunk.astype(object)
+                parquet_chunk = parquet_chunk.where(parquet_chunk.notna(), None)
+                parquet_writer.write_table(pa.Table.from_pandas(parquet_chunk, schema = parquet_schema, preserve_index = False))
+    if parquet_writer is not None:
+        parquet_writer.close()
+
+# opens a file for an output table in each output format. Returns the writers.
+def open_output_writers(output_tn, columns):
+    global output_formats
+    output_writers = []
+    columnar_schema = pa.schema([(str(column), pa.string()) for column in columns]) if feather is not None else None
+    for output_format in output_formats:
+        output_path = output_tn + '.' + output_format
+        if output_format == 'csv':
+            output_writer = open(output_path, 'w', newline = '')
+        elif output_format == 'csv.gz':
+            output_writer = gzip.open(output_path, 'wt', newline = '')
+        elif output_format == 'parquet':
+            output_writer = parquet.ParquetWriter(output_path, columnar_schema)
+        else:
+            output_writer = pa.ipc.new_file(output_path, columnar_schema, options = pa.ipc.IpcWriteOptions(compression = 'lz4'))
+        if output_format in ['csv', 'csv.gz']:
+            pd.DataFrame(columns = columns).to_csv(output_writer, index = False)
+        output_writers.append((output_format, output_writer, columnar_schema))
+    return output_writers
+
+# writes a chunk of rows of an output table to each of its files
+def write_output_chunk(output_writers, table_chunk):
+    columnar_chunk = None
+    for output_format, output_writer, columnar_schema in output_writers:
+        if output_format in ['csv', 'csv.gz']:
+            table_chunk.to_csv(output_writer, header = False, index = False)
+        else:
+            if columnar_chunk is None:
+                columnar_chunk = table_chunk.astype(object)
+                columnar_chunk = pa.Table.from_pandas(columnar_chunk.where(columnar_chunk.notna(), None), schema = columnar_schema, preserve_index = False)
+            output_writer.write_table(columnar_chunk)
+
+# closes the files of an output table
+def close_output_writers(output_writers):
+    for output_format, output_writer, columnar_schema in output_writers:
+        output_writer.close()
+
+# writes an output table to its files on a thread of the output pool. Returns the time taken.
+def write_output_table(output_tn, output_table):
+    start_time = time.time()
+    output_writers = open_output_writers(output_tn, output_table.columns)
     try:
-        for i, unique_form_row in unique_form_rows.iterrows():
-            var_to_form_dict.update({unique_form_row['input_field_name']:unique_form_row['input_form_name']})
-    except Exception as e:
-        log_error('Error: Could not match all input variable names to form names', e.message, False)
-    return var_to_form_dict
+        for chunk_start in range(0, len(output_table), output_chunk_rows):
+            write_output_chunk(output_writers, output_table.iloc[chunk_start:chunk_start + output_chunk_rows])
+    finally:
+        close_output_writers(output_writers)
+    return time.time() - start_time
 
-# compares the last column of each DataFrame in form_dataframes and checks for discrepancies between them
-def find_discrepancies(discrepancies_list, form_dataframes, key_values, output_val, output_tn, form_precedence_dict, var_to_form_dict, rule):
-    merged_df = None
+# compares the gathered column of each form in form_columns and checks for discrepancies between them
+def find_discrepancies(discrepancies_list, form_columns, key_values, output_val, output_tn, form_precedence_dict, compiled_rule, parsed_date_columns, stored_cells = None):
+    global table_keys_df
+    global form_key_indexers
+    global column_report
+    global gathered_duplicate_values
     form_name_list = []
     try:
-        # merges all forms in form_dataframes by their key values
-        for form_name, form in form_dataframes.iteritems():
+        for form_name in form_columns:
             form_name_list.append(form_name)
-            if merged_df is None:
-                merged_df = form
-            else:
-                merged_df = pd.merge(merged_df, form, how = 'outer', on = key_values)
-            if form_name not in discrepancies_list.columns:
-                discrepancies_list.insert(loc = len(discrepancies_list.columns), column=form_name, value=['' for i in range(discrepancies_list.shape[0])])
-        # creates a column for the 'winning val', which is the value that will be chosen after comparing the different input values
-        merged_df['winning_val'] = 'nan'
-        # for loop cycles through each row, compares the input values, and decides a 'winner'; if there is a discrepancy write it to the discrepancy DataFrame
-        for i, merged_row in merged_df.iterrows():
-            discrepancy_found = False
-            var_name_to_val_dict = {}
-            winning_val = 'nan'
-            for j in range(0, len(form_dataframes)):
-                var_name_to_val_dict.update({merged_df.columns[len(merged_df.columns)-(j+2)]:str(merged_row[merged_df.columns[len(merged_df.columns)-(j+2)]])})
-            new_var_name_to_val_dict = var_name_to_val_dict.copy()
-            # gets rid of null values
-            for val_name, val in var_name_to_val_dict.iteritems():
-                if ((val == 'nan') | (val == '') | (val == '-4') | (pd.isnull(val))):
-                    del new_var_name_to_val_dict[val_name]
-            highest_precedence_val = 'nan'
-            # determines the highest precedence value; if another value exists with equal precedence and is different, log the discrepancy
-            if len(new_var_name_to_val_dict) > 1:
-                is_first_val = True
-                highest_precedence = 9
-                for val_name, val in new_var_name_to_val_dict.iteritems():
-                    # set the first val in the dictionary of values as the winner, set the current highest precedence to this form precedence
-                    if is_first_val:
-                        winning_val = val
-                        highest_precedence_val = val
-                        highest_precedence = int(form_precedence_dict[var_to_form_dict[val_name]])
-                        is_first_val = False
-                    # for the rest of the vals in the dictionary, compare their precedence to the first val; if higher, set the highest precedence and winner to the current val
-                    else:
-                        current_val_precedence = int(form_precedence_dict[var_to_form_dict[val_name]])
-                        if(current_val_precedence < highest_precedence):
-                            winning_val = val
-                            highest_precedence_val = val
-                            highest_pecedence = current_val_precedence
-                            discrepancy_found = False
-                        # if the current value has the same precedence as the highest found precedence and the values don't match, a discrepancy has been found (unless a value with a higher discrepancy is found later)
-                        elif((current_val_precedence == highest_precedence) & (val != highest_precedence_val)):
-                            # pass the values to the rule filter to see if a discrepancy still exists based on the rule given
-                            if(has_discrepancy_after_rule(val, highest_precedence_val, rule)):
-                                discrepancy_found = True
-            # if there is only one value, set it as the winner
-            elif len(new_var_name_to_val_dict) == 1:
-                winning_val = list(new_var_name_to_val_dict.values())[0]
-           # if a discrepancy is found, add it to the discrepancy spreadsheet and put 'discrep' in place of a value in the output table
-            if discrepancy_found == True:
-                print('! Discrepancy found, written to discrepancies.csv !')
-                winning_val = 'discrep'
-                discrept_dict = {'output_tn' : output_tn, 'output_cn' : output_val}
-                for key_val in key_values:
-                    discrept_dict.update({key_val : merged_row[key_val]})
-                for k in range(0, len(form_dataframes)):
-                    discrept_dict.update({form_name_list[len(form_name_list)-(k+1)] : str(merged_row[merged_df.columns[len(merged_df.columns)-(k+2)]])})
-                discrepancies_list = discrepancies_list.append(discrept_dict, ignore_index = True)
-            merged_df.at[i, 'winning_val'] = winning_val
-        count2 = 0
+        add_discrepancy_columns(discrepancies_list, form_name_list)
+        # the rows of the output table which are contained in at least one of the forms
+        rows = np.flatnonzero(np.logical_or.reduce([form_key_indexers[form_name] >= 0 for form_name in form_name_list]))
+        # the values are compared starting from the last form
+        compare_order = form_name_list[::-1]
+        # the rows whose values were gathered
+        value_rows = rows if stored_cells is None else stored_cells['gather_rows']
+        gathered_positions = rows if stored_cells is None else np.arange(len(value_rows))
+        values, null_mask, dictionary = stack_form_values(form_columns, compare_order, gathered_positions)
+        precedences = np.array([int(form_precedence_dict[form_name]) for form_name in compare_order], dtype=np.int64)
+        # the parsed dates are used by date rules when every form's column is a column of dates
+        parsed_dates = None
+        if compiled_rule['uses_dates'] and (set(parsed_date_columns) == set(compare_order)):
+            parsed_dates = np.column_stack([parsed_date_columns[form_name][gathered_positions] for form_name in compare_order])
+        if stored_cells is None:
+            winning_vals, discrepancy_mask = resolve_form_values(values, null_mask, precedences, compiled_rule, parsed_dates, dictionary)
+        else:
+            winning_vals, discrepancy_mask = resolve_stored_cells(values, null_mask, precedences, compiled_rule, parsed_dates, dictionary, stored_cells, output_val)
+        # the keys whose duplicate rows differ in a form are discrepancies
+        if len(gathered_duplicate_values) != 0:
+            if dictionary is not None:
+                values = dictionary[values]
+                dictionary = None
+            values = values.astype(object)
+            winning_vals = np.asarray(winning_vals, dtype = object)
+            for k, form_name in enumerate(compare_order):
+                if form_name in gathered_duplicate_values:
+                    table_rows, joined_values = gathered_duplicate_values[form_name]
+                    duplicate_rows = np.searchsorted(rows, table_rows)
+                    values[np.searchsorted(value_rows, table_rows), k] = joined_values
+                    discrepancy_mask[duplicate_rows] = True
+                    winning_vals[duplicate_rows] = 'discrep'
+        column_report['rows'] = len(rows)
+        column_report['discrepancies'] = int(discrepancy_mask.sum())
+        # if discrepancies are found, add them to the discrepancy spreadsheet; 'discrep' replaces the value
+        if discrepancy_mask.any():
+            print('! ' + str(int(discrepancy_mask.sum())) + ' discrepancies found, written to discrepancies.csv !')
+            new_discrepancies = table_keys_df.loc[rows[discrepancy_mask], key_values].reset_index(drop = True)
+            new_discrepancies.insert(loc = 0, column = 'output_tn', value = output_tn)
+            new_discrepancies.insert(loc = 1, column = 'output_cn', value = output_val)
+            discrepancy_values = values[np.searchsorted(value_rows, rows[discrepancy_mask])]
+            if dictionary is not None:
+                discrepancy_values = dictionary[discrepancy_values]
+            for k, form_name in enumerate(compare_order):
+                new_discrepancies[form_name] = discrepancy_values[:, k]
+            append_discrepancies(discrepancies_list, new_discrepancies)
         # add all the winning values to the output table
-        while count2 < len(form_dataframes):
-            del merged_df[merged_df.columns[len(key_values)]]
-            count2 += 1
-        merged_df.rename(columns={'winning_val': output_val}, inplace = True)
-        add_value_to_output_table(output_tn, output_val, merged_df, key_values)
+        new_col_df = pd.DataFrame({output_val: winning_vals}, index = rows)
+        add_value_to_output_table(output_tn, output_val, new_col_df)
     except Exception as e:
-        log_error('Error: Problem with comparing values across input forms for ' + output_val, e.message, False)
+        log_error('Error: Problem with comparing values across input forms for ' + output_val, str(e), False)
     return discrepancies_list
 
-# adds the value to the output table
-def add_value_to_output_table(output_tn, output_val, new_col_df, key_values):
+# resolves the cells of a column like resolve_form_values, reusing the unchanged cells
+def resolve_stored_cells(values, null_mask, precedences, compiled_rule, parsed_dates, dictionary, stored_cells, output_val):
+    global previous_cells
+    global table_cells
+    global table_keys_df
+    global column_report
+    rows = stored_cells['rows']
+    is_reused = stored_cells['is_reused']
+    winning_vals = np.full(len(rows), None, dtype = object)
+    discrepancy_mask = np.zeros(len(rows), dtype = bool)
+    if is_reused.any():
+        previous_column = previous_cells[output_val]
+        winning_vals[is_reused] = previous_column['values'][rows[is_reused]]
+        discrepancy_mask[is_reused] = previous_column['discrepancies'][rows[is_reused]]
+    resolve_rows = np.flatnonzero(~is_reused)
+    if len(resolve_rows) != 0:
+        # the positions of the rows which are resolved again among the gathered rows
+        value_positions = np.searchsorted(stored_cells['gather_rows'], rows[resolve_rows])
+        winning_vals[resolve_rows], discrepancy_mask[resolve_rows] = resolve_form_values(values[value_positions], null_mask[value_positions], precedences, compiled_rule, None if parsed_dates is None else parsed_dates[value_positions], dictionary)
+    column_report['reused_cells'] = int(is_reused.sum())
+    # a column whose cells are all reused is kept as it was loaded
+    previous_column = previous_cells.get(output_val)
+    if (previous_column is not None) and (previous_column['fingerprint'] == stored_cells['fingerprint']) and is_reused.all() and (int(previous_column['has_cell'].sum()) == len(rows)):
+        table_cells[output_val] = previous_column
+        return winning_vals, discrepancy_mask
+    # the cells of this run, aligned to the rows of the output table
+    column_cells = {'fingerprint': stored_cells['fingerprint'], 'has_cell': np.zeros(len(table_keys_df), dtype = bool), 'hashes': np.zeros(len(table_keys_df), dtype = np.uint64), 'values': np.full(len(table_keys_df), None, dtype = object), 'discrepancies': np.zeros(len(table_keys_df), dtype = bool)}
+    column_cells['has_cell'][rows] = True
+    column_cells['hashes'][rows] = stored_cells['hashes']
+    column_cells['values'][rows] = winning_vals
+    column_cells['discrepancies'][rows] = discrepancy_mask
+    table_cells[output_val] = column_cells
+    return winning_vals, discrepancy_mask
+
+# adds the value to the resolved columns of the output table, indexed by output row position
+def add_value_to_output_table(output_tn, output_val, new_col_df):
     try:
-        global output_files_dict
+        global resolved_columns_dict
         global date_col_name
         global day_col_name
         global month_col_name
         global year_col_name
         global has_dmy_vars
-        # special case: if the column is the column of dates, split it up into columns for day, month, and year and merge these as well
+        # special case: if the column is the column of dates, split it into day, month, and year as well
         if ((has_dmy_vars) & (output_val == date_col_name)):
-            day_col = []
-            month_col = []
-            year_col = []
-            for i, row in new_col_df.iterrows():
-                if(row[output_val] == 'discrep'):
-                    day_col.append('discrep')
-                    month_col.append('discrep')
-                    year_col.append('discrep')
+            add_dmy_columns(new_col_df, date_col_name, day_col_name, month_col_name, year_col_name)
+        resolved_columns_dict[output_tn].append(new_col_df)
+    except Exception as e:
+        log_error('Error: Problem with adding the values to the output table', str(e), False)
+
+# splits the column of dates of new_col_df into day, month and year in place
+def add_dmy_columns(new_col_df, date_var_name, day_var_name, month_var_name, year_var_name):
+    month_col, day_col, year_col = split_date_column(new_col_df[date_var_name])
+    is_not_date = new_col_df[date_var_name].isin(['discrep', 'nan'])
+    new_col_df[day_var_name] = day_col.where(~is_not_date, new_col_df[date_var_name])
+    new_col_df[month_var_name] = month_col.where(~is_not_date, new_col_df[date_var_name])
+    new_col_df[year_var_name] = year_col.where(~is_not_date, new_col_df[date_var_name])
+
+# builds an output table in one step from its resolved columns, already aligned to the key tuples
+def assemble_output_table(table_plan, table_keys_df):
+    global resolved_columns_dict
+    output_tn = table_plan['output_tn']
+    try:
+        resolved_columns = resolved_columns_dict.pop(output_tn)
+        output_table = pd.concat([pd.DataFrame(index = pd.Index([], dtype = np.int64))] + resolved_columns, axis = 1).sort_index()
+        output_table = pd.concat([table_keys_df.iloc[output_table.index].reset_index(drop = True), output_table.reset_index(drop = True)], axis = 1)
+        # puts the columns in the display order
+        display_order = table_plan['display_order']
+        for output_cn in display_order:
+            if output_cn not in output_table.columns:
+                log_error('Error: No values could be retrieved for the output column \'' + output_cn + '\' in output table \'' + output_tn + '\'', '', False)
+                output_table[output_cn] = np.nan
+        return output_table[display_order]
+    except Exception as e:
+        log_error('Error: Could not assemble the output table \'' + output_tn + '\'', str(e), True)
+
+# returns a hash of the given strings and byte strings
+def hash_parts(parts):
+    parts_hash = hashlib.sha1()
+    for part in parts:
+        if not isinstance(part, bytes):
+            part = str(part).encode('utf-8')
+        parts_hash.update(part + b'\x00')
+    return parts_hash.hexdigest()
+
+# hashes the given columns of a form, combined like pd.util.hash_pandas_object
+def hash_form_columns(form_name, column_names):
+    global input_files_dict
+    global table_column_hashes
+    combined_hash = np.zeros(len(input_files_dict[form_name]), dtype = np.uint64) + np.uint64(0x345678)
+    multiplier = np.uint64(1000003)
+    for position, column_name in enumerate(column_names):
+        if (form_name, column_name) not in table_column_hashes:
+            table_column_hashes[(form_name, column_name)] = pd.util.hash_pandas_object(input_files_dict[form_name][column_name], index = False).to_numpy()
+        combined_hash = (combined_hash ^ table_column_hashes[(form_name, column_name)]) * multiplier
+        multiplier += np.uint64(82520 + 2 * (len(column_names) - position))
+    return (combined_hash + np.uint64(97531)).tobytes()
+
+# fingerprint of an output column: its config rows, rule, date columns, and each form's key columns
+def get_column_fingerprint(column_plan, key_values):
+    global input_files_dict
+    global has_dmy_vars
+    parts = key_values + [column_plan['config_fingerprint'], column_plan['rule'], has_dmy_vars, date_col_name, day_col_name, month_col_name, year_col_name]
+    # the policy only changes the fingerprint when it isn't the default
+    if duplicate_key_policy != 'first':
+        parts.append(duplicate_key_policy)
+    for source in column_plan['sources']:
+        form_name = source['form_name']
+        field_name = source['field_name']
+        if (form_name in input_files_dict) and (field_name in input_files_dict[form_name].columns):
+            parts.append(hash_form_columns(form_name, key_values + [field_name]))
+        else:
+            parts.append('missing')
+    return hash_parts(parts)
+
+# loads the run manifest of the previous run; returns an empty manifest if there is none
+def load_run_manifest(manifest_file):
+    try:
+        if os.path.exists(manifest_file):
+            with open(manifest_file) as manifest:
+                return json.load(manifest)
+    except Exception as e:
+        log_error('Error: Could not read the run manifest \'' + manifest_file + '\', all output columns will be recomputed', str(e), False)
+    return {'tables': {}}
+
+# writes the run manifest
+def write_run_manifest(manifest_file, manifest):
+    try:
+        write_file_atomically(manifest_file, lambda temp_path: write_json_file(temp_path, manifest, sort_keys = True))
+    except Exception as e:
+        log_error('Error: Could not write the run manifest \'' + manifest_file + '\'', str(e), False)
+
+# loads an output table written by the previous run to reuse its unchanged columns, or returns None
+def load_previous_output_table(output_tn, key_values):
+    global table_keys_df
+    global output_formats
+    try:
+        # the table is read from the file of the first output format; missing values are read as ''
+        output_format = output_formats[0]
+        if output_format in ['csv', 'csv.gz']:
+            previous_table = pd.read_csv(output_tn + '.' + output_format, dtype = str, keep_default_na = False)
+        else:
+            previous_table = pd.read_parquet(output_tn + '.parquet') if output_format == 'parquet' else pd.read_feather(output_tn + '.feather')
+            previous_table = previous_table.astype(object).fillna('')
+        # the row position of each previous row in the output table; '' keys are made missing again
+        previous_key_index = pd.MultiIndex.from_frame(previous_table[key_values].replace('', np.nan))
+        previous_table.index = pd.MultiIndex.from_frame(table_keys_df[key_values]).get_indexer(previous_key_index)
+        return previous_table
+    except Exception as e:
+        log_error('Error: Could not read the previous output table \'' + output_tn + '.' + output_formats[0] + '\', all of its columns will be recomputed', str(e), False)
+        return None
+
+# loads the discrepancies written by the previous run. Returns None if they can't be reused.
+def load_previous_discrepancies():
+    try:
+        return pd.read_csv('discrepancies.csv', dtype = str, keep_default_na = False)
+    except Exception as e:
+        log_error('Error: Could not read the previous discrepancies.csv, all output columns will be recomputed', str(e), False)
+        return None
+
+# reuses the values and discrepancies of an unchanged output column. Returns False if it can't.
+def reuse_previous_column(discrepancies_list, previous_table, previous_discrepancies, form_names, key_values, output_val, output_tn, column_names):
+    global resolved_columns_dict
+    if (previous_table is None) or (previous_discrepancies is None):
+        return False, discrepancies_list
+    if not set(column_names).issubset(previous_table.columns) or not set(form_names).issubset(previous_discrepancies.columns):
+        return False, discrepancies_list
+    # an empty cell means that none of the column's forms contained the key tuple
+    previous_col_df = previous_table.loc[previous_table[output_val] != '', column_names]
+    if (previous_col_df.index < 0).any():
+        return False, discrepancies_list
+    add_discrepancy_columns(discrepancies_list, form_names)
+    previous_column_discrepancies = previous_discrepancies[(previous_discrepancies.output_tn == output_tn) & (previous_discrepancies.output_cn == output_val)]
+    append_discrepancies(discrepancies_list, previous_column_discrepancies[['output_tn', 'output_cn'] + key_values + form_names[::-1]].reset_index(drop = True))
+    resolved_columns_dict[output_tn].append(previous_col_df.sort_index())
+    return True, discrepancies_list
+
+# the fingerprint of an output column's cells, besides the rows of its forms
+def get_cell_fingerprint(column_plan, output_tn, key_values, compare_order):
+    global merge_plan
+    parts = key_values + [output_tn, column_plan['output_cn'], column_plan['rule'], json.dumps(merge_plan['tables'][output_tn]['date_markers'], sort_keys = True), duplicate_key_policy]
+    for form_name in compare_order:
+        parts.extend(form_name + ':' + source['field_name'] + ':' + str(source['precedence']) for source in column_plan['sources'] if source['form_name'] == form_name)
+    return hash_parts(parts)
+
+# hashes each row of a loaded form over its columns by name
+def hash_form_rows(form_df):
+    return pd.util.hash_pandas_object(form_df[sorted(form_df.columns)], index = False).to_numpy()
+
+# gets the hash of each form row in the rows of the output table
+def get_table_row_hashes(form_name):
+    global table_row_hashes
+    global loaded_form_row_hashes
+    global loaded_input_files_dict
+    global form_key_indexers
+    global duplicate_first_rows
+    if form_name not in table_row_hashes:
+        if form_name not in loaded_form_row_hashes:
+            loaded_form_row_hashes[form_name] = hash_form_rows(loaded_input_files_dict[form_name])
+        indexer = form_key_indexers[form_name]
+        row_hashes = np.zeros(len(indexer), dtype = np.uint64)
+        row_hashes[indexer >= 0] = loaded_form_row_hashes[form_name][indexer[indexer >= 0]]
+        is_duplicate_key = np.isin(indexer, duplicate_first_rows[form_name]) if form_name in duplicate_first_rows else np.zeros(len(indexer), dtype = bool)
+        table_row_hashes[form_name] = (row_hashes, is_duplicate_key)
+    return table_row_hashes[form_name]
+
+# finds the cells of an output column the cell store can reuse. Returns None if it can't.
+def find_stored_cells(column_plan, output_tn, key_values):
+    global previous_cells
+    global form_key_indexers
+    global input_files_dict
+    for source in column_plan['sources']:
+        if (source['form_name'] not in form_key_indexers) or (source['field_name'] not in input_files_dict[source['form_name']].columns):
+            return None
+    compare_order = list(dict.fromkeys(source['form_name'] for source in column_plan['sources']))[::-1]
+    if len(compare_order) == 0:
+        return None
+    rows = np.flatnonzero(np.logical_or.reduce([form_key_indexers[form_name] >= 0 for form_name in compare_order]))
+    cell_hashes = np.zeros(len(rows), dtype = np.uint64)
+    is_duplicate_key = np.zeros(len(rows), dtype = bool)
+    for form_name in compare_order:
+        row_hashes, form_duplicate_keys = get_table_row_hashes(form_name)
+        cell_hashes = (cell_hashes * np.uint64(1000003)) ^ row_hashes[rows]
+        is_duplicate_key |= form_duplicate_keys[rows]
+    stored_cells = {'compare_order': compare_order, 'fingerprint': get_cell_fingerprint(column_plan, output_tn, key_values, compare_order), 'rows': rows, 'hashes': cell_hashes, 'is_reused': np.zeros(len(rows), dtype = bool), 'gather_rows': rows}
+    previous_column = previous_cells.get(column_plan['output_cn'])
+    if (previous_column is not None) and (previous_column['fingerprint'] == stored_cells['fingerprint']):
+        stored_cells['is_reused'] = previous_column['has_cell'][rows] & (previous_column['hashes'][rows] == cell_hashes) & ~is_duplicate_key
+        stored_cells['gather_rows'] = rows[~stored_cells['is_reused'] | previous_column['discrepancies'][rows]]
+    return stored_cells
+
+# gets the path of the cell store file of an output table
+def get_cell_store_path(output_tn):
+    global cell_store_dir
+    return os.path.join(cell_store_dir, hashlib.sha1(output_tn.encode('utf-8')).hexdigest()[:16] + '.feather')
+
+# loads the cells of an output table from the cell store. Returns {} if none are stored.
+def load_cell_store(output_tn, key_values):
+    global table_keys_df
+    store_path = get_cell_store_path(output_tn)
+    if not os.path.exists(store_path):
+        return {}
+    try:
+        store_table = feather.read_table(store_path)
+        cell_fingerprints = json.loads(store_table.schema.metadata[b'merger_cells'].decode('utf-8'))
+        store_keys_df = store_table.select(key_values).to_pandas()
+        # the row position of each stored row in the output table
+        if (len(store_keys_df) == len(table_keys_df)) and all(np.array_equal(store_keys_df[key_value].to_numpy(dtype = object), table_keys_df[key_value].astype(object).where(table_keys_df[key_value].notna(), None).to_numpy(dtype = object)) for key_value in key_values):
+            is_current = np.ones(len(store_keys_df), dtype = bool)
+            table_rows = np.arange(len(store_keys_df))
+        else:
+            table_rows = pd.MultiIndex.from_frame(table_keys_df[key_values]).get_indexer(pd.MultiIndex.from_frame(store_keys_df))
+            is_current = table_rows >= 0
+            table_rows = table_rows[is_current]
+        previous_cells = {}
+        for output_val, cell_fingerprint in cell_fingerprints.items():
+            value_column = store_table.column('value:' + output_val)
+            column_cells = {'fingerprint': cell_fingerprint, 'has_cell': np.zeros(len(table_keys_df), dtype = bool), 'hashes': np.zeros(len(table_keys_df), dtype = np.uint64), 'values': np.full(len(table_keys_df), None, dtype = object), 'discrepancies': np.zeros(len(table_keys_df), dtype = bool)}
+            column_cells['has_cell'][table_rows] = value_column.is_valid().to_numpy(zero_copy_only = False)[is_current]
+            column_cells['hashes'][table_rows] = store_table.column('hash:' + output_val).to_numpy()[is_current]
+            column_cells['values'][table_rows] = value_column.to_numpy(zero_copy_only = False)[is_current]
+            column_cells['discrepancies'][table_rows] = store_table.column('discrep:' + output_val).to_numpy()[is_current]
+            previous_cells[output_val] = column_cells
+        return previous_cells
+    except Exception as e:
+        log_error('Error: Could not read the cell store of output table \'' + output_tn + '\', all of its cells will be resolved again', str(e), False)
+        return {}
+
+# writes the cells of an output table resolved by this run to the cell store
+def write_cell_store(output_tn, key_values, table_cells):
+    global table_keys_df
+    store_path = get_cell_store_path(output_tn)
+    try:
+        store_columns = {}
+        for key_value in key_values:
+            store_columns[key_value] = pa.array(table_keys_df[key_value].astype(object).where(table_keys_df[key_value].notna(), None).to_numpy(dtype = object), type = pa.string())
+        for output_val, column_cells in table_cells.items():
+            store_columns['hash:' + output_val] = pa.array(column_cells['hashes'], type = pa.uint64())
+            store_columns['value:' + output_val] = pa.array(column_cells['values'], type = pa.string(), mask = ~column_cells['has_cell'])
+            store_columns['discrep:' + output_val] = pa.array(column_cells['discrepancies'], type = pa.bool_())
+        store_table = pa.table(store_columns)
+        store_table = store_table.replace_schema_metadata({'merger_cells': json.dumps(dict((output_val, column_cells['fingerprint']) for output_val, column_cells in table_cells.items())), 'output_tn': output_tn})
+        write_file_atomically(store_path, lambda temp_path: feather.write_feather(store_table, temp_path))
+    except Exception as e:
+        log_error('Error: Could not write the cell store of output table \'' + output_tn + '\'', str(e), False)
+
+# writes the discrepancies which changed since the previous run to delta_file
+def write_discrepancy_delta(previous_discrepancies, csv_file, delta_file):
+    global merge_plan
+    current_discrepancies = pd.read_csv(csv_file, dtype = str, keep_default_na = False)
+    if previous_discrepancies is None:
+        previous_discrepancies = pd.DataFrame(columns = current_discrepancies.columns)
+    columns = list(current_discrepancies.columns) + [column for column in previous_discrepancies.columns if column not in current_discrepancies.columns]
+    current_discrepancies = current_discrepancies.reindex(columns = columns, fill_value = '')
+    previous_discrepancies = previous_discrepancies.reindex(columns = columns, fill_value = '')
+    all_key_values = set(key_value for table_plan in merge_plan['tables'].values() for key_value in table_plan['key_values'])
+    id_columns = ['output_tn', 'output_cn'] + [column for column in columns[2:] if column in all_key_values]
+    value_columns = [column for column in columns if column not in id_columns]
+    previous_discrepancies = previous_discrepancies.drop_duplicates(subset = id_columns)
+    current_ids = pd.MultiIndex.from_frame(current_discrepancies[id_columns])
+    previous_ids = pd.MultiIndex.from_frame(previous_discrepancies[id_columns])
+    previous_rows = previous_ids.get_indexer(current_ids)
+    is_new = previous_rows < 0
+    is_changed = ~is_new
+    if len(value_columns) != 0:
+        is_changed &= (current_discrepancies[value_columns].to_numpy(dtype = object) != previous_discrepancies[value_columns].to_numpy(dtype = object)[previous_rows]).any(axis = 1)
+    else:
+        is_changed[:] = False
+    is_disappeared = ~previous_ids.isin(current_ids)
+    delta = pd.concat([current_discrepancies[is_new | is_changed].assign(change = np.where(is_new, 'new', 'changed')[is_new | is_changed]), previous_discrepancies[is_disappeared].assign(change = 'disappeared')], ignore_index = True)
+    delta[['change'] + columns].to_csv(delta_file, index = False)
+    return {'new': int(is_new.sum()), 'changed': int(is_changed.sum()), 'disappeared': int(is_disappeared.sum())}
+
+# the registry of comparison rules: their pattern, compile function, and whether they use dates
+comparison_rules = []
+
+# registers a comparison rule, as a decorator on a function which compiles a rule into a predicate
+def register_comparison_rule(pattern, uses_dates = False):
+    def add_comparison_rule(compile_rule):
+        comparison_rules.append((re.compile(pattern), compile_rule, uses_dates))
+        return compile_rule
+    return add_comparison_rule
+
+# compiles the rule of an output column into a predicate with the first rule which matches it
+def compile_comparison_rule(rule):
+    compiled_rule = {'rule': rule, 'predicate': None, 'uses_dates': False}
+    if rule in ['nan', '<NA>', '']:
+        return compiled_rule
+    for pattern, compile_rule, uses_dates in comparison_rules:
+        rule_match = pattern.fullmatch(rule)
+        if rule_match is not None:
+            try:
+                compiled_rule['predicate'] = compile_rule(rule_match)
+                compiled_rule['uses_dates'] = uses_dates
+            except Exception as e:
+                log_error('Error: Problem with compiling the comparison rule: ' + rule + ', values will be compared on string equality', str(e), False)
+            return compiled_rule
+    log_error('Error: Unknown comparison rule: ' + rule + ', values will be compared on string equality', '', False)
+    return compiled_rule
+
+# parses an array of M/D/Y date strings
+def parse_date_strings(date_values):
+    month_col, day_col, year_col = split_date_column(pd.Series(date_values, dtype = object))
+    return parse_date_parts(month_col, day_col, year_col)
+
+## ADD DISCREPANCY RULES HERE (or in a plugin file passed with --rule-plugins)
+
+## Date rules: if the dates are within a certain time period, there is no discrepancy.
+## Examples: 'date_90_day' - dates within 90 days of each other are considered OK
+##           'date_6_month' - within 6 months OK (a month is classified as 30 days)
+##           'date_2_year' - within 2 years OK (a year is classified as 365 days)
+@register_comparison_rule(r'date_(\d+)_(day|month|year)', uses_dates = True)
+def compile_date_rule(rule_match):
+    window = np.timedelta64(int(rule_match.group(1)) * {'day': 1, 'month': 30, 'year': 365}[rule_match.group(2)], 'D')
+    def has_date_discrepancy(vals, winning_vals, dates, winning_dates):
+        # values which aren't date markers are parsed here
+        if dates is None:
+            dates = parse_date_strings(vals)
+            winning_dates = parse_date_strings(winning_vals)
+        # dates which could not be parsed are always discrepancies
+        unparsed = np.isnat(dates) | np.isnat(winning_dates)
+        if unparsed.any():
+            log_error('Error: Problem with comparing values based on given rule: ' + rule_match.group(0), str(int(unparsed.sum())) + ' date(s) could not be parsed', False)
+        return ~((dates - winning_dates) <= window)
+    return has_date_discrepancy
+
+## Compares floats and ints
+## Example: '1.0' is the same as '1'
+@register_comparison_rule(r'compare_value_int')
+def compile_compare_value_int_rule(rule_match):
+    def has_value_discrepancy(vals, winning_vals, dates, winning_dates):
+        floats = pd.to_numeric(pd.Series(vals, dtype = object), errors = 'coerce').to_numpy(dtype = float)
+        winning_floats = pd.to_numeric(pd.Series(winning_vals, dtype = object), errors = 'coerce').to_numpy(dtype = float)
+        # values which aren't numbers are always discrepancies
+        unparsed = np.isnan(floats) | np.isnan(winning_floats)
+        if unparsed.any():
+            log_error('Error: Problem with comparing values based on given rule: ' + rule_match.group(0), str(int(unparsed.sum())) + ' value(s) are not numbers', False)
+        return ~(floats == winning_floats)
+    return has_value_discrepancy
+
+# the plugin files which have been loaded, so their rules are only registered once
+loaded_rule_plugins = []
+
+# loads comparison rules from plugin files, which call register_comparison_rule
+def load_rule_plugins(plugin_files):
+    global loaded_rule_plugins
+    for plugin_file in plugin_files:
+        if os.path.abspath(plugin_file) in loaded_rule_plugins:
+            continue
+        try:
+            plugin_name = 'merger_rule_plugin_' + os.path.splitext(os.path.basename(plugin_file))[0]
+            plugin_spec = importlib.util.spec_from_file_location(plugin_name, plugin_file)
+            plugin = importlib.util.module_from_spec(plugin_spec)
+            plugin.register_comparison_rule = register_comparison_rule
+            plugin_spec.loader.exec_module(plugin)
+            loaded_rule_plugins.append(os.path.abspath(plugin_file))
+        except Exception as e:
+            log_error('Error: Could not load the comparison rule plugin \'' + plugin_file + '\'', str(e), True)
+
+# compiles the comparison rule of every column in the merge plan once
+def compile_plan_rules(merge_plan):
+    compiled_rules = {}
+    for output_tn in merge_plan['table_names']:
+        for column_plan in merge_plan['tables'][output_tn]['columns']:
+            if (not column_plan['is_key']) and (column_plan['rule'] not in compiled_rules):
+                compiled_rules[column_plan['rule']] = compile_comparison_rule(column_plan['rule'])
+    return compiled_rules
+
+# processes a single output table from its plan. Returns its results and report.
+def process_output_table(output_tn):
+    global input_files_dict
+    global previous_cells
+    global table_cells
+    global table_row_hashes
+    global table_column_hashes
+    global table_keys_df
+    global form_key_indexers
+    global resolved_columns_dict
+    global parsed_dates_dict
+    global table_error_messages
+    global column_report
+    table_error_messages = []
+    table_report = {'stages': [], 'columns': {}}
+    table_result = {'output_tn': output_tn, 'table': None, 'key_values': [], 'discrepancies': None, 'manifest': None, 'errors': table_error_messages, 'critical': False, 'report': table_report}
+    table_stage = start_stage('process table')
+    try:
+        # every output table starts from the forms as loaded, without other tables' renamed or date columns
+        input_files_dict = dict(loaded_input_files_dict)
+        parsed_dates_dict = {}
+        table_plan = merge_plan['tables'][output_tn]
+
+        # get all the key column values for the output table
+        key_values_list = table_plan['key_values']
+        table_result['key_values'] = key_values_list
+
+        # create an entry for the output table in the dictionary of resolved columns of every table
+        resolved_columns_dict = create_output_file(output_tn, resolved_columns_dict)
+
+        # renames the key columns of the input forms of the output table to the output key columns
+        key_index_stage = start_stage('key index')
+        rename_key_columns(table_plan)
+
+        # builds the key index of each input form needed to create the output table
+        table_keys_df, form_key_indexers = build_form_key_indexes(table_plan)
+        key_index_record = end_stage(key_index_stage, table_report['stages'])
+        key_index_record['rows'] = len(table_keys_df)
+        key_index_record.update(table_duplicate_keys)
+
+        # process the date markers: create date columns for forms with day, month, and year columns
+        date_markers_stage = start_stage('date markers')
+        process_date_markers(table_plan['date_markers'])
+        end_stage(date_markers_stage, table_report['stages'])
+
+        # if the table's fingerprint matches the previous run, its previous table is loaded
+        table_manifest = {'fingerprint': table_plan['fingerprint'], 'columns': {}}
+        table_result['manifest'] = table_manifest
+        previous_table = None
+        previous_table_manifest = previous_manifest['tables'].get(output_tn, {'columns': {}})
+        if incremental_run and (previous_table_manifest.get('fingerprint') == table_manifest['fingerprint']):
+            previous_table = load_previous_output_table(output_tn, key_values_list)
+
+        # the cells of the output table resolved by the previous run and by this run
+        previous_cells = load_cell_store(output_tn, key_values_list) if cell_store_dir is not None else {}
+        table_cells = {}
+        table_row_hashes = {}
+        table_column_hashes = {}
+
+        # the discrepancies found in this output table
+        discrepancies_list = create_discrepancy_buffer(['output_tn', 'output_cn'] + key_values_list)
+
+        # for loop which iterates through the planned columns of the output table
+        for column_plan in table_plan['columns']:
+            output_cn = column_plan['output_cn']
+
+            # key columns aren't compared; they are taken from the key index
+            if(not column_plan['is_key']):
+
+                print('\n## Retrieving value for \'' + output_cn + '\'')
+                log_progress('## Retrieving value for \'' + output_cn + '\'')
+                column_stage = start_stage('resolve column')
+                column_report = {}
+
+                # the day, month and year columns are split from the column of dates, so aren't gathered
+                if column_plan['is_dmy_var']:
+                    form_columns = {}
                 else:
-                    day_col.append(row[output_val].split('/')[1])
-                    month_col.append(row[output_val].split('/')[0])
-                    year_col.append(row[output_val].split('/')[2])
-            new_col_df[day_col_name] = day_col
-            new_col_df[month_col_name] = month_col
-            new_col_df[year_col_name] = year_col
-        # merges the column of winning vals with the rest of the output table
-        output_files_dict[output_tn] = pd.merge(output_files_dict[output_tn], new_col_df, how = 'outer', on = key_values)
+                    # with the cell store, only the changed rows and the stored discrepancies are gathered
+                    stored_cells = find_stored_cells(column_plan, output_tn, key_values_list) if cell_store_dir is not None else None
+                    gather_rows = None if stored_cells is None else stored_cells['gather_rows']
+
+                    # gathers the current column from each input form, aligned to the rows of the output table
+                    form_columns = gather_form_columns(column_plan, gather_rows)
+                    form_precedence_dict = get_form_precedence_dict(column_plan)
+                    parsed_date_columns = gather_parsed_dates(column_plan, gather_rows)
+                    # if a form couldn't be gathered after all, every cell is resolved
+                    if (stored_cells is not None) and (list(form_columns)[::-1] != stored_cells['compare_order']):
+                        stored_cells = None
+                        form_columns = gather_form_columns(column_plan)
+                        parsed_date_columns = gather_parsed_dates(column_plan)
+
+                    # the comparison rule of the column, compiled when the plan was loaded
+                    compiled_rule = compiled_rules[column_plan['rule']]
+
+                # once these columns have been gathered, compare them, check for discrepancies, and export them
+                if(len(form_columns) != 0):
+                    print('...comparing ' + str(len(form_columns)) + ' forms')
+                    column_names = column_plan['column_names']
+                    column_fingerprint = get_column_fingerprint(column_plan, key_values_list)
+                    table_manifest['columns'][output_cn] = column_fingerprint
+                    # if the column's inputs haven't changed since the previous run, reuse its values
+                    column_reused = False
+                    if previous_table_manifest['columns'].get(output_cn) == column_fingerprint:
+                        column_reused, discrepancies_list = reuse_previous_column(discrepancies_list, previous_table, previous_discrepancies, list(form_columns.keys()), key_values_list, output_cn, output_tn, column_names)
+                    if column_reused:
+                        print('...unchanged since the previous run, reusing its values')
+                        # the cells of the column are unchanged as well, so they are kept
+                        if output_cn in previous_cells:
+                            table_cells[output_cn] = previous_cells[output_cn]
+                    else:
+                        discrepancies_list = find_discrepancies(discrepancies_list, form_columns, key_values_list, output_cn, output_tn, form_precedence_dict, compiled_rule, parsed_date_columns, stored_cells)
+                    column_report['reused'] = column_reused
+
+                # the time taken by the column, and its rows, forms and discrepancies
+                column_report.update(end_stage(column_stage, None))
+                column_report['forms'] = len(column_plan['sources']) if column_plan['is_dmy_var'] else len(form_columns)
+                del column_report['stage']
+                table_report['columns'][output_cn] = column_report
+
+        # all the columns of the output table have been resolved, so assemble it
+        assembly_stage = start_stage('assembly')
+        table_result['table'] = assemble_output_table(table_plan, table_keys_df)
+        table_result['discrepancies'] = discrepancies_list
+        end_stage(assembly_stage, table_report['stages'])
+        # the cell store is only written again if a cell of the output table changed
+        if (cell_store_dir is not None) and ((set(table_cells) != set(previous_cells)) or any(table_cells[output_val] is not previous_cells[output_val] for output_val in table_cells)):
+            write_cell_store(output_tn, key_values_list, table_cells)
+        table_report['rows'] = len(table_result['table'])
+    except SystemExit:
+        table_result['critical'] = True
+    end_stage(table_stage, table_report['stages'])
+    table_error_messages = None
+    return table_result
+
+# adds the results of a processed output table to the run: its messages, discrepancies and columns
+def add_table_result(table_result):
+    global error_log
+    global error_count
+    global output_file_names
+    global output_files_dict
+    global output_write_pool
+    global output_write_futures
+    global discrepancies_list
+    global key_values_list
+    global run_manifest
+    global run_report
+    for message, is_error in table_result['errors']:
+        if is_error:
+            error_count += 1
+        error_log.write(message)
+    if table_result['critical']:
+        print('CRITICAL ERROR: Check error_log.txt')
+        error_log.close()
+        sys.exit()
+    output_tn = table_result['output_tn']
+    old_key_values = key_values_list[:]
+    key_values_list = table_result['key_values']
+    # create the discrepancies list if not made yet; otherwise add any new key values
+    if discrepancies_list is None:
+        discrepancies_list = create_discrepancy_buffer(['output_tn', 'output_cn'] + key_values_list)
+    else:
+        for val in key_values_list:
+            if (val not in old_key_values) and (val not in discrepancies_list['columns']):
+                discrepancies_list['columns'].insert(2, val)
+    extend_discrepancy_buffer(discrepancies_list, table_result['discrepancies'])
+    output_file_names.append(output_tn)
+    output_files_dict[output_tn] = table_result['table']
+    # the output table is written while the next tables are processed
+    if table_result['table'] is not None:
+        output_write_futures[output_tn] = output_write_pool.submit(write_output_table, output_tn, table_result['table'])
+    run_manifest['tables'][output_tn] = table_result['manifest']
+    # the report of the table, with the discrepancies found in all of its columns
+    table_report = table_result['report']
+    table_report['discrepancies'] = sum(column_record.get('discrepancies', 0) for column_record in table_report['columns'].values())
+    run_report['tables'][output_tn] = table_report
+
+
+# gets the field of each loaded form which holds the first key column of its output tables
+def get_form_shard_fields():
+    global merge_plan
+    form_shard_fields = {}
+    for output_tn in output_table_names:
+        table_plan = merge_plan['tables'][output_tn]
+        first_key_column = table_plan['key_values'][0]
+        for form_name, form_key_fields in table_plan['key_fields'].items():
+            first_key_field = form_key_fields[first_key_column]
+            if form_shard_fields.get(form_name, first_key_field) != first_key_field:
+                log_error('Error: The form \'' + form_name + '\' can not be sharded, as the first key column of the output tables it is used in comes from more than one field: \'' + str(form_shard_fields[form_name]) + '\' and \'' + str(first_key_field) + '\'', '', True)
+            form_shard_fields[form_name] = first_key_field
+    return form_shard_fields
+
+# assigns each row of every loaded form to a shard by hashing its first key column
+def get_form_shard_ids(shard_count):
+    global full_input_files_dict
+    form_shard_ids = {}
+    try:
+        form_shard_fields = get_form_shard_fields()
+        for form_name, form_df in full_input_files_dict.items():
+            if form_name in form_shard_fields:
+                shard_values = form_df[form_shard_fields[form_name]].fillna('').to_numpy(dtype = object)
+                form_shard_ids[form_name] = (pd.util.hash_array(shard_values) % np.uint64(shard_count)).astype(np.int64)
+            else:
+                # forms without the first key column are caught when their keys are checked
+                form_shard_ids[form_name] = np.zeros(len(form_df), dtype = np.int64)
+        return form_shard_ids
     except Exception as e:
-        log_error('Error: Problem with adding the values to the output table', e.message, False)
-
-# if the two values are still different after having been modified by the given rule, return true
-def has_discrepancy_after_rule(val1, val2, rule):
-    try:
-        # ADD DISCREPANCY RULES HERE
-
-        if(rule == 'nan'):
-            return True
-
-        ## Date rules: if the dates are within a certain time period, there is no discrepancy.
-        ## Examples: 'date_90_day' - dates within 90 days of each other are considered OK
-        ##           'date_6_month' - within 6 months OK (a month is classified as 30 days)
-        ##           'date_2_year' - within 2 years OK (a year is classified as 365 days)
-        if(rule[0:4] == 'date'):
-            date_rule = rule.split('_')
-            date1 = date(int(val1.split('/')[2]), int(val1.split('/')[0]), int(val1.split('/')[1]))
-            date2 = date(int(val2.split('/')[2]), int(val2.split('/')[0]), int(val2.split('/')[1]))
-            if(date_rule[2] == 'day'):
-                if date1 - date2 <= timedelta(days = int(date_rule[1])):
-                    return False
-            elif(date_rule[2] == 'month'):
-                if date1 - date2 <= timedelta(days = (30 * int(date_rule[1]))):
-                    return False
-            elif(date_rule[2] == 'year'):
-                if date1 - date2 <= timedelta(days = (365 * int(date_rule[1]))):
-                    return False
-
-        ## Compares floats and ints
-        ## Example: '1.0' is the same as '1'
-        if(rule == 'compare_value_int'):
-            float1 = float(val1)
-            float2 = float(val2)
-            if(float1 == float2):
-                return False
+        log_error('Error: Could not hash-partition the input forms into shards', str(e), True)
 
+# processes every output table on one shard of the input forms. Returns the result of each output table.
+def process_shard(shard_index):
+    global loaded_input_files_dict
+    loaded_input_files_dict = {}
+    for form_name, form_df in full_input_files_dict.items():
+        loaded_input_files_dict[form_name] = form_df[form_shard_ids[form_name] == shard_index].reset_index(drop = True)
+    return [process_output_table(output_tn) for output_tn in output_table_names]
+
+# writes each shard of the input forms to its own directory with its own list of input files
+def write_shard_directories(shard_dir, shard_count):
+    global full_input_files_dict
+    try:
+        for shard_index in range(shard_count):
+            shard_path = os.path.join(shard_dir, 'shard_' + str(shard_index))
+            if not os.path.isdir(shard_path):
+                os.makedirs(shard_path)
+            list_of_files = []
+            for form_name, form_df in full_input_files_dict.items():
+                form_path = os.path.abspath(os.path.join(shard_path, form_name + '.csv'))
+                form_df[form_shard_ids[form_name] == shard_index].to_csv(form_path, index = False)
+                list_of_files.append('shard|' + form_name + '|' + form_path)
+            with open(os.path.join(shard_path, 'list_of_files.txt'), 'w') as list_file:
+                list_file.write('\n'.join(list_of_files) + '\n')
+        print('Shards written to \'' + shard_dir + '\'. Run the merger in each shard directory with its list_of_files.txt, then combine the outputs with --combine-shards.')
     except Exception as e:
-        log_error('Error: Problem with comparing values based on given rule: ' + str(rule), e.message, False)
-    return True
+        log_error('Error: Could not write the shards to \'' + shard_dir + '\'', str(e), True)
 
+# sorts the rows of an output table by its key values, the order of an unsharded run
+def sort_output_table_rows(output_table, key_values):
+    return output_table.sort_values(by = key_values, kind = 'mergesort').reset_index(drop = True)
 
-## START OF PROGRAM ##
+# sorts discrepancies by output table, output column in display order, then key values
+def sort_discrepancy_rows(discrepancies):
+    global merge_plan
+    if discrepancies.empty:
+        return discrepancies
+    column_positions = {}
+    all_key_values = set()
+    for output_tn in output_table_names:
+        for column_plan in merge_plan['tables'][output_tn]['columns']:
+            column_positions.setdefault((output_tn, column_plan['output_cn']), len(column_positions))
+        all_key_values.update(merge_plan['tables'][output_tn]['key_values'])
+    positions = [column_positions.get(output_column, len(column_positions)) for output_column in zip(discrepancies['output_tn'], discrepancies['output_cn'])]
+    key_columns = [col for col in discrepancies.columns if col in all_key_values]
+    sorted_discrepancies = discrepancies.assign(discrepancy_position = positions).sort_values(by = ['discrepancy_position'] + key_columns, kind = 'mergesort')
+    return sorted_discrepancies.drop(columns = ['discrepancy_position']).reset_index(drop = True)
 
-# creates a log of errors regarding the format of the given forms, the program, etc.
-if(os.path.exists('error_log.txt')):
-    os.remove('error_log.txt')
-error_log = open('error_log.txt', 'a')
+# merges the discrepancies of the shards into the order of an unsharded run, by output column
+def merge_shard_discrepancies(shard_chunk_iterators, add_chunk):
+    global merge_plan
+    column_positions = {}
+    for output_tn in output_table_names:
+        for column_plan in merge_plan['tables'][output_tn]['columns']:
+            column_positions.setdefault((output_tn, column_plan['output_cn']), len(column_positions))
+    spill_dir = tempfile.mkdtemp(prefix = 'merger_discrepancies_')
+    try:
+        # the spill files of each output column, in shard order; unknown columns are sorted last
+        position_parts = {}
+        for shard_chunks in shard_chunk_iterators:
+            for discrepancies_chunk in shard_chunks:
+                if len(discrepancies_chunk) == 0:
+                    continue
+                positions = np.array([column_positions.get(output_column, len(column_positions)) for output_column in zip(discrepancies_chunk['output_tn'], discrepancies_chunk['output_cn'])])
+                for position in pd.unique(positions):
+                    spill_path = os.path.join(spill_dir, 'discrepancies_' + str(len(os.listdir(spill_dir))) + '.pkl')
+                    discrepancies_chunk[positions == position].to_pickle(spill_path)
+                    position_parts.setdefault(position, []).append(spill_path)
+        for position in sorted(position_parts):
+            add_chunk(sort_discrepancy_rows(pd.concat([pd.read_pickle(spill_path) for spill_path in position_parts[position]], ignore_index = True)))
+            for spill_path in position_parts[position]:
+                os.remove(spill_path)
+    finally:
+        shutil.rmtree(spill_dir, True)
 
-# counts the number of errors handled while running
-error_count = 0
+# combines the results of an output table from every shard, in the order of an unsharded run
+def combine_shard_results(shard_results):
+    combined_result = {'output_tn': shard_results[0]['output_tn'], 'table': None, 'key_values': shard_results[0]['key_values'], 'discrepancies': None, 'manifest': None, 'errors': [], 'critical': False, 'report': merge_table_reports([shard_result['report'] for shard_result in shard_results])}
+    for shard_index, shard_result in enumerate(shard_results):
+        for message, is_error in shard_result['errors']:
+            combined_result['errors'].append((message.replace('\n', '\n[shard ' + str(shard_index) + '] ', 1), is_error))
+        combined_result['critical'] = combined_result['critical'] or shard_result['critical']
+    if not combined_result['critical']:
+        combined_result['table'] = sort_output_table_rows(pd.concat([shard_result['table'] for shard_result in shard_results], ignore_index = True), combined_result['key_values'])
+        # the discrepancies of a table are sorted one output column at a time
+        combined_result['discrepancies'] = create_discrepancy_buffer(shard_results[0]['discrepancies']['columns'])
+        for shard_result in shard_results:
+            add_discrepancy_columns(combined_result['discrepancies'], shard_result['discrepancies']['columns'])
+        merge_shard_discrepancies([iterate_discrepancy_chunks(shard_result['discrepancies']) for shard_result in shard_results], lambda discrepancies_chunk: append_discrepancies(combined_result['discrepancies'], discrepancies_chunk))
+    return combined_result
 
-# loads and sorts the config files
-input_config = load_config_file(sys.argv[2])
-input_config = sort_input_config_file(input_config)
-output_config = load_config_file(sys.argv[3])
-output_config = sort_output_config_file(output_config)
+# combines the outputs of shards which were run separately into the outputs of a single run
+def combine_shard_directories(shard_dir):
+    global error_log
+    global error_count
+    global output_files_dict
+    try:
+        shard_paths = sorted([os.path.join(shard_dir, name) for name in os.listdir(shard_dir) if name.startswith('shard_')], key = lambda path: int(path.rsplit('_', 1)[1]))
+        for output_tn in output_table_names:
+            key_values = merge_plan['tables'][output_tn]['key_values']
+            shard_tables = [pd.read_csv(os.path.join(shard_path, output_tn + '.csv'), dtype = str, keep_default_na = False) for shard_path in shard_paths]
+            sort_output_table_rows(pd.concat(shard_tables, ignore_index = True), key_values).to_csv(output_tn + '.csv', index = False)
+            output_files_dict[output_tn] = None
+        # the shards' discrepancies are read a chunk at a time and written one output column at a time
+        discrepancy_paths = [os.path.join(shard_path, 'discrepancies.csv') for shard_path in shard_paths]
+        discrepancy_columns = []
+        for discrepancy_path in discrepancy_paths:
+            discrepancy_columns.extend(column for column in pd.read_csv(discrepancy_path, dtype = str, nrows = 0).columns if column not in discrepancy_columns)
+        with open('discrepancies.csv', 'w', newline = '') as discrepancies_file:
+            pd.DataFrame(columns = discrepancy_columns).to_csv(discrepancies_file, index = False)
+            merge_shard_discrepancies([pd.read_csv(discrepancy_path, dtype = str, keep_default_na = False, chunksize = discrepancy_batch_rows) for discrepancy_path in discrepancy_paths], lambda discrepancies_chunk: discrepancies_chunk.reindex(columns = discrepancy_columns).to_csv(discrepancies_file, header = False, index = False))
+        # the error logs of the shards are copied over, with each message marked with its shard
+        for shard_index, shard_path in enumerate(shard_paths):
+            if os.path.exists(os.path.join(shard_path, 'error_log.txt')):
+                with open(os.path.join(shard_path, 'error_log.txt')) as shard_error_log:
+                    for line in shard_error_log.read().split('\n'):
+                        if line.startswith('Error'):
+                            error_count += 1
+                        if line != '':
+                            error_log.write('\n[shard ' + str(shard_index) + '] ' + line)
+    except Exception as e:
+        log_error('Error: Could not combine the shards in \'' + shard_dir + '\'', str(e), True)
 
-# loads the list of input files
-input_files_dict = load_input_files(sys.argv[1])
 
-# list of output file names to keep track of which ones have already been created
-output_file_names = []
+# encodes the key values of a form's rows into strings which sort like the output table
+def get_key_sort_keys(form_df, key_fields):
+    sort_keys = None
+    for key_field in key_fields:
+        key_col = form_df[key_field].astype(object)
+        encoded_col = ('\x01' + key_col.fillna('')).where(key_col.notna(), '\x02')
+        sort_keys = encoded_col if sort_keys is None else sort_keys + '\x00' + encoded_col
+    return sort_keys.to_numpy(dtype = object)
 
-# dictionary which stores the output file DataFrames
-output_files_dict = {}
+# sorts a run of a form's rows by key and spills it to disk in blocks
+def spill_sorted_run(run_df, run_bytes, key_fields):
+    global stream_spill_dir
+    global stream_spill_count
+    global memory_budget
+    sort_keys = get_key_sort_keys(run_df, key_fields)
+    # a stable sort, so the rows of a duplicate key stay in the order of the form
+    sort_order = np.argsort(sort_keys, kind = 'stable')
+    run_df = run_df.iloc[sort_order].reset_index(drop = True)
+    sort_keys = sort_keys[sort_order]
+    block_rows = max(1, int(len(run_df) * (memory_budget / 64) / max(run_bytes, 1)))
+    block_paths = []
+    for block_start in range(0, len(run_df), block_rows):
+        stream_spill_count += 1
+        block_path = os.path.join(stream_spill_dir, 'block_' + str(stream_spill_count) + '.pkl')
+        pd.to_pickle((run_df.iloc[block_start:block_start + block_rows], sort_keys[block_start:block_start + block_rows]), block_path)
+        block_paths.append(block_path)
+    return block_paths
 
-# list of strings containing the key values for each output file
-key_values_list = []
+# externally sorts the given fields of a form by key into runs on disk
+def sort_form_into_runs(form_path, field_names, key_fields):
+    global memory_budget
+    runs = []
+    run_chunks = []
+    run_bytes = 0
+    total_rows = 0
+    total_bytes = 0
+    empty_form_df = pd.read_csv(form_path, dtype = 'string', usecols = lambda col: col in field_names, nrows = 0)
+    for form_chunk in pd.read_csv(form_path, dtype = 'string', usecols = lambda col: col in field_names, chunksize = 10000):
+        chunk_bytes = int(form_chunk.memory_usage(deep = True).sum())
+        run_chunks.append(form_chunk)
+        run_bytes += chunk_bytes
+        total_rows += len(form_chunk)
+        total_bytes += chunk_bytes
+        if run_bytes >= memory_budget / 4:
+            runs.append(spill_sorted_run(pd.concat(run_chunks, ignore_index = True), run_bytes, key_fields))
+            run_chunks = []
+            run_bytes = 0
+    if len(run_chunks) != 0:
+        runs.append(spill_sorted_run(pd.concat(run_chunks, ignore_index = True), run_bytes, key_fields))
+    return runs, empty_form_df, total_bytes / max(total_rows, 1)
 
-# DataFrame which contains all of the discrepancies
-discrepancies_list = pd.DataFrame()
+# creates a stream over a sorted run of a form
+def create_run_stream(form_name, block_paths):
+    return {'form_name': form_name, 'blocks': list(block_paths), 'rows': None, 'sort_keys': np.array([], dtype = object)}
 
-# boolean which stores whether the discrepancies list has been created yet
-discrepancies_list_made = False
+# reads the next block of a run into its stream. The block file is removed once it has been read.
+def read_run_block(run_stream):
+    block_path = run_stream['blocks'].pop(0)
+    block_df, block_sort_keys = pd.read_pickle(block_path)
+    os.remove(block_path)
+    if (run_stream['rows'] is None) or (len(run_stream['rows']) == 0):
+        run_stream['rows'] = block_df
+    else:
+        run_stream['rows'] = pd.concat([run_stream['rows'], block_df], ignore_index = True)
+    run_stream['sort_keys'] = np.concatenate([run_stream['sort_keys'], block_sort_keys])
 
-# boolean which stores whether the current output table has variables for the individual day, month and year variables
-has_dmy_vars = False
+# the sort key of the last row read from a stream, or the smallest key if none are waiting
+def get_last_sort_key(run_stream):
+    if len(run_stream['sort_keys']) == 0:
+        return ''
+    return run_stream['sort_keys'][-1]
 
-# the name of the date, day, month, and year output columns. These names will be overriden to the names in the output config if the date markers are assigned.
-date_col_name = 'visdate'
-day_col_name = 'visday'
-month_col_name = 'vismonth'
-year_col_name = 'visyear'
+# takes the rows of every stream whose keys are below the boundary, grouped by form
+def take_merged_rows(run_streams, boundary):
+    form_parts = {}
+    for run_stream in run_streams:
+        if len(run_stream['sort_keys']) == 0:
+            continue
+        take_rows = len(run_stream['sort_keys']) if boundary is None else int(np.searchsorted(run_stream['sort_keys'], boundary, side = 'left'))
+        if take_rows == 0:
+            continue
+        form_parts.setdefault(run_stream['form_name'], []).append(run_stream['rows'].iloc[:take_rows])
+        run_stream['rows'] = run_stream['rows'].iloc[take_rows:].reset_index(drop = True)
+        run_stream['sort_keys'] = run_stream['sort_keys'][take_rows:]
+    return form_parts
 
-print('Starting...')
+# adds a resolved batch to the outputs of its table
+def add_streamed_batch(batch_result, table_stream, output_writers):
+    global error_log
+    global error_count
+    for message, is_error in batch_result['errors']:
+        if message not in table_stream['messages']:
+            table_stream['messages'].add(message)
+            if is_error:
+                error_count += 1
+            error_log.write(message)
+    if batch_result['critical']:
+        print('CRITICAL ERROR: Check error_log.txt')
+        error_log.close()
+        sys.exit()
+    write_output_chunk(output_writers, batch_result['table'])
+    table_stream['reports'].append(batch_result['report'])
+    add_discrepancy_columns(table_stream['discrepancies'], batch_result['discrepancies']['columns'])
+    for discrepancies_chunk in iterate_discrepancy_chunks(batch_result['discrepancies']):
+        for output_cn, column_discrepancies in discrepancies_chunk.groupby('output_cn', sort = False):
+            column_buffer = table_stream['column_discrepancies'].setdefault(output_cn, create_discrepancy_buffer([]))
+            append_discrepancies(column_buffer, column_discrepancies.reset_index(drop = True))
 
-# for loop which iterates through the output config file
-for i, row in output_config.iterrows():
+# processes an output table out of core, a batch of keys at a time
+def stream_output_table(output_tn, form_paths):
+    global merge_plan
+    global memory_budget
+    global loaded_input_files_dict
+    table_plan = merge_plan['tables'][output_tn]
+    key_values = table_plan['key_values']
+    # the fields of each form used by the output table
+    table_fields = {}
+    for form_name, form_key_fields in table_plan['key_fields'].items():
+        table_fields[form_name] = set(form_key_fields.values())
+    for column_plan in table_plan['columns']:
+        for source in column_plan['sources']:
+            table_fields.setdefault(source['form_name'], set()).add(source['field_name'])
+    for form_name, dmy_fields in table_plan['date_markers']['dmy_fields'].items():
+        table_fields.setdefault(form_name, set()).update(dmy_fields)
+    # only the forms which add rows to the output table are sorted
+    empty_forms_dict = {}
+    run_streams = []
+    row_bytes = 1
+    sort_stage = start_stage('sort runs')
+    for form_name in table_fields:
+        if form_name not in form_paths:
+            continue
+        try:
+            if form_name in table_plan['row_forms']:
+                key_fields = [table_plan['key_fields'][form_name][output_key_column] for output_key_column in key_values]
+                runs, empty_forms_dict[form_name], form_row_bytes = sort_form_into_runs(form_paths[form_name], table_fields[form_name], key_fields)
+                row_bytes = max(row_bytes, form_row_bytes)
+                run_streams = run_streams + [create_run_stream(form_name, block_paths) for block_paths in runs]
+            else:
+                empty_forms_dict[form_name] = pd.read_csv(form_paths[form_name], dtype = 'string', usecols = lambda col: col in table_fields[form_name], nrows = 0)
+        except Exception as e:
+            log_error('Error: Could not sort the input form \'' + form_name + '\' for output table \'' + output_tn + '\'', str(e), True)
+    sort_stage_record = end_stage(sort_stage, None)
+    sort_stage_record['runs'] = len(run_streams)
+    # each batch holds about an eighth of the memory budget of rows
+    batch_rows = max(1, int(memory_budget / 8 / row_bytes))
+    table_stream = {'messages': set(), 'reports': [], 'discrepancies': create_discrepancy_buffer(['output_tn', 'output_cn'] + key_values), 'column_discrepancies': {}}
+    batch_count = 0
+    output_writers = open_output_writers(output_tn, table_plan['display_order'])
+    try:
+        while True:
+            # reads blocks until a batch of rows is waiting, from the stream which limits the batch
+            pending_streams = [run_stream for run_stream in run_streams if len(run_stream['blocks']) != 0]
+            while (len(pending_streams) != 0) and (sum(len(run_stream['sort_keys']) for run_stream in run_streams) < batch_rows):
+                read_run_block(min(pending_streams, key = get_last_sort_key))
+                pending_streams = [run_stream for run_stream in run_streams if len(run_stream['blocks']) != 0]
+            # every key below the smallest last key of the unfinished streams is complete
+            boundary = None
+            if len(pending_streams) != 0:
+                boundary = min(get_last_sort_key(run_stream) for run_stream in pending_streams)
+            form_parts = take_merged_rows(run_streams, boundary)
+            if len(form_parts) == 0:
+                if len(pending_streams) == 0:
+                    break
+                # all the waiting rows share the boundary key, so the batch has to reach past it
+                read_run_block(min(pending_streams, key = get_last_sort_key))
+                continue
+            batch_count += 1
+            print('\n# Merging batch ' + str(batch_count) + ' of output table \'' + output_tn + '\'')
+            loaded_input_files_dict = dict(empty_forms_dict)
+            for form_name, parts in form_parts.items():
+                loaded_input_files_dict[form_name] = pd.concat(parts, ignore_index = True)
+            add_streamed_batch(process_output_table(output_tn), table_stream, output_writers)
+    finally:
+        close_output_writers(output_writers)
+    # the discrepancies are put in the order of a run which isn't streamed
+    table_discrepancies = table_stream['discrepancies']
+    for output_cn in dict.fromkeys(column_plan['output_cn'] for column_plan in table_plan['columns']):
+        if output_cn in table_stream['column_discrepancies']:
+            extend_discrepancy_buffer(table_discrepancies, table_stream['column_discrepancies'][output_cn])
+    # the report of the table adds up its batches
+    table_report = merge_table_reports(table_stream['reports'])
+    table_report['stages'].insert(0, sort_stage_record)
+    table_report['batches'] = batch_count
+    return {'output_tn': output_tn, 'table': None, 'key_values': key_values, 'discrepancies': table_discrepancies, 'manifest': None, 'errors': [], 'critical': False, 'report': table_report}
 
-    # if the output table has not been created yet, create it
-    if row['output_tn'] not in output_file_names:
 
-        # get all the key column values for the new output table
-        old_key_values = key_values_list[:]
-        key_values_list = get_key_columns(output_config[output_config.output_tn == row['output_tn']])
+# quotes the name of a table or column for use in SQL
+def quote_identifier(name):
+    return '"' + str(name).replace('"', '""') + '"'
 
-        # create a DataFrame for the output table and add it to the dictionary storing all of the output tables
-        output_files_dict = create_output_file(row['output_tn'], output_files_dict, key_values_list)
+# the SQL condition which is true when a value is treated as missing (NULL, 'nan', '', '-4')
+def get_sql_null_condition(value_sql):
+    return '(' + value_sql + ' IS NULL OR ' + value_sql + ' IN (' + ', '.join('\'' + null_value + '\'' for null_value in null_values) + '))'
 
-        # goes through all of the input forms needed to create the output table and makes sure they contain the required key values
-        check_input_forms_for_key_values(row['output_tn'], key_values_list)
+# opens the database of the SQLite backend
+def open_merge_database(database_file):
+    database_dir = os.path.dirname(database_file)
+    if (database_dir != '') and not os.path.isdir(database_dir):
+        os.makedirs(database_dir)
+    connection = sqlite3.connect(database_file)
+    connection.execute('CREATE TABLE IF NOT EXISTS merger_forms (form_name TEXT PRIMARY KEY, fingerprint TEXT)')
+    return connection
 
-        # process the date markers column: create date columns for forms which have seperate day, month, and year columns
-        process_date_markers(input_config[input_config.output_tn == row['output_tn']])
+# loads the required fields of each form into the database, reusing unchanged forms
+def load_forms_into_database(connection, form_paths):
+    global merge_plan
+    global rebuild_cache
+    loaded_forms = {}
+    for form_name, form_path in form_paths.items():
+        try:
+            required_fields = merge_plan['required_fields'][form_name]
+            form_table = quote_identifier('form_' + form_name)
+            fingerprint = json.dumps(get_file_fingerprint(form_path) + [required_fields])
+            loaded_form = connection.execute('SELECT fingerprint FROM merger_forms WHERE form_name = ?', (form_name,)).fetchone()
+            if (not rebuild_cache) and (loaded_form is not None) and (loaded_form[0] == fingerprint):
+                loaded_forms[form_name] = [column_info[1] for column_info in connection.execute('PRAGMA table_info(' + form_table + ')')]
+                continue
+            print('Loading \'' + form_name + '\' into the database')
+            connection.execute('DELETE FROM merger_forms WHERE form_name = ?', (form_name,))
+            connection.execute('DROP TABLE IF EXISTS ' + form_table)
+            form_fields = pd.read_csv(form_path, dtype = 'string', usecols = lambda col: col in required_fields, nrows = 0).columns.tolist()
+            connection.execute('CREATE TABLE ' + form_table + ' (' + ', '.join(quote_identifier(field_name) + ' TEXT' for field_name in form_fields) + ')')
+            insert_sql = 'INSERT INTO ' + form_table + ' VALUES (' + ', '.join(['?'] * len(form_fields)) + ')'
+            for form_chunk in pd.read_csv(form_path, dtype = 'string', usecols = lambda col: col in required_fields, chunksize = 100000):
+                form_chunk = form_chunk[form_fields].astype(object)
+                connection.executemany(insert_sql, form_chunk.where(form_chunk.notna(), None).itertuples(index = False, name = None))
+            for output_tn in merge_plan['table_names']:
+                table_plan = merge_plan['tables'][output_tn]
+                if form_name in table_plan['row_forms']:
+                    key_fields = [table_plan['key_fields'][form_name][output_key_column] for output_key_column in table_plan['key_values']]
+                    if set(key_fields).issubset(form_fields):
+                        connection.execute('CREATE INDEX IF NOT EXISTS ' + quote_identifier('index_' + hash_parts([form_name] + key_fields)) + ' ON ' + form_table + ' (' + ', '.join(quote_identifier(key_field) for key_field in key_fields) + ')')
+            connection.execute('INSERT INTO merger_forms VALUES (?, ?)', (form_name, fingerprint))
+            connection.commit()
+            loaded_forms[form_name] = form_fields
+        except Exception as e:
+            log_error('Error: Could not load the input form \'' + form_name + '\' into the database', str(e), True)
+    return loaded_forms
 
-        # updates the discrepancies list to include new key values, e.g. ones that haven't been seen in a previous output table
-        if discrepancies_list_made:
-            for val in key_values_list:
-                if val not in old_key_values:
-                    discrepancies_list.insert(loc=2, column=val, value=['' for i in range(discrepancies_list.shape[0])])
+# prepares an output table in the database: a keyed table of each form and their key tuples
+def create_database_table_forms(connection, table_plan, loaded_forms):
+    output_tn = table_plan['output_tn']
+    key_values = table_plan['key_values']
+    date_markers = table_plan['date_markers']
+    # every form of the output table must have been loaded
+    for form_name in table_plan['key_fields']:
+        if form_name not in loaded_forms:
+            log_error('Error: Problem retrieving the key column names from the input form \'' + form_name + '\'', '\'' + form_name + '\'', True)
+    table_form_columns = {}
+    try:
+        for form_position, form_name in enumerate(table_plan['row_forms']):
+            form_table = quote_identifier('form_' + form_name)
+            key_fields = [table_plan['key_fields'][form_name][output_key_column] for output_key_column in key_values]
+            key_fields_sql = ', '.join(quote_identifier(key_field) for key_field in key_fields)
+            select_list = [quote_identifier(key_field) + ' AS ' + quote_identifier(output_key_column) for output_key_column, key_field in zip(key_values, key_fields)]
+            form_columns = list(key_values)
+            for field_name in loaded_forms[form_name]:
+                if field_name not in key_fields:
+                    select_list.append(quote_identifier(field_name))
+                    form_columns.append(field_name)
+            # the date column of a form with only day, month, and year columns
+            if form_name in date_markers['dmy_fields']:
+                day_var_name, month_var_name, year_var_name = date_markers['dmy_fields'][form_name]
+                if set([day_var_name, month_var_name, year_var_name]).issubset(form_columns):
+                    select_list.append(quote_identifier(month_var_name) + ' || \'/\' || ' + quote_identifier(day_var_name) + ' || \'/\' || ' + quote_identifier(year_var_name) + ' AS ' + quote_identifier(date_markers['date_col_name'] + '_' + form_name))
+                    form_columns.append(date_markers['date_col_name'] + '_' + form_name)
+                else:
+                    log_error('Error: Problem converting the day, month, and year columns into a date column', 'The form \'' + form_name + '\' is missing one of them', False)
+            first_rows_sql = 'SELECT MIN(rowid) FROM ' + form_table + ' GROUP BY ' + key_fields_sql
+            table_form = 'table_form_' + str(form_position)
+            connection.execute('DROP TABLE IF EXISTS ' + table_form)
+            connection.execute('CREATE TEMP TABLE ' + table_form + ' AS SELECT ' + ', '.join(select_list) + ' FROM ' + form_table + ' WHERE rowid IN (' + first_rows_sql + ')')
+            # duplicate key tuples are reported here, before any values are compared
+            duplicate_count = connection.execute('SELECT COUNT(*) FROM ' + form_table).fetchone()[0] - connection.execute('SELECT COUNT(*) FROM ' + table_form).fetchone()[0]
+            if duplicate_count > 0:
+                duplicate_keys = ', '.join(str(key) for key in connection.execute('SELECT ' + key_fields_sql + ' FROM ' + form_table + ' WHERE rowid NOT IN (' + first_rows_sql + ') ORDER BY rowid LIMIT 5'))
+                # the SQLite backend only supports the 'fail' and 'first' duplicate key policies
+                if duplicate_key_policy == 'fail':
+                    log_error('Error: ' + str(duplicate_count) + ' duplicate key value(s) in form \'' + form_name + '\' for output table \'' + output_tn + '\'. Duplicates include: ' + duplicate_keys, '', True)
+                elif duplicate_key_policy != 'first':
+                    print('...the SQLite backend does not support the \'' + duplicate_key_policy + '\' duplicate key policy, the first row for each key is used')
+                log_error('Error: ' + str(duplicate_count) + ' duplicate key value(s) in form \'' + form_name + '\' for output table \'' + output_tn + '\', only the first row for each key is used. Duplicates include: ' + duplicate_keys, '', False)
+            connection.execute('CREATE INDEX ' + table_form + '_keys ON ' + table_form + ' (' + ', '.join(quote_identifier(output_key_column) for output_key_column in key_values) + ')')
+            table_form_columns[form_name] = (table_form, form_columns)
+        # the union of the key tuples, sorted like the output table; its rowid is the row position
+        key_values_sql = ', '.join(quote_identifier(output_key_column) for output_key_column in key_values)
+        connection.execute('DROP TABLE IF EXISTS table_keys')
+        connection.execute('CREATE TEMP TABLE table_keys (' + key_values_sql + ')')
+        if len(table_form_columns) != 0:
+            union_sql = ' UNION '.join('SELECT ' + key_values_sql + ' FROM ' + table_form for table_form, form_columns in table_form_columns.values())
+            connection.execute('INSERT INTO table_keys SELECT * FROM (' + union_sql + ') ORDER BY ' + ', '.join(quote_identifier(output_key_column) + ' IS NULL, ' + quote_identifier(output_key_column) for output_key_column in key_values))
+        connection.execute('DROP TABLE IF EXISTS resolved_columns')
+        connection.execute('CREATE TEMP TABLE resolved_columns (row_id INTEGER PRIMARY KEY, is_resolved INTEGER DEFAULT 0)')
+        connection.execute('INSERT INTO resolved_columns (row_id) SELECT rowid FROM table_keys')
+    except Exception as e:
+        log_error('Error: Could not build the key index of the input forms for output table \'' + output_tn + '\'', str(e), True)
+    return table_form_columns
 
-        # create the discrepancies list if not made yet
-        if discrepancies_list_made == False:
-            discrepancies_list_cols = ['output_tn', 'output_cn'] + key_values_list
-            discrepancies_list = pd.DataFrame(columns = discrepancies_list_cols)
-            discrepancies_list_made = True
+# resolves an output column in the database, finding the winners and discrepancies in SQL
+def resolve_database_column(connection, discrepancies_list, table_form_columns, form_fields, form_precedence_dict, compiled_rule, key_values, output_val, output_tn, resolved_column):
+    global column_report
+    try:
+        form_name_list = list(form_fields.keys())
+        add_discrepancy_columns(discrepancies_list, form_name_list)
+        # the values are compared starting from the last form
+        compare_order = form_name_list[::-1]
+        value_cols = ['v' + str(k) for k in range(len(compare_order))]
+        select_list = []
+        join_list = []
+        contains_key = []
+        for k, form_name in enumerate(compare_order):
+            table_form = table_form_columns[form_name][0]
+            join_list.append('LEFT JOIN ' + table_form + ' f' + str(k) + ' ON ' + ' AND '.join('t.' + quote_identifier(key) + ' IS f' + str(k) + '.' + quote_identifier(key) for key in key_values))
+            select_list.append('f' + str(k) + '.' + quote_identifier(form_fields[form_name]) + ' AS ' + value_cols[k])
+            contains_key.append('f' + str(k) + '.rowid IS NOT NULL')
+        # null values can never win, so they are given a precedence lower than any form
+        precedences = [str(int(form_precedence_dict[form_name])) for form_name in compare_order]
+        is_null = [get_sql_null_condition(value_col) for value_col in value_cols]
+        candidate_precedences = ['CASE WHEN ' + is_null[k] + ' THEN ' + str(np.iinfo(np.int64).max) + ' ELSE ' + precedences[k] + ' END' for k in range(len(compare_order))]
+        highest_precedence_sql = candidate_precedences[0] if len(candidate_precedences) == 1 else 'min(' + ', '.join(candidate_precedences) + ')'
+        is_highest = ['(NOT ' + is_null[k] + ' AND ' + precedences[k] + ' = highest_precedence)' for k in range(len(compare_order))]
+        winning_val_sql = 'CASE ' + ' '.join('WHEN ' + is_highest[k] + ' THEN ' + value_cols[k] for k in range(len(compare_order))) + ' ELSE \'nan\' END'
+        connection.execute('DROP TABLE IF EXISTS column_values')
+        connection.execute('CREATE TEMP TABLE column_values (row_id INTEGER PRIMARY KEY, ' + ', '.join(value_cols) + ', highest_precedence INTEGER, winning_val, is_discrep INTEGER)')
+        connection.execute('INSERT INTO column_values SELECT row_id, ' + ', '.join(value_cols) + ', highest_precedence, ' + winning_val_sql + ', 0 FROM (SELECT *, ' + highest_precedence_sql + ' AS highest_precedence FROM (SELECT t.rowid AS row_id, ' + ', '.join(select_list) + ' FROM table_keys t ' + ' '.join(join_list) + ' WHERE ' + ' OR '.join(contains_key) + '))')
+        differs = ['(' + is_highest[k] + ' AND ' + value_cols[k] + ' != winning_val)' for k in range(len(compare_order))]
+        if compiled_rule['predicate'] is None:
+            connection.execute('UPDATE column_values SET is_discrep = 1 WHERE ' + ' OR '.join(differs))
+        else:
+            # all the differing pairs are passed to the rule's predicate, a chunk at a time
+            discrepancy_rows = set()
+            pairs_cursor = connection.execute(' UNION ALL '.join('SELECT row_id, ' + value_cols[k] + ', winning_val FROM column_values WHERE ' + differs[k] for k in range(len(compare_order))))
+            while True:
+                pairs = pairs_cursor.fetchmany(100000)
+                if len(pairs) == 0:
+                    break
+                pair_rows = np.array([pair[0] for pair in pairs], dtype = np.int64)
+                pair_discrepancies = compiled_rule['predicate'](np.array([pair[1] for pair in pairs]), np.array([pair[2] for pair in pairs]), None, None)
+                discrepancy_rows.update(pair_rows[pair_discrepancies].tolist())
+            connection.executemany('UPDATE column_values SET is_discrep = 1 WHERE row_id = ?', [(row_id,) for row_id in sorted(discrepancy_rows)])
+        # if discrepancies are found, add them to the discrepancy spreadsheet
+        discrepancy_count = connection.execute('SELECT COUNT(*) FROM column_values WHERE is_discrep = 1').fetchone()[0]
+        column_report['rows'] = connection.execute('SELECT COUNT(*) FROM column_values').fetchone()[0]
+        column_report['discrepancies'] = discrepancy_count
+        if discrepancy_count > 0:
+            print('! ' + str(discrepancy_count) + ' discrepancies found, written to discrepancies.csv !')
+            discrepancies_cursor = connection.execute('SELECT ' + ', '.join('t.' + quote_identifier(key) for key in key_values) + ', ' + ', '.join('c.' + value_col for value_col in value_cols) + ' FROM column_values c JOIN table_keys t ON t.rowid = c.row_id WHERE c.is_discrep = 1 ORDER BY c.row_id')
+            while True:
+                discrepancy_rows = discrepancies_cursor.fetchmany(discrepancy_batch_rows)
+                if len(discrepancy_rows) == 0:
+                    break
+                new_discrepancies = pd.DataFrame([row[:len(key_values)] for row in discrepancy_rows], columns = key_values)
+                new_discrepancies.insert(loc = 0, column = 'output_tn', value = output_tn)
+                new_discrepancies.insert(loc = 1, column = 'output_cn', value = output_val)
+                for k, form_name in enumerate(compare_order):
+                    new_discrepancies[form_name] = ['nan' if row[len(key_values) + k] is None else row[len(key_values) + k] for row in discrepancy_rows]
+                append_discrepancies(discrepancies_list, new_discrepancies)
+        # add all the winning values to the resolved columns of the output table
+        connection.execute('UPDATE resolved_columns SET ' + resolved_column + ' = (SELECT CASE WHEN c.is_discrep = 1 THEN \'discrep\' ELSE c.winning_val END FROM column_values c WHERE c.row_id = resolved_columns.row_id), is_resolved = 1 WHERE row_id IN (SELECT row_id FROM column_values)')
+    except Exception as e:
+        log_error('Error: Problem with comparing values across input forms for ' + output_val, str(e), False)
+    return discrepancies_list
 
-    # for each output column name, retrieve all the rows from the input config file which correspond to this output table and column name
-    input_config_matching_rows = input_config[(input_config.output_tn == row['output_tn']) & (input_config.output_cn == row['output_cn'])]
+# writes an output table resolved in the database to its files. Returns its rows.
+def export_database_table(connection, table_plan, resolved_columns):
+    output_tn = table_plan['output_tn']
+    key_values = table_plan['key_values']
+    date_markers = table_plan['date_markers']
+    display_order = table_plan['display_order']
+    split_dates = date_markers['has_dmy_vars'] and (date_markers['date_col_name'] in resolved_columns)
+    column_names = key_values + list(resolved_columns.keys())
+    if split_dates:
+        column_names = column_names + [date_markers['day_col_name'], date_markers['month_col_name'], date_markers['year_col_name']]
+    for output_cn in display_order:
+        if output_cn not in column_names:
+            log_error('Error: No values could be retrieved for the output column \'' + output_cn + '\' in output table \'' + output_tn + '\'', '', False)
+    row_count = 0
+    try:
+        table_cursor = connection.execute('SELECT ' + ', '.join(['t.' + quote_identifier(key) for key in key_values] + ['r.' + resolved_column for resolved_column in resolved_columns.values()]) + ' FROM resolved_columns r JOIN table_keys t ON t.rowid = r.row_id WHERE r.is_resolved = 1 ORDER BY r.row_id')
+        output_writers = open_output_writers(output_tn, display_order)
+        try:
+            while True:
+                table_rows = table_cursor.fetchmany(output_chunk_rows)
+                if len(table_rows) == 0:
+                    break
+                table_chunk = pd.DataFrame(table_rows, columns = key_values + list(resolved_columns.keys()), dtype = object)
+                if split_dates:
+                    add_dmy_columns(table_chunk, date_markers['date_col_name'], date_markers['day_col_name'], date_markers['month_col_name'], date_markers['year_col_name'])
+                table_chunk = table_chunk.reindex(columns = display_order)
+                write_output_chunk(output_writers, table_chunk)
+                row_count += len(table_rows)
+        finally:
+            close_output_writers(output_writers)
+    except Exception as e:
+        log_error('Error: Could not write the output table \'' + output_tn + '\'', str(e), True)
+    return row_count
 
-    # if this DataFrame is empty, this means there is no information about this variable in the input form and a critical error should be thrown
-    if(input_config_matching_rows.empty):
-        log_error('Error: No corresponding input column for the output column \'' + row['output_cn'] + '\' in the input config file', '', True)
+# processes an output table with the SQLite backend
+def process_database_table(connection, output_tn, loaded_forms):
+    global merge_plan
+    global compiled_rules
+    global column_report
+    table_plan = merge_plan['tables'][output_tn]
+    key_values = table_plan['key_values']
+    table_report = {'stages': [], 'columns': {}}
+    table_stage = start_stage('process table')
+    print('\n\n# Creating output table: \'' + output_tn + '\'\n')
+    discrepancies_list = create_discrepancy_buffer(['output_tn', 'output_cn'] + key_values)
+    key_index_stage = start_stage('key index')
+    table_form_columns = create_database_table_forms(connection, table_plan, loaded_forms)
+    end_stage(key_index_stage, table_report['stages'])
+    # the column of the resolved_columns table which holds each resolved output column
+    resolved_columns = {}
+    for column_plan in table_plan['columns']:
+        output_cn = column_plan['output_cn']
+        if column_plan['is_key']:
+            continue
+        print('\n## Retrieving value for \'' + output_cn + '\'')
+        log_progress('## Retrieving value for \'' + output_cn + '\'')
+        column_stage = start_stage('resolve column')
+        column_report = {}
+        # the field of the column in each form; a form which is listed more than once uses its last field
+        form_fields = {}
+        for source in column_plan['sources']:
+            if (source['form_name'] in table_form_columns) and (source['field_name'] in table_form_columns[source['form_name']][1]):
+                form_fields[source['form_name']] = source['field_name']
+            else:
+                log_error('Error: The variable \'' + str(source['field_name']) + '\' is not contained in the form \'' + source['form_name'] + '\'. Column \'' + output_cn + '\' can not be compared across forms', '\'' + str(source['field_name']) + '\'', False)
+        if (len(form_fields) != 0):
+            print('...comparing ' + str(len(form_fields)) + ' forms')
+            if (not column_plan['is_dmy_var']) and (output_cn not in resolved_columns):
+                resolved_columns[output_cn] = 'resolved_' + str(len(resolved_columns))
+                connection.execute('ALTER TABLE resolved_columns ADD COLUMN ' + resolved_columns[output_cn])
+                discrepancies_list = resolve_database_column(connection, discrepancies_list, table_form_columns, form_fields, get_form_precedence_dict(column_plan), compiled_rules[column_plan['rule']], key_values, output_cn, output_tn, resolved_columns[output_cn])
+        # the time taken by the column, and its rows, forms and discrepancies
+        column_report.update(end_stage(column_stage, None))
+        column_report['forms'] = len(form_fields)
+        del column_report['stage']
+        table_report['columns'][output_cn] = column_report
+    export_stage = start_stage('export')
+    table_report['rows'] = export_database_table(connection, table_plan, resolved_columns)
+    end_stage(export_stage, table_report['stages'])
+    for table_form, form_columns in table_form_columns.values():
+        connection.execute('DROP TABLE IF EXISTS ' + table_form)
+    end_stage(table_stage, table_report['stages'])
+    return {'output_tn': output_tn, 'table': None, 'key_values': key_values, 'discrepancies': discrepancies_list, 'manifest': None, 'errors': [], 'critical': False, 'report': table_report}
 
-    # special case for the date column: compare across forms not just listed with a date output column, but also those with day, month, and year output columns, as a date column has been generated for these forms
-    if(input_config_matching_rows.iloc[0]['date_markers'] == 'date'):
-        input_config_matching_rows = input_config[(input_config.output_tn == row['output_tn']) & ((input_config.date_markers == 'date') | (input_config.date_markers == 'day'))]
-        for j, input_config_matching_row in input_config_matching_rows.iterrows():
-            if input_config_matching_row['output_cn'] != date_col_name:
-                input_config_matching_rows.at[j, 'output_cn'] = date_col_name
-                input_config_matching_rows.at[j, 'input_field_name'] = date_col_name + '_' + input_config_matching_row['input_form_name']
 
-    # if more than one row exists, this means that there are multiple source/input forms for this column value and they must be compared. Don't compare if this column value is a key value
-    if(row['output_cn'] not in key_values_list):
+## DRY RUN ##
+
+# the fields of a form which hold its key columns, and the field it is sampled on
+def get_form_key_fields(form_name):
+    global merge_plan
+    key_fields = []
+    sample_field = None
+    for output_tn in output_table_names:
+        table_plan = merge_plan['tables'][output_tn]
+        if form_name in table_plan['key_fields']:
+            form_key_fields = table_plan['key_fields'][form_name]
+            key_fields = key_fields + [field_name for field_name in form_key_fields.values() if field_name not in key_fields]
+            if sample_field is None:
+                sample_field = form_key_fields[table_plan['key_values'][0]]
+    return key_fields, sample_field
+
+# chooses the rows of the sampled participants, the same way shards are chosen
+def is_sampled_key(key_values, sample_modulus):
+    return (pd.util.hash_array(pd.Series(key_values, dtype = object).fillna('').to_numpy(dtype = object)) % np.uint64(sample_modulus)) == 0
+
+# reads each input form's header and key columns for the dry run
+def read_form_keys(form_paths):
+    global merge_plan
+    form_keys = {}
+    form_records = {}
+    for form_name in merge_plan['required_fields']:
+        if form_name not in form_paths:
+            log_error('Error: The input form \'' + form_name + '\' is used in the input config but isn\'t in the list of input files', '', False)
+    for form_name, form_path in form_paths.items():
+        try:
+            start_time = time.time()
+            form_fields = pd.read_csv(form_path, dtype = 'string', nrows = 0).columns.tolist()
+            required_fields = merge_plan['required_fields'][form_name]
+            missing_fields = [field_name for field_name in required_fields if field_name not in form_fields]
+            if len(missing_fields) != 0:
+                log_error('Error: The input form \'' + form_name + '\' doesn\'t have the field(s) ' + ', '.join('\'' + str(field_name) + '\'' for field_name in missing_fields) + ' used in the input config', '', False)
+            key_fields, sample_field = get_form_key_fields(form_name)
+            key_fields = [field_name for field_name in key_fields if field_name in form_fields]
+            form_keys[form_name] = pd.read_csv(form_path, dtype = 'string', usecols = key_fields if len(key_fields) != 0 else form_fields[:1])
+            form_records[form_name] = {'file_mb': round(os.path.getsize(form_path) / 1048576.0, 2), 'rows': len(form_keys[form_name]), 'fields': len(required_fields), 'sample_field': sample_field if sample_field in form_fields else None, 'key_read_seconds': round(time.time() - start_time, 4)}
+        except Exception as e:
+            log_error('Error: Could not read the input form \'' + form_name + '\' from \'' + form_path + '\'', str(e), False)
+    return form_keys, form_records
+
+# reads the rows of the sampled participants from each input form
+def read_form_samples(form_paths, form_keys, form_records, sample_modulus):
+    global merge_plan
+    sample_forms = {}
+    for form_name, form_record in form_records.items():
+        sample_field = form_record['sample_field']
+        if sample_field is None:
+            continue
+        try:
+            start_time = time.time()
+            is_sampled_row = is_sampled_key(form_keys[form_name][sample_field], sample_modulus)
+            required_fields = merge_plan['required_fields'][form_name]
+            sample_df = pd.read_csv(form_paths[form_name], dtype = 'string', usecols = lambda col: col in required_fields, skiprows = lambda line: (line != 0) and ((line > len(is_sampled_row)) or not is_sampled_row[line - 1]))
+            sample_df = sample_df[is_sampled_key(sample_df[sample_field], sample_modulus)].reset_index(drop = True)
+            # the memory of the form while parsed and once encoded, scaled up from the sample
+            sample_scale = form_record['rows'] / float(max(len(sample_df), 1))
+            form_record['read_memory_mb'] = round(2 * sample_df.memory_usage(index = False, deep = True).sum() / 1048576.0 * sample_scale, 2)
+            encode_form_columns(form_name, sample_df)
+            form_record['memory_mb'] = round(sample_df.memory_usage(index = False, deep = True).sum() / 1048576.0 * sample_scale, 2)
+            sample_forms[form_name] = sample_df
+            form_record['sample_rows'] = len(sample_df)
+            form_record['sample_read_seconds'] = round(time.time() - start_time, 4)
+        except Exception as e:
+            log_error('Error: Could not read a sample of the input form \'' + form_name + '\'', str(e), False)
+    return sample_forms
+
+# counts the key tuples of the forms of an output table
+def count_table_keys(table_plan, form_keys):
+    key_values = table_plan['key_values']
+    key_counts = []
+    table_record = {'duplicate_rows': {}}
+    for form_name in table_plan['row_forms']:
+        if form_name not in form_keys:
+            continue
+        key_fields = [table_plan['key_fields'][form_name][output_key_column] for output_key_column in key_values]
+        if not set(key_fields).issubset(form_keys[form_name].columns):
+            continue
+        form_key_counts = pd.MultiIndex.from_frame(form_keys[form_name][key_fields]).value_counts(dropna = False)
+        table_record['duplicate_rows'][form_name] = int(form_key_counts.sum() - len(form_key_counts))
+        key_counts.append(form_key_counts)
+    if len(key_counts) == 0:
+        table_record.update({'rows': 0, 'overlapping_rows': 0, 'join_rows': 0})
+        return table_record
+    key_counts = pd.concat(key_counts, axis = 1)
+    table_record['rows'] = len(key_counts)
+    table_record['overlapping_rows'] = int((key_counts.notna().sum(axis = 1) > 1).sum())
+    table_record['join_rows'] = int(key_counts.fillna(1).prod(axis = 1).sum())
+    return table_record
+
+# merges the output tables on the sampled forms, like a run
+def merge_sample_forms(sample_forms):
+    global loaded_input_files_dict
+    global resolved_columns_dict
+    global previous_manifest
+    global previous_discrepancies
+    global incremental_run
+    global discrepancy_spill_dir
+    global discrepancy_spill_count
+    global error_count
+    global cell_store_dir
+    # the sampled forms replace the loaded input forms while they are merged
+    resident_forms_dict = loaded_input_files_dict
+    loaded_input_files_dict = sample_forms
+    resolved_columns_dict = {}
+    previous_manifest = {'tables': {}}
+    previous_discrepancies = None
+    incremental_run = False
+    # the sample is never added to the cell store
+    cell_store_dir = None
+    discrepancy_spill_dir = tempfile.mkdtemp(prefix = 'merger_discrepancies_')
+    discrepancy_spill_count = 0
+    sample_results = {}
+    try:
+        for output_tn in output_table_names:
+            start_time = time.time()
+            table_result = process_output_table(output_tn)
+            for message, is_error in table_result['errors']:
+                if is_error:
+                    error_count += 1
+                error_log.write(message)
+            if table_result['critical']:
+                print('CRITICAL ERROR: Check error_log.txt')
+            table_result['seconds'] = time.time() - start_time
+            sample_results[output_tn] = table_result
+    finally:
+        shutil.rmtree(discrepancy_spill_dir, True)
+        loaded_input_files_dict = resident_forms_dict
+    return sample_results
+
+# the memory of the machine in MB, or None if it can't be found
+def get_machine_memory_mb():
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') / 1048576.0
+    except (AttributeError, ValueError, OSError):
+        return None
+
+# suggests --jobs or --shards from the estimated memory
+def suggest_run_options(estimate):
+    machine_memory = get_machine_memory_mb()
+    forms_memory = estimate['base_memory_mb'] + estimate['forms_memory_mb']
+    table_memory = max([table_record['memory_mb'] for table_record in estimate['tables'].values()] + [1])
+    cpu_count = os.cpu_count() or 1
+    suggestion = {'machine_memory_mb': None if machine_memory is None else round(machine_memory), 'cpus': cpu_count, 'shards': 1, 'jobs': 1, 'write_shards': None, 'streaming': False}
+    if machine_memory is None:
+        suggestion['jobs'] = min(cpu_count, max(len(estimate['tables']), 1))
+        return suggestion
+    # a fifth of the memory is left for python, the pool of processes, and everything else on the machine
+    usable_memory = machine_memory * 0.8
+    if forms_memory * 1.25 > usable_memory:
+        suggestion['write_shards'] = int(np.ceil(forms_memory * 1.25 / usable_memory)) + 1
+        suggestion['streaming'] = True
+    elif forms_memory + table_memory > usable_memory:
+        suggestion['shards'] = int(np.ceil(table_memory / (usable_memory - forms_memory)))
+    else:
+        suggestion['jobs'] = max(1, min(cpu_count, max(len(estimate['tables']), 1), int((usable_memory - forms_memory) / table_memory)))
+    return suggestion
+
+# estimates the cost of the run without running it
+def estimate_run(args):
+    global merge_plan
+    global run_report
+    estimate_stage = start_stage('dry run')
+    estimate = {'forms': {}, 'tables': {}}
+    base_memory = get_max_rss_mb() if resource is not None else 0
+    try:
+        form_paths = read_list_of_files(args.list_of_files)
+    except Exception as e:
+        log_error('Error: Could not load input source files from the given paths', str(e), True)
+    form_keys, estimate['forms'] = read_form_keys(form_paths)
+    # the participants are sampled so the largest form has about dry_run_sample_rows rows
+    largest_form_rows = max([form_record['rows'] for form_record in estimate['forms'].values()] + [1])
+    sample_modulus = max(1, int(np.ceil(largest_form_rows / float(max(args.dry_run_sample_rows, 1)))))
+    sample_forms = read_form_samples(form_paths, form_keys, estimate['forms'], sample_modulus)
+    sample_results = merge_sample_forms(sample_forms)
+    for output_tn in output_table_names:
+        table_plan = merge_plan['tables'][output_tn]
+        table_record = count_table_keys(table_plan, form_keys)
+        table_result = sample_results[output_tn]
+        sample_rows = len(table_result['table']) if table_result['table'] is not None else 0
+        # the sample's time, memory and discrepancies are scaled up to the table's rows
+        scale = 0.0 if table_result['critical'] else table_record['rows'] / float(max(sample_rows, 1))
+        table_record['sample_rows'] = sample_rows
+        table_record['critical_error'] = table_result['critical']
+        table_record['columns'] = len(table_plan['display_order'])
+        table_record['discrepancies'] = int(round(sum(column_record.get('discrepancies', 0) for column_record in table_result['report']['columns'].values()) * scale))
+        table_record['seconds'] = round(table_result['seconds'] * scale, 2)
+        # the work of the table takes about four times the size of the output table
+        table_memory = 0 if table_result['table'] is None else table_result['table'].memory_usage(index = False, deep = True).sum()
+        table_record['memory_mb'] = round(4 * table_memory / 1048576.0 * scale, 2)
+        estimate['tables'][output_tn] = table_record
+    # the forms are read on the pool of threads
+    read_seconds = [form_record['key_read_seconds'] * form_record['fields'] / max(len(form_keys[form_name].columns), 1) for form_name, form_record in estimate['forms'].items()]
+    estimate['read_seconds'] = round(max(max(read_seconds + [0]), sum(read_seconds) / max(args.read_threads, 1)), 2)
+    # freed memory mostly stays with the process
+    estimate['base_memory_mb'] = round(base_memory, 2)
+    estimate['forms_memory_mb'] = round(sum(form_record.get('read_memory_mb', 0) for form_record in estimate['forms'].values()), 2)
+    estimate['peak_memory_mb'] = round(base_memory + estimate['forms_memory_mb'] + max([table_record['memory_mb'] for table_record in estimate['tables'].values()] + [0]), 2)
+    estimate['seconds'] = round(estimate['read_seconds'] + sum(table_record['seconds'] for table_record in estimate['tables'].values()), 2)
+    estimate['discrepancies'] = sum(table_record['discrepancies'] for table_record in estimate['tables'].values())
+    estimate['sample_share'] = round(1.0 / sample_modulus, 4)
+    estimate['suggested'] = suggest_run_options(estimate)
+    end_stage(estimate_stage, run_report['stages'])
+    return estimate
+
+# prints the estimate of the run
+def print_estimate(estimate):
+    print('\n# Dry run estimate (merged on ' + str(round(100 * estimate['sample_share'], 2)) + '% of the participants)\n')
+    for form_name, form_record in estimate['forms'].items():
+        print('Form \'' + form_name + '\': ' + str(form_record['rows']) + ' rows, ' + str(form_record['file_mb']) + ' MB on disk, about ' + str(form_record.get('read_memory_mb', '?')) + ' MB while it is read and ' + str(form_record.get('memory_mb', '?')) + ' MB once loaded')
+    for output_tn, table_record in estimate['tables'].items():
+        if table_record['critical_error']:
+            print('Output table \'' + output_tn + '\': the run would stop with a critical error, see error_log.txt')
+            continue
+        print('Output table \'' + output_tn + '\': ' + str(table_record['rows']) + ' rows x ' + str(table_record['columns']) + ' columns, join of ' + str(table_record['join_rows']) + ' rows, ' + str(table_record['overlapping_rows']) + ' rows in more than one form, ' + str(sum(table_record['duplicate_rows'].values())) + ' duplicate key rows, about ' + str(table_record['discrepancies']) + ' discrepancies, ' + str(table_record['seconds']) + 's, ' + str(table_record['memory_mb']) + ' MB')
+    print('\nEstimated run: about ' + str(estimate['seconds']) + 's (' + str(estimate['read_seconds']) + 's reading the forms), peak memory about ' + str(estimate['peak_memory_mb']) + ' MB, about ' + str(estimate['discrepancies']) + ' discrepancies')
+    suggested = estimate['suggested']
+    if suggested['write_shards'] is not None:
+        print('Suggested: the forms may not fit in the memory of this machine (' + str(suggested['machine_memory_mb']) + ' MB); split them with --write-shards ' + str(suggested['write_shards']) + ' and run the shards on separate machines, or run with --streaming or --backend sqlite')
+    elif suggested['shards'] > 1:
+        print('Suggested: --shards ' + str(suggested['shards']) + ', so the largest output table fits in memory')
+    else:
+        print('Suggested: --jobs ' + str(suggested['jobs']) + ' (' + str(suggested['cpus']) + ' CPUs, ' + str(suggested['machine_memory_mb']) + ' MB of memory)')
+
+
+## RUNNING THE MERGER ##
+
+# builds the parser of the command line arguments, which are also the options of the Merger class
+def create_argument_parser():
+    parser = argparse.ArgumentParser(description = 'Creates output tables from the input forms and lists the discrepancies between them.')
+    parser.add_argument('list_of_files', help = 'text file listing the input forms and their directories')
+    parser.add_argument('input_config', help = 'input config file')
+    parser.add_argument('output_config', help = 'output config file')
+    parser.add_argument('--cache-dir', default = '.merger_cache', help = 'directory of the cache of parsed input forms')
+    parser.add_argument('--no-cache', action = 'store_true', help = 'always parse the input forms from their .csv files and build the merge plan from the config files')
+    parser.add_argument('--rebuild-cache', action = 'store_true', help = 'parse the input forms and build the merge plan again, and replace their cache entries')
+    parser.add_argument('--cache-size-mb', type = int, default = 4096, help = 'size cap of the cached forms and merge plans in MB; the least recently used are evicted at the start of each run and when one is added')
+    parser.add_argument('--incremental', action = 'store_true', help = 'only recompute the output columns whose inputs changed since the run recorded in the manifest')
+    parser.add_argument('--manifest', default = 'merger_manifest.json', help = 'run manifest recording what each output column was computed from')
+    parser.add_argument('--read-threads', type = int, default = 4, help = 'number of input forms read at the same time')
+    parser.add_argument('--jobs', type = int, default = 1, help = 'number of output tables (or shards) processed at the same time on a pool of processes')
+    parser.add_argument('--dry-run', nargs = '?', const = '', metavar = 'FILE', help = 'estimate the rows, discrepancies, peak memory and time of each output table from the key columns of the input forms and a merge of a sample of the participants, and suggest the number of jobs or shards, instead of running the merge; the estimate is also written to FILE as JSON if given')
+    parser.add_argument('--dry-run-sample-rows', type = int, default = 10000, help = 'number of rows of the largest input form in the sample merged by the dry run')
+    parser.add_argument('--write-plan', metavar = 'FILE', help = 'validate the config files and write the merge plan built from them to this file as JSON, instead of running the merge')
+    parser.add_argument('--rule-plugins', nargs = '+', default = [], metavar = 'FILE', help = 'python files which register additional comparison rules')
+    parser.add_argument('--discrepancy-batch-rows', type = int, default = 100000, help = 'number of discrepancies kept in memory before they are spilled to disk')
+    parser.add_argument('--output-formats', nargs = '+', choices = ['csv', 'csv.gz', 'parquet', 'feather'], default = ['csv'], metavar = 'FORMAT', help = 'formats the output tables are written in: csv, csv.gz (gzip-compressed), parquet, or feather (default: csv)')
+    parser.add_argument('--write-threads', type = int, default = 2, help = 'number of output tables written at the same time')
+    parser.add_argument('--discrepancies-parquet', action = 'store_true', help = 'also write the discrepancies to discrepancies.parquet')
+    parser.add_argument('--streaming', action = 'store_true', help = 'merge the input forms out of core: sort them by their key values on disk and merge them a batch of keys at a time')
+    parser.add_argument('--memory-budget-mb', type = float, default = 1024, help = 'memory budget of the streaming mode in MB')
+    parser.add_argument('--backend', choices = ['pandas', 'sqlite'], default = 'pandas', help = 'engine which resolves the output tables: in memory with pandas, or on disk in a SQLite database')
+    parser.add_argument('--database', metavar = 'FILE', help = 'database file of the sqlite backend (default: merger.sqlite in the cache directory)')
+    parser.add_argument('--shards', type = int, default = 1, help = 'hash-partition the input forms on the first key column into this many shards and run the whole merge on each shard')
+    parser.add_argument('--write-shards', metavar = 'DIR', help = 'write the shards of the input forms to this directory instead of running the merge')
+    parser.add_argument('--combine-shards', metavar = 'DIR', help = 'combine the outputs of shards which were run separately in this directory')
+    parser.add_argument('--run-report', metavar = 'FILE', help = 'write a JSON report of the wall time of each stage of the run with the process peak memory so far, and the time and counts of each output column, to this file')
+    parser.add_argument('--trace-memory', action = 'store_true', help = 'record the peak memory traced while each stage runs in the run report (slower)')
+    parser.add_argument('--profile', metavar = 'FILE', help = 'profile the run with cProfile and dump the statistics to this file')
+    parser.add_argument('--dictionary-max-values', type = int, default = 1000, help = 'dictionary-encode the compared columns of the input forms with at most this many distinct values, so they are held and compared as integer codes; 0 keeps every column as strings')
+    parser.add_argument('--cell-store', metavar = 'DIR', help = 'keep every resolved cell in this directory with a hash of the form rows it was resolved from, and only gather and resolve the cells whose form rows changed since the previous run')
+    parser.add_argument('--discrepancy-delta', action = 'store_true', help = 'also write the discrepancies which are new, changed, or disappeared since the previous run to discrepancies_delta.csv')
+    parser.add_argument('--duplicate-keys', choices = ['first', 'fail', 'precedence', 'report'], default = 'first', help = 'policy for key tuples with more than one row in a form, applied before any values are compared: use the first row, stop the run, combine the rows taking the first value which isn\'t missing, or use the first row and list the keys whose rows differ in discrepancies.csv')
+    parser.add_argument('--watch', action = 'store_true', help = 'keep running after the merge with the input forms loaded, and run it again whenever the config files, the list of input files, or an input form changes')
+    parser.add_argument('--watch-interval', type = float, default = 2, help = 'seconds between the checks for changed files in watch mode')
+    return parser
+
+# starts a run of the merger with the settings of the arguments and a new error log
+def start_run(args):
+    global cache_dir
+    global use_cache
+    global rebuild_cache
+    global cache_size_limit
+    global error_log
+    global error_count
+    global table_error_messages
+    global run_report
+    global stage_stack
+    global trace_memory
+    global run_stage
+    global column_report
+    global discrepancy_batch_rows
+    global memory_budget
+    global duplicate_key_policy
+    global dictionary_max_values
+    global output_formats
+
+    # settings for the cache of parsed input forms
+    cache_dir = args.cache_dir
+    use_cache = (not args.no_cache) and (feather is not None)
+    rebuild_cache = args.rebuild_cache
+    cache_size_limit = args.cache_size_mb * 1024 * 1024
+
+    # creates a log of errors regarding the format of the given forms, the program, etc.
+    if (error_log is not None) and not error_log.closed:
+        error_log.close()
+    if(os.path.exists('error_log.txt')):
+        os.remove('error_log.txt')
+    error_log = open('error_log.txt', 'a')
+
+    # counts the number of errors handled while running
+    error_count = 0
+
+    # messages for the error log from the output table being processed
+    table_error_messages = None
+
+    # the report of the run: its stages, and the time of each form and output table
+    run_report = {'arguments': vars(args), 'started': time.strftime('%Y-%m-%d %H:%M:%S'), 'stages': [], 'forms': {}, 'tables': {}}
+    stage_stack = []
+    trace_memory = args.trace_memory
+    if trace_memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+    run_stage = start_stage('run')
+
+    # the record of the output column being resolved
+    column_report = {}
+
+    # discrepancies are spilled to disk in batches of this many rows
+    discrepancy_batch_rows = args.discrepancy_batch_rows
+
+    # the memory budget of the streaming mode
+    memory_budget = args.memory_budget_mb * 1024 * 1024
+
+    # the policy for key tuples with more than one row in a form
+    duplicate_key_policy = args.duplicate_keys
 
-        print('\n## Retrieving value for \'' + row['output_cn'] + '\'')
-        log_error('## Retrieving value for \'' + row['output_cn'] + '\'', '', False)
+    # the compared columns with at most this many distinct values are dictionary-encoded
+    dictionary_max_values = args.dictionary_max_values
 
-        # creates DataFrames for each input form which includes the key values and the current column value
-        form_dataframes = create_dataframes_for_each_form(input_config_matching_rows, key_values_list, row['output_tn'])
-        form_precedence_dict = get_form_precedence_dict(input_config_matching_rows)
-        var_to_form_dict = get_var_to_form_dict(input_config_matching_rows)
+    # the formats the output tables are written in; the columnar formats need pyarrow
+    output_formats = list(dict.fromkeys(args.output_formats))
+    if feather is None:
+        for output_format in ['parquet', 'feather']:
+            if output_format in output_formats:
+                log_error('Error: pyarrow is needed to write the output tables as ' + output_format + ' files', '', False)
+                output_formats.remove(output_format)
+        if len(output_formats) == 0:
+            output_formats = ['csv']
 
-        # gets the comparison rule for the current column value
-        rule = str(input_config_matching_rows.iloc[0]['comparison_type'])
+    # loads the comparison rules from the plugin files
+    load_rule_plugins(args.rule_plugins)
 
-        # once these DataFrames have been created, compare their values, check for discrepancies, and export to the output table
-        if(len(form_dataframes) != 0):
-            print('...comparing ' + str(len(form_dataframes)) + ' forms')
-            if((row['output_cn'] != day_col_name) & (row['output_cn'] != month_col_name) & (row['output_cn'] != year_col_name)):
-                discrepancies_list = find_discrepancies(discrepancies_list, form_dataframes, key_values_list, row['output_cn'], row['output_tn'], form_precedence_dict, var_to_form_dict, rule)
+# builds the merge plan or loads it from the cache, and compiles its comparison rules
+def load_plan(args):
+    global use_plan_cache
+    global merge_plan
+    global compiled_rules
+    global output_table_names
+    global run_report
 
-# export each output file to a .csv with columns in the display order
-for output_file_name in output_files_dict:
-    output_config_matching_table = output_config[(output_config.output_tn == output_file_name)].sort_values(by=['output_display_order'])
-    in_order_output_table = pd.DataFrame()
-    for i, row in output_config_matching_table.iterrows():
-        in_order_output_table[row['output_cn']] = output_files_dict[output_file_name][row['output_cn']].copy()
-    in_order_output_table.to_csv(output_file_name + '.csv', index = False)
+    # the merge plan is cached alongside the parsed input forms
+    use_plan_cache = not args.no_cache
+
+    # a cache over its cap, e.g. because the cap was lowered, is brought within it before it is read
+    if use_plan_cache and os.path.isdir(cache_dir):
+        try:
+            with cache_lock:
+                evict_cache_entries()
+        except Exception as e:
+            log_error('Error: Could not remove the least recently used entries of the cache', str(e), False)
+    config_load_stage = start_stage('config load')
+    merge_plan = load_merge_plan(args.input_config, args.output_config)
+    compiled_rules = compile_plan_rules(merge_plan)
+    end_stage(config_load_stage, run_report['stages'])
+
+    # the output tables, in the order they appear in the sorted output config
+    output_table_names = merge_plan['table_names']
+
+# starts loading the input forms, or only their paths when streaming or with sqlite
+def start_loading_forms(args):
+    global database_run
+    global streaming_run
+    global form_paths
+    global stream_spill_dir
+    global stream_spill_count
+    global input_form_futures
+    global input_files_dict
+    global full_input_files_dict
+    global form_shard_ids
+    global shard_count
+    global hash_loaded_forms
+    database_run = args.backend == 'sqlite'
+    streaming_run = args.streaming and not database_run
+    # the rows of each form are hashed as it is loaded when the cell store will be used
+    hash_loaded_forms = bool(args.cell_store) and (args.shards <= 1) and not (streaming_run or database_run)
+    form_paths = {}
+    if streaming_run or database_run:
+        if (args.jobs > 1) or (args.shards > 1) or args.write_shards or args.incremental or (args.streaming and database_run):
+            print('The output tables are processed one at a time by the ' + ('sqlite backend' if database_run else 'streaming mode') + '; --jobs, --shards, --write-shards, --incremental' + (' and --streaming' if database_run else '') + ' are ignored')
+        try:
+            form_paths = read_list_of_files(args.list_of_files)
+        except Exception as e:
+            log_error('Error: Could not load input source files from the given paths', str(e), True)
+    if streaming_run:
+        stream_spill_dir = tempfile.mkdtemp(prefix = 'merger_streaming_')
+        stream_spill_count = 0
+        atexit.register(shutil.rmtree, stream_spill_dir, True)
+
+    # starts reading the input files on a pool of threads; each output table waits for the forms it needs
+    input_form_futures = {} if (streaming_run or database_run) else start_loading_input_files(args.list_of_files, args.read_threads)
+    input_files_dict = loaded_input_files_dict
+
+    # when sharding, the rows of each input form are assigned to shards
+    full_input_files_dict = loaded_input_files_dict
+    form_shard_ids = {}
+    shard_count = 1 if (streaming_run or database_run) else max(args.shards, 1)
+    if (shard_count > 1) or (args.write_shards and not (streaming_run or database_run)):
+        wait_for_input_forms(list(input_form_futures))
+        form_shard_ids = get_form_shard_ids(shard_count)
+
+# runs the merge of every output table and adds their results to the run
+def run_merge(args, incremental):
+    global incremental_run
+    global previous_manifest
+    global run_manifest
+    global previous_discrepancies
+    global cell_store_dir
+    global output_file_names
+    global output_files_dict
+    global output_write_pool
+    global output_write_futures
+    global resolved_columns_dict
+    global table_keys_df
+    global form_key_indexers
+    global key_values_list
+    global discrepancies_list
+    global discrepancy_spill_dir
+    global discrepancy_spill_count
+    global has_dmy_vars
+    global parsed_dates_dict
+    global date_col_name
+    global day_col_name
+    global month_col_name
+    global year_col_name
+    global loaded_input_files_dict
+
+    # the manifests of the previous run and this run; sharded runs are never incremental
+    incremental_run = incremental and (shard_count == 1) and not (streaming_run or database_run)
+    previous_manifest = load_run_manifest(args.manifest) if incremental_run else {'tables': {}}
+    run_manifest = {'tables': {}}
+
+    # the discrepancies of the previous run
+    previous_discrepancies = None
+    if incremental_run or (args.discrepancy_delta and os.path.exists('discrepancies.csv')):
+        previous_discrepancies = load_previous_discrepancies()
+
+    # the store of the cells resolved by each run
+    cell_store_dir = None
+    if args.cell_store:
+        if (shard_count > 1) or streaming_run or database_run:
+            print('The cell store is only used by runs which aren\'t sharded or streamed and use the pandas backend; --cell-store is ignored')
+        elif feather is None:
+            log_error('Error: pyarrow is needed for the cell store, --cell-store is ignored', '', False)
+        else:
+            try:
+                os.makedirs(args.cell_store, exist_ok = True)
+                cell_store_dir = args.cell_store
+            except Exception as e:
+                log_error('Error: Could not create the cell store directory \'' + args.cell_store + '\'', str(e), False)
+
+    # list of output file names to keep track of which ones have already been created
+    output_file_names = []
+
+    # dictionary which stores the output file DataFrames
+    output_files_dict = {}
+
+    # the output tables are written on a pool of threads as soon as they are complete
+    output_write_pool = concurrent.futures.ThreadPoolExecutor(max_workers = max(args.write_threads, 1))
+    output_write_futures = {}
+
+    # dictionary which stores the resolved columns of each output table until the table is assembled
+    resolved_columns_dict = {}
+
+    # the sorted key tuples of the current output table, and the row position of each in every form
+    table_keys_df = pd.DataFrame()
+    form_key_indexers = {}
+
+    # list of strings containing the key values of the last output table added to the results
+    key_values_list = []
+
+    # buffer which contains all of the discrepancies
+    discrepancies_list = None
+
+    # discrepancies are spilled to this directory until they are written to discrepancies.csv
+    discrepancy_spill_dir = tempfile.mkdtemp(prefix = 'merger_discrepancies_')
+    discrepancy_spill_count = 0
+    atexit.register(shutil.rmtree, discrepancy_spill_dir, True)
+
+    # boolean which stores whether the current output table has variables for the individual day, month and year variables
+    has_dmy_vars = False
+
+    # the parsed dates of the current output table's forms, by form name and field name
+    parsed_dates_dict = {}
+
+    # the name of the date, day, month, and year output columns. These names will be overriden to the names in the output config if the date markers are assigned.
+    date_col_name = 'visdate'
+    day_col_name = 'visday'
+    month_col_name = 'vismonth'
+    year_col_name = 'visyear'
+
+    print('Starting...')
+
+    # with more than one job, the output tables run on forked processes; results are added in order
+    can_fork = 'fork' in multiprocessing.get_all_start_methods()
+    if (args.jobs > 1) and not can_fork:
+        print('Processes can not be forked on this platform, processing the output tables one at a time')
+    if database_run:
+        # the input forms are loaded into the database, and each output table is resolved in it
+        try:
+            database_connection = open_merge_database(args.database if args.database else os.path.join(cache_dir, 'merger.sqlite'))
+        except Exception as e:
+            log_error('Error: Could not open the database of the sqlite backend', str(e), True)
+        form_load_stage = start_stage('form load')
+        loaded_forms = load_forms_into_database(database_connection, form_paths)
+        end_stage(form_load_stage, run_report['stages'])['forms'] = list(loaded_forms)
+        for output_tn in output_table_names:
+            add_table_result(process_database_table(database_connection, output_tn, loaded_forms))
+        database_connection.close()
+    elif streaming_run:
+        for output_tn in output_table_names:
+            add_table_result(stream_output_table(output_tn, form_paths))
+    elif shard_count > 1:
+        # every shard runs the whole merge; the results of each table are then combined across the shards
+        if (args.jobs > 1) and can_fork:
+            error_log.flush()
+            with concurrent.futures.ProcessPoolExecutor(max_workers = args.jobs, mp_context = multiprocessing.get_context('fork')) as pool:
+                shard_results = list(pool.map(process_shard, range(shard_count)))
+        else:
+            shard_results = [process_shard(shard_index) for shard_index in range(shard_count)]
+        for table_position in range(len(output_table_names)):
+            add_table_result(combine_shard_results([shard_result[table_position] for shard_result in shard_results]))
+    elif (args.jobs > 1) and can_fork:
+        # the processes are forked once every form has been read
+        wait_for_input_forms(list(input_form_futures))
+        error_log.flush()
+        with concurrent.futures.ProcessPoolExecutor(max_workers = args.jobs, mp_context = multiprocessing.get_context('fork')) as pool:
+            for table_result in pool.map(process_output_table, output_table_names):
+                add_table_result(table_result)
+    else:
+        # each output table starts as soon as the forms it uses have been read
+        for output_tn in output_table_names:
+            wait_for_input_forms(list(merge_plan['tables'][output_tn]['key_fields']))
+            add_table_result(process_output_table(output_tn))
+    if input_read_pool is not None:
+        input_read_pool.shutdown()
+
+    # shards and streamed batches replace the loaded forms while they are processed
+    loaded_input_files_dict = full_input_files_dict
+
+    if discrepancies_list is None:
+        discrepancies_list = create_discrepancy_buffer(['output_tn', 'output_cn'])
+
+# writes the outputs of the run and closes the error log
+def export_outputs(args):
+    global run_report
+
+    # waits for each output table to be written and records the time taken
+    export_stage = start_stage('export wait')
+    for output_tn, write_future in output_write_futures.items():
+        try:
+            run_report['tables'][output_tn]['stages'].append({'stage': 'export', 'seconds': round(write_future.result(), 4), 'formats': list(output_formats)})
+        except Exception as e:
+            log_error('Error: Could not write the output table \'' + output_tn + '\'', str(e), True)
+    output_write_pool.shutdown()
+    end_stage(export_stage, run_report['stages'])
+
+    discrepancies_export_stage = start_stage('discrepancies export')
+    write_discrepancies(discrepancies_list, 'discrepancies.csv', 'discrepancies.parquet' if (args.discrepancies_parquet or ('parquet' in output_formats)) else None)
+    # the discrepancies which changed since the previous run
+    if args.discrepancy_delta:
+        try:
+            delta_counts = write_discrepancy_delta(previous_discrepancies, 'discrepancies.csv', 'discrepancies_delta.csv')
+            run_report['discrepancy_delta'] = delta_counts
+            print('Discrepancies since the previous run: ' + str(delta_counts['new']) + ' new, ' + str(delta_counts['changed']) + ' changed, ' + str(delta_counts['disappeared']) + ' disappeared, listed in discrepancies_delta.csv')
+        except Exception as e:
+            log_error('Error: Could not write the discrepancies which changed since the previous run to discrepancies_delta.csv', str(e), False)
+    end_stage(discrepancies_export_stage, run_report['stages'])
+
+    # the manifest only describes unsharded runs of the pandas backend which aren't streamed
+    if (shard_count == 1) and not (streaming_run or database_run):
+        write_run_manifest(args.manifest, run_manifest)
+
+    # the run report is written last, so it covers the whole run
+    run_report.update(end_stage(run_stage, None))
+    del run_report['stage']
+    run_report['error_count'] = error_count
+    if args.run_report:
+        write_run_report(args.run_report, run_report)
+        print('Run report written to \'' + args.run_report + '\'')
+
+    error_log.close()
+
+    # the spilled discrepancies and sorted runs aren't needed once the outputs are written
+    shutil.rmtree(discrepancy_spill_dir, True)
+    if streaming_run:
+        shutil.rmtree(stream_spill_dir, True)
+
+    print('\nComplete.\nFinished with ' + str(error_count) + ' error(s).\nErrors listed in error_log.txt.\nDiscrepancies listed in discrepancies.csv.\n' + str(len(output_files_dict)) + ' output files created: ' + str(output_files_dict.keys()))
+
+# gets the size and modification time of each file the merger reads
+def get_watched_files(args):
+    watched_paths = [args.list_of_files, args.input_config, args.output_config]
+    try:
+        with open(args.list_of_files) as list_file:
+            for line in list_file.read().split('\n'):
+                split_line = line.split('|')
+                if len(split_line) == 3:
+                    watched_paths.append(split_line[2])
+    except Exception:
+        pass
+    watched_files = {}
+    for watched_path in watched_paths:
+        try:
+            file_stat = os.stat(watched_path)
+            watched_files[watched_path] = [file_stat.st_size, file_stat.st_mtime_ns]
+        except OSError:
+            watched_files[watched_path] = None
+    return watched_files
+
+# keeps the merger running, and runs it again whenever a file it reads changes
+def watch_for_changes(args):
+    watched_files = get_watched_files(args)
+    print('\nWatching the config files, the list of input files, and the input forms for changes. Press Ctrl+C to stop.')
+    try:
+        while True:
+            time.sleep(args.watch_interval)
+            current_files = get_watched_files(args)
+            if current_files == watched_files:
+                continue
+            changed_paths = sorted(path for path in set(watched_files) | set(current_files) if watched_files.get(path) != current_files.get(path))
+            watched_files = current_files
+            print('\n\n# Changed: ' + ', '.join(changed_paths))
+            start_time = time.time()
+            try:
+                start_run(args)
+                load_plan(args)
+                start_loading_forms(args)
+                run_merge(args, True)
+                export_outputs(args)
+                print('Run again in ' + str(round(time.time() - start_time, 2)) + 's')
+            except SystemExit:
+                print('The run stopped because of a critical error. Waiting for the files to change.')
+    except KeyboardInterrupt:
+        print('\nStopped watching.')
+
+# runs the merger from the command line
+def main(argv):
+    global output_files_dict
+    args = create_argument_parser().parse_args(argv)
+
+    # the whole run is profiled with cProfile if asked; the statistics can be read with the pstats module
+    profiler = None
+    if args.profile:
+        profiler = cProfile.Profile()
+        profiler.enable()
+
+    start_run(args)
+    load_plan(args)
+
+    # the validated plan is written out instead of running the merge
+    if args.write_plan:
+        try:
+            write_merge_plan(args.write_plan, merge_plan)
+        except Exception as e:
+            log_error('Error: Could not write the merge plan to \'' + args.write_plan + '\'', str(e), True)
+        error_log.close()
+        print('\nComplete.\nMerge plan of ' + str(len(merge_plan['table_names'])) + ' output tables written to \'' + args.write_plan + '\'.\nFinished with ' + str(error_count) + ' error(s).')
+        sys.exit()
+
+    # the cost of the run is estimated instead of running the merge
+    if args.dry_run is not None:
+        estimate = estimate_run(args)
+        print_estimate(estimate)
+        if args.dry_run != '':
+            try:
+                write_json_file(args.dry_run, estimate)
+            except Exception as e:
+                log_error('Error: Could not write the estimate to \'' + args.dry_run + '\'', str(e), True)
+        error_log.close()
+        print('\nComplete.\nDry run of ' + str(len(merge_plan['table_names'])) + ' output tables' + (', estimate written to \'' + args.dry_run + '\'' if args.dry_run != '' else '') + '.\nFinished with ' + str(error_count) + ' error(s).\nErrors listed in error_log.txt.')
+        sys.exit()
+
+    # the outputs of shards which were run separately only need to be combined
+    if args.combine_shards:
+        output_files_dict = {}
+        combine_shard_directories(args.combine_shards)
+        error_log.close()
+        print('\nComplete.\nCombined ' + str(len(output_files_dict)) + ' output files from the shards in \'' + args.combine_shards + '\'.\nFinished with ' + str(error_count) + ' error(s).\nErrors listed in error_log.txt.\nDiscrepancies listed in discrepancies.csv.')
+        sys.exit()
+
+    start_loading_forms(args)
+
+    # the shards are written out to be run separately
+    if args.write_shards and not (streaming_run or database_run):
+        write_shard_directories(args.write_shards, shard_count)
+        error_log.close()
+        sys.exit()
+
+    run_merge(args, args.incremental)
+    export_outputs(args)
+
+    if profiler is not None:
+        profiler.disable()
+        profiler.dump_stats(args.profile)
+        print('Profile written to \'' + args.profile + '\'')
+
+    # in watch mode the merger keeps running, with the input forms loaded
+    if args.watch:
+        watch_for_changes(args)
+
+
+## IMPORTABLE API ##
+
+# whether a module variable holds state of a run
+def is_run_state(name, value):
+    return not (name.startswith('__') or (name in shared_state_names) or isinstance(value, (types.ModuleType, types.FunctionType, type)))
+
+# gets the state of the run held by the module variables
+def get_run_state():
+    return dict((name, value) for name, value in globals().items() if is_run_state(name, value))
+
+# replaces the state of the run held by the module variables
+def set_run_state(run_state):
+    for name in list(get_run_state()):
+        if name not in run_state:
+            del globals()[name]
+    globals().update(run_state)
+
+# runs the merger from python in steps: plan, load, run and export. Each Merger keeps the state of its own runs.
+class Merger(object):
+
+    # takes the same arguments as the command line, with options by argument name
+    def __init__(self, list_of_files, input_config, output_config, **options):
+        self.args = create_argument_parser().parse_args([list_of_files, input_config, output_config])
+        for option_name, option_value in options.items():
+            if not hasattr(self.args, option_name):
+                raise TypeError('Unknown merger option \'' + option_name + '\'')
+            setattr(self.args, option_name, option_value)
+        self.run_state = copy.deepcopy(initial_run_state)
+        self.run_started = False
+        self.forms_loaded = False
+
+    # runs a step with this Merger's state in the module variables
+    def run_step(self, step):
+        with merger_lock:
+            module_state = get_run_state()
+            set_run_state(self.run_state)
+            try:
+                return step()
+            finally:
+                self.run_state = get_run_state()
+                set_run_state(module_state)
+
+    # starts a run and builds or loads its merge plan. Returns the plan.
+    def plan(self):
+        return self.run_step(self.plan_step)
+
+    # loads the input forms used by the plan, planning first if needed. Returns the forms.
+    def load(self):
+        return self.run_step(self.load_step)
+
+    # runs the merge and waits for the tables to be written. Returns the tables and discrepancies.
+    def run(self):
+        return self.run_step(self.merge_step)
+
+    # writes the other outputs of the last run and ends the run. Returns the number of errors.
+    def export(self):
+        return self.run_step(self.export_step)
+
+    # estimates the cost of the run without running it, as with --dry-run
+    def estimate(self):
+        return self.run_step(self.estimate_step)
+
+    # the steps, which are only run by run_step
+    def plan_step(self):
+        start_run(self.args)
+        load_plan(self.args)
+        self.run_started = True
+        self.forms_loaded = False
+        return merge_plan
+
+    def estimate_step(self):
+        if not self.run_started:
+            self.plan_step()
+        run_estimate = estimate_run(self.args)
+        self.run_started = False
+        self.forms_loaded = False
+        return run_estimate
+
+    def load_step(self):
+        if not self.run_started:
+            self.plan_step()
+        start_loading_forms(self.args)
+        wait_for_input_forms(list(input_form_futures))
+        self.forms_loaded = True
+        return loaded_input_files_dict
+
+    def merge_step(self):
+        if not self.forms_loaded:
+            self.load_step()
+        run_merge(self.args, self.args.incremental)
+        # the writer threads read the module variables, so they finish here
+        concurrent.futures.wait(list(output_write_futures.values()))
+        self.forms_loaded = False
+        return output_files_dict, read_discrepancy_buffer(discrepancies_list)
+
+    def export_step(self):
+        export_outputs(self.args)
+        self.run_started = False
+        return error_count
+
+
+## START OF PROGRAM ##
+
+# the state of the merger between runs, which each run's settings and results are added to
+error_log = None
+error_count = 0
+table_error_messages = None
+stage_stack = []
+trace_memory = False
+run_report = {'stages': [], 'forms': {}, 'tables': {}}
+column_report = {}
+duplicate_key_policy = 'first'
+dictionary_max_values = 1000
+output_formats = ['csv']
+output_write_pool = None
+output_write_futures = {}
+cell_store_dir = None
+previous_cells = {}
+table_cells = {}
+hash_loaded_forms = False
+loaded_form_row_hashes = {}
+table_row_hashes = {}
+table_column_hashes = {}
+duplicate_first_rows = {}
+duplicate_key_values = {}
+gathered_duplicate_values = {}
+table_duplicate_keys = {}
+merge_plan = None
 
-discrepancies_list.to_csv('discrepancies.csv', index = False)
+# the parsed input forms, which stay loaded between runs, and the fingerprint of each
+cache_lock = threading.Lock()
+input_read_pool = None
+input_form_futures = {}
+loaded_input_files_dict = {}
+loaded_form_fingerprints = {}
 
-error_log.close()
+# the variables shared by every Merger, and the state each Merger starts from
+merger_lock = threading.Lock()
+shared_state_names = ['cache_lock', 'merger_lock', 'shared_state_names', 'initial_run_state']
+initial_run_state = get_run_state()
 
-print('\nComplete.\nFinished with ' + str(error_count) + ' error(s).\nErrors listed in error_log.txt.\nDiscrepancies listed in discrepancies.csv.\n' + str(len(output_files_dict)) + ' output files created: ' + str(output_files_dict.keys()))
+if __name__ == '__main__':
+    main(sys.argv[1:])
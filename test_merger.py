@@ -0,0 +1,102 @@
+# Checks that every way of running the merger writes the same outputs as a serial run.
+# To run from terminal:
+# python -m pytest test_merger.py
+
+import os
+import sys
+import subprocess
+
+import pandas as pd
+import pytest
+
+import generate_synthetic_data
+
+merger_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'merger.py')
+
+# the settings of the synthetic data: small, but with conflicts, duplicates and both date layouts
+synthetic_settings = {'participants': 200, 'visits': 3, 'forms': 4, 'tables': 2, 'columns': 6, 'coverage': 0.8, 'overlap': 0.5, 'conflict_rate': 0.1, 'missing_rate': 0.05, 'duplicate_rate': 0.02, 'precedence_levels': 2, 'date_layout': 'mixed', 'seed': 1}
+
+## FUNCTIONS ##
+
+# runs the merger on the synthetic data in data_dir, in run_dir, and checks it exits cleanly
+def run_merger(data_dir, run_dir, merger_args):
+    if not os.path.isdir(run_dir):
+        os.makedirs(run_dir)
+    command = [sys.executable, merger_file, os.path.join(data_dir, 'list_of_files.txt'), os.path.join(data_dir, 'input_config.csv'), os.path.join(data_dir, 'output_config.csv')] + merger_args
+    completed = subprocess.run(command, cwd = run_dir, stdout = subprocess.PIPE, stderr = subprocess.STDOUT)
+    assert completed.returncode == 0, completed.stdout.decode('utf-8', 'replace')
+
+# reads the output tables and discrepancies.csv written by a run, by file name
+def read_outputs(run_dir):
+    outputs = {}
+    for file_name in sorted(os.listdir(run_dir)):
+        if file_name.endswith('.csv'):
+            with open(os.path.join(run_dir, file_name)) as output_file:
+                outputs[file_name] = output_file.read()
+    return outputs
+
+# changes a few values of one synthetic form, as a new export of it would
+def edit_form(data_dir):
+    form_path = os.path.join(data_dir, 'forms', 'form_1.csv')
+    form_df = pd.read_csv(form_path, dtype = str, keep_default_na = False)
+    value_column = form_df.columns[-1]
+    form_df.loc[form_df.index[:20], value_column] = '7'
+    form_df.to_csv(form_path, index = False)
+
+
+## TESTS ##
+
+# the synthetic data and the outputs of a serial run on it, shared by the tests
+@pytest.fixture(scope = 'module')
+def serial_run(tmp_path_factory):
+    data_dir = str(tmp_path_factory.mktemp('data'))
+    generate_synthetic_data.generate_synthetic_data(data_dir, synthetic_settings)
+    run_dir = str(tmp_path_factory.mktemp('serial'))
+    run_merger(data_dir, run_dir, ['--no-cache'])
+    return data_dir, read_outputs(run_dir)
+
+# every mode writes the same tables and discrepancies as the serial run
+@pytest.mark.parametrize('merger_args', [['--jobs', '2'], ['--shards', '2'], ['--shards', '2', '--jobs', '2'], ['--streaming'], ['--streaming', '--memory-budget-mb', '1'], ['--backend', 'sqlite'], [], ['--discrepancy-batch-rows', '10']])
+def test_modes_match_serial_run(serial_run, tmp_path, merger_args):
+    data_dir, serial_outputs = serial_run
+    run_merger(data_dir, str(tmp_path), merger_args)
+    outputs = read_outputs(str(tmp_path))
+    assert sorted(outputs) == sorted(serial_outputs)
+    for file_name in serial_outputs:
+        assert outputs[file_name] == serial_outputs[file_name], file_name
+
+# a rerun with the cache, and the database of the sqlite backend, writes the same outputs
+@pytest.mark.parametrize('merger_args', [[], ['--backend', 'sqlite']])
+def test_cached_rerun_matches_serial_run(serial_run, tmp_path, merger_args):
+    data_dir, serial_outputs = serial_run
+    run_merger(data_dir, str(tmp_path), merger_args)
+    run_merger(data_dir, str(tmp_path), merger_args)
+    assert read_outputs(str(tmp_path)) == serial_outputs
+
+# an incremental rerun after a form has changed writes the same outputs as a fresh run
+def test_incremental_rerun_matches_fresh_run(tmp_path):
+    data_dir = str(tmp_path / 'data')
+    generate_synthetic_data.generate_synthetic_data(data_dir, synthetic_settings)
+    incremental_dir = str(tmp_path / 'incremental')
+    run_merger(data_dir, incremental_dir, ['--incremental'])
+    edit_form(data_dir)
+    run_merger(data_dir, incremental_dir, ['--incremental'])
+    fresh_dir = str(tmp_path / 'fresh')
+    run_merger(data_dir, fresh_dir, ['--no-cache'])
+    assert read_outputs(incremental_dir) == read_outputs(fresh_dir)
+
+# a rerun with the cell store writes the same outputs as a fresh run
+def test_cell_store_rerun_matches_fresh_run(tmp_path):
+    data_dir = str(tmp_path / 'data')
+    generate_synthetic_data.generate_synthetic_data(data_dir, synthetic_settings)
+    store_dir = str(tmp_path / 'store')
+    run_merger(data_dir, store_dir, ['--cell-store', 'cells'])
+    run_merger(data_dir, store_dir, ['--cell-store', 'cells'])
+    fresh_dir = str(tmp_path / 'fresh')
+    run_merger(data_dir, fresh_dir, ['--no-cache'])
+    assert read_outputs(store_dir) == read_outputs(fresh_dir)
+    edit_form(data_dir)
+    run_merger(data_dir, store_dir, ['--cell-store', 'cells'])
+    changed_dir = str(tmp_path / 'changed')
+    run_merger(data_dir, changed_dir, ['--no-cache'])
+    assert read_outputs(store_dir) == read_outputs(changed_dir)